@@ -0,0 +1,156 @@
+# Reads a region with tesseract's word boxes and confidences instead of plain text, so the fields that did not match
+# their pattern, or that tesseract was unsure of, can be found on the image and read again on their own. Only the box
+# of each of those fields is read again, upscaled, as a single line or word, and limited to the characters the field can
+# hold. A better reading is added to the region's text as a line of its own, which extraction then uses, since it takes
+# the last match on the page. Pages whose fields are recovered this way do not need the slow search for their patient.
+import pytesseract
+from PIL import Image
+
+from timings import timed
+
+# Define adaptive extraction settings
+min_confidence = 60  # Fields tesseract read with a word below this confidence (0-100) are read again
+reread_scales = (2, 3)  # The field's box is upscaled by each of these in turn
+reread_psms = (7, 13)  # Read the box as one line of text, then as one raw line
+box_padding = 4  # Pixels added around a field's box, so the edges of its characters are not cut off
+
+
+def settings_key(fields: list) -> str:
+    """
+    Describe everything the text read_adaptively returns depends on besides the image and the region's tesseract
+    settings, so text read with other settings is never taken from the OCR cache
+    :param fields: the forms.Field objects read from the region
+    """
+    return repr((min_confidence, reread_scales, reread_psms, box_padding,
+                 [(field.label, field.whitelist, field.pattern.pattern) for field in fields]))
+
+
+def read_words(image, lang: str, config: str, stage: str = 'ocr') -> list:
+    """
+    Read the words of an image with their boxes and confidences
+    :param stage: the stage the call is timed as
+    :return: a list of dicts with text, conf, left, top, right, bottom and line, in reading order
+    """
+    with timed(stage):
+        data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+    words = []
+    for i, text in enumerate(data['text']):
+        if not text.strip() or float(data['conf'][i]) < 0:
+            continue
+        words.append({'text': text.strip(), 'conf': float(data['conf'][i]), 'left': data['left'][i],
+                      'top': data['top'][i], 'right': data['left'][i] + data['width'][i],
+                      'bottom': data['top'][i] + data['height'][i],
+                      'line': (data['block_num'][i], data['par_num'][i], data['line_num'][i])})
+    return words
+
+
+def words_to_text(words: list) -> str:
+    """
+    Lay words out as text the way image_to_string does: one line per line of words, and a blank line between blocks
+    """
+    text = ''
+    previous = None
+    for word in words:
+        if previous is None:
+            pass
+        elif word['line'] == previous:
+            text += ' '
+        elif word['line'][0] != previous[0]:
+            text += '\n\n'
+        else:
+            text += '\n'
+        text += word['text']
+        previous = word['line']
+    return text + '\n'
+
+
+def field_words(words: list, label: str, other_labels: list = ()) -> tuple:
+    """
+    Find the words of a field's value: the words after its label on the label's line, up to the next field's label
+    :param label: the text printed before the value, e.g. 'DOB:'. Fields without one are the whole region
+    :param other_labels: the labels of the other fields in the region, which end the value if they follow it on its line
+    :return: (the words of the value, or None if the label is not on the image, the box around them or None)
+    """
+    if not label:
+        if not words:
+            return None, None
+        value = words
+    else:
+        last_word = label.split()[-1].lower()
+        found = [word for word in words if word['text'].lower() == last_word]
+        if not found:
+            return None, None
+        label_word = found[-1]  # Extraction uses the last match, so the last label is the one that counts
+        first_words = {other.split()[0].lower() for other in other_labels if other and other != label}
+        value = []
+        end = None
+        for word in sorted((word for word in words if word['line'] == label_word['line']
+                            and word['left'] > label_word['left']), key=lambda word: word['left']):
+            if word['text'].lower() in first_words:
+                end = word['left']
+                break
+            value.append(word)
+        if not value:
+            # Nothing was read after the label, so the value is somewhere between it and the next label on its line
+            return [], (label_word['right'], label_word['top'], end, label_word['bottom'])
+    return value, (min(word['left'] for word in value), min(word['top'] for word in value),
+                   max(word['right'] for word in value), max(word['bottom'] for word in value))
+
+
+def reread(image, box: tuple, field, lang: str) -> tuple:
+    """
+    Read a field's box again, upscaled, with each page segmentation mode and the field's characters, and keep the
+    reading that matches the field's pattern with the best confidence
+    :param box: (left, top, right, bottom) in pixels. A right of None runs to the edge of the image
+    :return: (the value read, without its label, and its lowest word confidence), or (None, -1) if no reading matched
+    """
+    left, top, right, bottom = box
+    crop = image.crop((max(0, left - box_padding), max(0, top - box_padding),
+                       image.width if right is None else min(image.width, right + box_padding),
+                       min(image.height, bottom + box_padding)))
+    best, best_confidence = None, -1
+    for scale in reread_scales:
+        scaled = crop.resize((crop.width * scale, crop.height * scale), Image.LANCZOS)
+        for psm in reread_psms:
+            config = f'--psm {psm}'
+            if field.whitelist:
+                config += f' -c tessedit_char_whitelist={field.whitelist}'
+            words = read_words(scaled, lang, config, 'reread')
+            if not words:
+                continue
+            value = ' '.join(word['text'] for word in words)
+            confidence = min(word['conf'] for word in words)
+            if field.pattern.findall(f'{field.label} {value}\n'.lstrip()) and confidence > best_confidence:
+                best, best_confidence = value, confidence
+        if best_confidence >= min_confidence:
+            break
+    return best, best_confidence
+
+
+def read_adaptively(image, fields: list, lang: str, config: str) -> str:
+    """
+    Read a region, and read again the fields in it that did not match their pattern or were read with low confidence
+    :param image: the PIL image of the region
+    :param fields: the forms.Field objects read from the region
+    :param lang: the tesseract language
+    :param config: the tesseract config the region is read with
+    :return: the text of the region, with a line of the label and value of every field that was read better on its own
+    """
+    words = read_words(image, lang, config)
+    text = words_to_text(words)
+    labels = [field.label for field in fields]
+    recovered = []
+    for field in fields:
+        value_words, box = field_words(words, field.label, labels)
+        matched = bool(field.pattern.findall(text))
+        confidence = min((word['conf'] for word in value_words or ()), default=-1)
+        if matched and confidence >= min_confidence:
+            continue
+        if box is None:
+            continue  # The label was not read either, so there is nowhere to look for the value
+        value, reread_confidence = reread(image, box, field, lang)
+        if value is not None and (not matched or reread_confidence > confidence):
+            recovered.append(f'{field.label} {value}'.lstrip())
+    if recovered:
+        text += '\n' + '\n'.join(recovered) + '\n'
+    return text
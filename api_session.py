@@ -0,0 +1,150 @@
+# EXPERIMENTAL: files pages over http instead of driving the website's pages through Chrome. A browser is only needed
+# once, to log in, and its session cookie is then reused by every ApiSession.
+#
+# The api it calls has not been checked against the real website's traffic. It is the api mock_site.py serves, and
+# every part of it is assumed:
+#   - the paths in api_endpoints
+#   - the login sets a cookie named session_cookie, and calls without it are answered with 401 or 403
+#   - a search is a GET with one field and one value query parameter for each column searched by, named as in
+#     api_search_fields
+#   - a search answers with a JSON list of patients with the keys id, last, first, dob, sex, phone, address and provider
+#   - listing a folder is a GET with a folder query parameter, answered with a JSON list of files with a name key
+#   - an upload is a multipart POST with the file in a part named file, and folder and name query parameters
+# Record the real website's calls in the network tab of the browser's developer tools and check all of these before
+# using it on the real website.
+import os
+from urllib.parse import urljoin
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from backend import Backend, document_folders
+
+# Paths of the assumed api calls behind the patient search and documents pages, relative to the website's address
+api_endpoints = {
+    'search': 'api/patients/search',
+    'documents': 'api/patients/{patient_id}/documents',
+}
+
+# The cookie the assumed api checks on every call, set by logging in
+session_cookie = 'session'
+
+# Names the assumed api uses for each column that patients can be searched by
+api_search_fields = {
+    'Last Name': 'last',
+    'First Name': 'first',
+    'Date of Birth': 'dob',
+    'Preferred Phone': 'phone',
+    'Address': 'address',
+}
+
+
+def results_table(patients: list) -> pd.DataFrame or None:
+    """
+    Lay the patients the api returns out like the table that pd.read_html makes from the search results grid, so that
+    find_patient can read them by the same column numbers
+    :param patients: the patients, as returned by the api
+    :return: the table, or None if there are no patients
+    """
+    if not patients:
+        return None
+    return pd.DataFrame([['', p['id'], f"{p['last']}, {p['first']}", p['dob'], p['sex'], p['phone'], p['address'],
+                          p['provider']] for p in patients])
+
+
+class ApiSession(Backend):
+    """
+    Searches for patients, lists their documents and uploads files with http requests over a pooled connection, to the
+    assumed api described at the top of this file
+    """
+
+    def __init__(self, url: str, cookies: list = (), user_agent: str = None, timeout: float = 30, pool_size: int = 4):
+        """
+        :param url: the address of the website
+        :param cookies: the cookies of a logged-in browser, as returned by webdriver's get_cookies
+        :param user_agent: the user agent of that browser, so the website sees the same client
+        :param timeout: seconds to wait for a response before giving up
+        :param pool_size: the number of connections to keep open to the website
+        """
+        self.url = url if url.endswith('/') else url + '/'
+        self.timeout = timeout
+        self.results = []
+        self.patient_id = None
+        self.folder = None
+
+        # Keep connections to the website open between requests
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        for cookie in cookies:
+            # Python's cookie jar never sends cookies for a domain without a dot, like localhost, to that domain
+            domain = cookie.get('domain', '')
+            self.http.cookies.set(cookie['name'], cookie['value'], domain=domain if '.' in domain else '',
+                                  path=cookie.get('path', '/'))
+        if user_agent:
+            self.http.headers['User-Agent'] = user_agent
+
+    def endpoint(self, name: str, **kwargs) -> str:
+        return urljoin(self.url, api_endpoints[name].format(**kwargs))
+
+    def search_many(self, criteria: dict) -> pd.DataFrame or None:
+        """
+        Search for the patients that match several fields at once.
+        :param criteria: maps each column to search by, one of api_search_fields, to the value to search for
+        :return: the results laid out like the website's results table, or None if there are no results
+        """
+        params = []
+        for field, value in criteria.items():
+            params += [('field', api_search_fields[field]), ('value', value)]
+        response = self.http.get(self.endpoint('search'), params=params, timeout=self.timeout)
+        response.raise_for_status()
+        self.results = response.json()
+        return results_table(self.results)
+
+    def open_patient(self, row_index: int) -> None:
+        self.patient_id = self.results[row_index]['id']
+
+    def open_patient_by_id(self, patient_id, row: list) -> None:
+        # The documents api only needs the id
+        self.patient_id = patient_id
+
+    def open_documents(self, file_type: str) -> None:
+        self.folder = document_folders[file_type]
+
+    def list_documents(self) -> list:
+        response = self.http.get(self.endpoint('documents', patient_id=self.patient_id), params={'folder': self.folder},
+                                 timeout=self.timeout)
+        response.raise_for_status()
+        return [file['name'] for file in response.json()]
+
+    def upload(self, form_path: str, filename: str) -> None:
+        """
+        Upload a file into the open folder of the patient's documents and check that it shows up.
+        :param form_path: the path to the file
+        :param filename: the name the file shows up under
+        :raises RuntimeError: if the file is not in the folder after the upload
+        """
+        with open(form_path, 'rb') as file:
+            response = self.http.post(self.endpoint('documents', patient_id=self.patient_id),
+                                      params={'folder': self.folder, 'name': filename},
+                                      files={'file': (os.path.basename(form_path), file, 'application/pdf')},
+                                      timeout=self.timeout)
+        response.raise_for_status()
+        if filename not in self.list_documents():
+            raise RuntimeError(f"{filename} did not show up in the patient's documents after uploading it")
+
+    def is_logged_in(self) -> bool:
+        """
+        Check that the api still accepts the session cookie, with a search that finds nobody
+        """
+        try:
+            response = self.http.get(self.endpoint('search'), params=[('field', api_search_fields['Last Name']),
+                                                                      ('value', '-')], timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        return response.status_code not in (401, 403)
+
+    def close(self) -> None:
+        self.http.close()
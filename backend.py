@@ -0,0 +1,98 @@
+# The operations that filing a page needs from the website. BatchFiler only calls these, so it works the same whether
+# the website is driven through Chrome (browser.BrowserSession) or, experimentally, called over http
+# (api_session.ApiSession).
+
+# Titles of the folders in the patient's documents that each form type is filed in
+document_folders = {
+    'intake': 'IntakeForms',
+    'vf': 'Visual Fields',
+}
+
+
+class Backend:
+    """
+    A logged-in connection to the website
+    """
+
+    def open_search(self) -> None:
+        """
+        Go to the patient search, if the backend has to
+        """
+
+    def reset_search(self) -> None:
+        """
+        Clear the last search, if the backend has to
+        """
+
+    def search(self, field: str, value: str):
+        """
+        Search for patients by one field.
+        :param field: the column to search by (e.g. 'Last Name')
+        :param value: the value to search for
+        :return: the results as a dataframe laid out like the website's results table, or None if there are no results
+        """
+        return self.search_many({field: value})
+
+    def search_many(self, criteria: dict):
+        """
+        Search for the patients that match several fields at once, in one search.
+        :param criteria: maps each column to search by to the value to search for
+        :return: the results as a dataframe laid out like the website's results table, or None if there are no results
+        """
+        raise NotImplementedError
+
+    def open_patient(self, row_index: int) -> None:
+        """
+        Open a patient from the results of the last search
+        :param row_index: the 0-indexed row of the results
+        """
+        raise NotImplementedError
+
+    def open_patient_by_id(self, patient_id, row: list) -> None:
+        """
+        Open a patient found in the patient index. Searches for them by the name and date of birth the index has for
+        them and opens the row with their id, which backends that can open a patient by id skip
+        :param patient_id: the patient's id on the website
+        :param row: the patient's row of the search results table, as the index has it
+        :raises LookupError: if the website has no patient with that id
+        """
+        last_name = row[2].partition(',')[0].strip()
+        self.reset_search()
+        table = self.search_many({'Last Name': last_name, 'Date of Birth': row[3]})
+        if table is not None:
+            for i in range(len(table)):
+                if str(table[1][i]) == str(patient_id):
+                    self.open_patient(i)
+                    return
+        raise LookupError(f'No patient with id {patient_id}')
+
+    def open_documents(self, file_type: str) -> None:
+        """
+        Open the folder of the open patient's documents that the form type is filed in
+        """
+        raise NotImplementedError
+
+    def list_documents(self) -> list:
+        """
+        Get the names of the files in the open folder
+        """
+        raise NotImplementedError
+
+    def upload(self, form_path: str, filename: str) -> None:
+        """
+        Upload a file into the open folder and wait until it shows up
+        :param form_path: the path to the file
+        :param filename: the name the file shows up under
+        """
+        raise NotImplementedError
+
+    def is_logged_in(self) -> bool:
+        """
+        Check that the connection still works and is still logged in, before it is reused for another batch
+        """
+        return True
+
+    def close(self) -> None:
+        """
+        Release the connection
+        """
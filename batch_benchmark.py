@@ -0,0 +1,332 @@
+# Measures the whole script offline, from a batch pdf to uploaded documents, without real scans or the website.
+# A batch of intake or vf pages is drawn from a roster of patients in the layout the form templates in forms.py read,
+# with OCR-style misreadings and speckle noise, so the patient and fields of every page are known. The batch is then
+# filed into mock_site.py, and the run reports pages per minute, the timings of every stage, peak memory, and how many
+# fields were extracted and patients matched correctly. Every run is appended to a JSON lines file to compare runs.
+#
+# Usage: python batch_benchmark.py --roster data.csv --type intake --pages 50 --noise 0.1 --speckle 0.001
+#        python batch_benchmark.py --type vf --pages 200 --workers 4 --phases
+#        python batch_benchmark.py --type intake --pages 50 --backend http
+#        python batch_benchmark.py --type intake --pages 50 --check-prefilter
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFont
+
+import main
+from api_session import ApiSession
+from filing import filename_date_columns
+from error_ledger import ErrorLedger
+from journal import BatchJournal
+from match_benchmark import misread
+from mock_site import MockSite, serve
+from patient_index import PatientIndex
+from pipeline import run_batch
+from prefilter import PageFilter, PageHashes, is_duplicate, page_fingerprint
+from rasterize import page_sizes
+from timings import take_samples, print_timing_report, summarize
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+page_dpi = 200  # The resolution the synthetic pages are drawn at
+font_size = 32
+
+# The columns each form type has on its pages, which are the ones its extraction is scored on
+scored_columns = {
+    'intake': ['First Name', 'Last Name', 'Date of Birth', 'Sex', 'Preferred Phone', 'Address', 'Provider',
+               'Document Date'],
+    'vf': ['First Name', 'Last Name', 'Date of Birth', 'Screening Date'],
+}
+
+
+def load_font(size: int):
+    """
+    A scalable font, so the text is drawn at the size of the text on a scanned form
+    """
+    for name in ('arial.ttf', 'DejaVuSans.ttf', 'LiberationSans-Regular.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def make_patients(roster: pd.DataFrame, file_type: str, count: int, noise: float, rng: random.Random) -> list:
+    """
+    Pick the patient of every page and the values written on it
+    :param roster: the patients, with the columns of data.csv
+    :param file_type: 'intake' or 'vf'
+    :param count: the number of pages
+    :param noise: the chance that a field is written misread, the way OCR misreads it
+    :param rng: the random number generator
+    :return: a list of (roster index of the patient, the true values of the page, the values written on the page)
+    """
+    pages = []
+    for _ in range(count):
+        index = rng.randrange(len(roster))
+        truth = {column: str(roster.iloc[index][column]) for column in scored_columns[file_type]
+                 if column in roster.columns}
+        # The form's own date is never the date of birth, which validation would throw away
+        form_date = date(2020, 1, 1) + timedelta(days=rng.randrange(4 * 365))
+        truth[filename_date_columns[file_type]] = form_date.strftime('%m/%d/%Y')
+        written = {column: misread(value, rng) if rng.random() < noise else value for column, value in truth.items()}
+        pages.append((index, truth, written))
+    return pages
+
+
+def draw_page(values: dict, file_type: str, font, speckle: float, rng: random.Random) -> Image.Image:
+    """
+    Draw a letter-sized page with the values where the form's template reads them
+    :param values: the values written on the page
+    :param file_type: 'intake' or 'vf'
+    :param font: the font to write with
+    :param speckle: the fraction of the page's pixels that are specks of scanner noise
+    :param rng: the random number generator
+    """
+    width, height = int(8.5 * page_dpi), int(11 * page_dpi)
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    line_height = int(font_size * 1.5)
+    margin = page_dpi // 2
+
+    if file_type == 'intake':
+        # The patient information is in the top third, and the document date in the bottom tenth
+        lines = [f"First: {values['First Name']}", f"Last: {values['Last Name']}", f"DOB: {values['Date of Birth']}",
+                 f"Sex: {values['Sex']}", f"Preferred: Cell: {values['Preferred Phone']}",
+                 f"Address: {values['Address']}", f"Provider: {values['Provider']}"]
+        for i, line in enumerate(lines):
+            draw.text((margin, margin // 2 + i * line_height), line, fill=0, font=font)
+        draw.text((margin, height * 9 // 10 + line_height), f"Date: {values['Document Date']}", fill=0, font=font)
+    else:
+        # Everything is in the top seventh, with dates written with dashes
+        dob = values['Date of Birth'].replace('/', '-')
+        screening_date = values['Screening Date'].replace('/', '-')
+        draw.text((margin, margin // 2), f"NAME: {values['Last Name']}, {values['First Name']}   DOB: {dob}", fill=0,
+                  font=font)
+        draw.text((margin, margin // 2 + line_height), f"Screening DATE: {screening_date}", fill=0, font=font)
+
+    # Some text in the body of the page, which is never read
+    for i in range(10):
+        draw.line((margin, height // 2 + i * line_height, width - margin, height // 2 + i * line_height), fill=160)
+
+    specks = int(width * height * speckle)
+    draw.point([(rng.randrange(width), rng.randrange(height)) for _ in range(specks)], fill=0)
+    return image
+
+
+def write_batch(path: str, pages: list, file_type: str, speckle: float, rng: random.Random) -> None:
+    """
+    Write the pages into a batch pdf, one page at a time so only one page image is in memory
+    """
+    font = load_font(font_size)
+    for i, (index, truth, written) in enumerate(pages):
+        image = draw_page(written, file_type, font, speckle, rng)
+        image.save(path, 'PDF', resolution=page_dpi, append=i > 0)
+
+
+def check_distinct_pages(roster: pd.DataFrame, file_type: str, count: int, speckle: float, rng: random.Random) -> bool:
+    """
+    Check that the page filter skips none of the pages of a batch where every page is a different patient, even the
+    ones whose small renders look alike
+    :param count: the number of pages, at most the number of patients in the roster
+    :return: whether no page was skipped
+    """
+    pages = []
+    for index in rng.sample(range(len(roster)), min(count, len(roster))):
+        truth = {column: str(roster.iloc[index][column]) for column in scored_columns[file_type]
+                 if column in roster.columns}
+        form_date = date(2020, 1, 1) + timedelta(days=rng.randrange(4 * 365))
+        truth[filename_date_columns[file_type]] = form_date.strftime('%m/%d/%Y')
+        pages.append((index, truth, truth))
+
+    with tempfile.TemporaryDirectory() as folder:
+        batch_path = os.path.join(folder, 'Batch-1.pdf')
+        write_batch(batch_path, pages, file_type, speckle, rng)
+        journal = BatchJournal(os.path.join(folder, 'journal'), file_type, 1)
+        page_filter = PageFilter(journal, PageHashes(os.path.join(folder, 'page_hashes.db')))
+
+        # How many pairs of pages the hash alone would have taken for duplicates
+        sizes = page_sizes(batch_path, len(pages))
+        fingerprints = [page_fingerprint(page_filter.task(batch_path, i, sizes[i])) for i in range(len(pages))]
+        alike = sum(is_duplicate(hash_a, ink_a, hash_b, ink_b, page_filter.bits)
+                    for i, (ink_a, hash_a) in enumerate(fingerprints) for ink_b, hash_b in fingerprints[:i])
+
+        working_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            main.read_batch(batch_path, file_type, journal, use_cache=False, page_filter=page_filter)
+        finally:
+            os.chdir(working_folder)
+
+    print(f"{len(pages)} {file_type} pages of different patients: {alike} pairs look alike by their hash, "
+          f"{len(page_filter.skipped)} pages skipped")
+    return not page_filter.skipped
+
+
+def peak_rss_mb() -> tuple:
+    """
+    The most memory this process and the largest of its finished child processes, e.g. OCR workers, have used
+    :return: (this process, children) in MB, or (None, None) where it cannot be measured
+    """
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and kB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def score_run(df: pd.DataFrame, pages: list, journal: BatchJournal, site: MockSite) -> dict:
+    """
+    Count the fields extracted and patients matched correctly
+    :param df: the information extracted from every page, indexed by page
+    :param pages: the pages of the batch, from make_patients
+    :param journal: the journal the run recorded the matched patients in
+    :param site: the mock site the run searched
+    """
+    fields_correct = fields_total = correct = wrong = 0
+    for page_index, (index, truth, written) in enumerate(pages):
+        if page_index in df.index:
+            row = df.loc[page_index]
+            fields_correct += sum(str(row[column]) == value for column, value in truth.items())
+        fields_total += len(truth)
+
+        matched = journal.get(page_index, 'matched')
+        if matched is None:
+            continue
+        if str(matched['patient'][1]) == str(site.patients[index]['id']):
+            correct += 1
+        else:
+            wrong += 1
+    return {'fields correct': fields_correct, 'fields': fields_total, 'correct': correct, 'wrong': wrong,
+            'not found': len(pages) - correct - wrong}
+
+
+def file_synthetic_batch(batch_path: str, file_type: str, journal: BatchJournal, num_pages: int, open_session,
+                         args) -> pd.DataFrame:
+    """
+    Read and file the batch the way main.py does, with the same stages. The patient index, page hashes and error
+    ledger start empty, in the batch's folder
+    """
+    folder = os.path.dirname(batch_path)
+    patient_index = None if args.no_index else PatientIndex(':memory:')
+    page_hashes = None if args.no_prefilter else PageHashes(os.path.join(folder, 'page_hashes.db'))
+    page_filter = None if args.no_prefilter else PageFilter(journal, page_hashes)
+    error_ledger = ErrorLedger(os.path.join(folder, 'errors.db'))
+    cache_path = main.ocr_cache_path if args.cache else None
+    try:
+        if args.phases:
+            df = main.read_batch(batch_path, file_type, journal, use_cache=args.cache, page_filter=page_filter)
+            main.file_batch(df, batch_path, file_type, 1, journal, False, args.workers, open_session,
+                            matcher=args.matcher, patient_index=patient_index, error_ledger=error_ledger)
+            return df
+        return run_batch(batch_path, file_type, 1, journal, set(range(num_pages)), [], args.workers, open_session,
+                         main.default_null_date, main.default_null_phone_number, args.ocr_workers, cache_path,
+                         main.ocr_cache_max_bytes, page_filter, main.adaptive_extraction, matcher=args.matcher,
+                         patient_index=patient_index, documents_ttl=main.documents_cache_ttl,
+                         error_ledger=error_ledger)
+    finally:
+        if patient_index is not None:
+            patient_index.close()
+        if page_hashes is not None:
+            page_hashes.close()
+        error_ledger.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure reading and filing a synthetic batch into the mock site')
+    parser.add_argument('--roster', default='data.csv', help='csv with the columns of data.csv that holds the patients')
+    parser.add_argument('--type', choices=list(scored_columns), default='intake')
+    parser.add_argument('--pages', type=int, default=50, help='number of pages in the batch')
+    parser.add_argument('--noise', type=float, default=0.1, help='chance that a field is written misread')
+    parser.add_argument('--speckle', type=float, default=0.001, help='fraction of the pixels of a page that are specks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every request to the mock site takes')
+    parser.add_argument('--workers', type=int, default=main.upload_workers, help='sessions that upload at once')
+    parser.add_argument('--ocr-workers', type=int, default=main.ocr_workers, help='processes used for OCR')
+    parser.add_argument('--matcher', choices=['scored', 'cascade'], default=main.patient_matcher)
+    parser.add_argument('--backend', choices=['selenium', 'http'], default=main.upload_backend,
+                        help='file through Chrome, or (experimental) through the api the mock site serves')
+    parser.add_argument('--phases', action='store_true', help='read the whole batch before filing it')
+    parser.add_argument('--no-index', action='store_true',
+                        help='always search the mock site instead of an index that starts empty')
+    parser.add_argument('--no-prefilter', action='store_true', help='read every page without checking it first')
+    parser.add_argument('--cache', action='store_true', help='use the OCR cache, which is skipped by default')
+    parser.add_argument('--no-adaptive', action='store_true',
+                        help='read every region once, to compare against reading low-confidence fields again')
+    parser.add_argument('--log', default='benchmark.jsonl', help='JSON lines file every run is appended to')
+    parser.add_argument('--check-prefilter', action='store_true',
+                        help='only check that no page of a batch of different patients is skipped as a duplicate')
+    args = parser.parse_args()
+
+    # read_batch reads these from main. The cache is kept in the working folder rather than the batch's folder
+    main.ocr_workers = args.ocr_workers
+    main.ocr_cache_path = os.path.abspath(main.ocr_cache_path)
+    main.adaptive_extraction = not args.no_adaptive
+
+    rng = random.Random(args.seed)
+    roster = pd.read_csv(args.roster, dtype=str, keep_default_na=False)
+    if args.check_prefilter:
+        sys.exit(0 if check_distinct_pages(roster, args.type, args.pages, args.speckle, rng) else 1)
+    site = MockSite(args.roster, args.latency, alert_every=0)
+    server = serve(site)
+    url = f'http://localhost:{server.server_port}/'
+    if args.backend == 'http':
+        def open_session():
+            return ApiSession(url, [{'name': 'session', 'value': site.login(), 'domain': 'localhost', 'path': '/'}])
+    else:
+        open_session = main.session_opener('selenium', url, args.workers)
+    log_path = os.path.abspath(args.log)
+
+    # The batch, its journal and the error csv are kept out of the working folder
+    with tempfile.TemporaryDirectory() as folder:
+        pages = make_patients(roster, args.type, args.pages, args.noise, rng)
+        batch_path = os.path.join(folder, 'Batch-1.pdf')
+        start = time.perf_counter()
+        write_batch(batch_path, pages, args.type, args.speckle, rng)
+        print(f"Drew {len(pages)} {args.type} pages in {time.perf_counter() - start:.1f}s")
+
+        working_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            journal = BatchJournal(os.path.join(folder, 'journal'), args.type, 1)
+            take_samples()  # Only time the run itself
+            start = time.perf_counter()
+            df = file_synthetic_batch(batch_path, args.type, journal, len(pages), open_session, args)
+            seconds = time.perf_counter() - start
+            batch_samples = take_samples()
+            scores = score_run(df, pages, journal, site)
+        finally:
+            os.chdir(working_folder)
+            server.shutdown()
+
+    rss, children_rss = peak_rss_mb()
+    print()
+    print_timing_report(batch_samples)
+    print()
+    print(f"{len(pages)} pages in {seconds:.1f}s, {len(pages) / seconds * 60:.1f} pages/minute, "
+          f"{site.uploads} uploaded")
+    if rss is not None:
+        print(f"Peak memory: {rss:.0f} MB, largest OCR worker {children_rss:.0f} MB")
+    print(f"Fields extracted correctly: {scores['fields correct']}/{scores['fields']}, patients matched: "
+          f"{scores['correct']} correct, {scores['wrong']} wrong, {scores['not found']} not found")
+
+    result = {'time': time.time(), 'form_type': args.type, 'pages': len(pages), 'noise': args.noise,
+              'speckle': args.speckle, 'seed': args.seed, 'workers': args.workers, 'ocr_workers': args.ocr_workers,
+              'matcher': args.matcher, 'backend': args.backend, 'mode': 'phases' if args.phases else 'pipeline',
+              'index': not args.no_index, 'prefilter': not args.no_prefilter, 'cache': args.cache,
+              'adaptive': not args.no_adaptive, 'seconds': seconds,
+              'pages_per_minute': len(pages) / seconds * 60,
+              'uploads': site.uploads, 'peak_rss_mb': rss, 'peak_child_rss_mb': children_rss, **scores,
+              'stages': summarize(batch_samples)}
+    with open(log_path, 'a') as file:
+        file.write(json.dumps(result) + '\n')
@@ -0,0 +1,281 @@
+# Drives the website through one logged-in Chrome session. Every session has its own driver, so several sessions can
+# run side by side in their own threads.
+import pandas as pd
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.remote.webelement import WebElement
+
+from backend import Backend, document_folders
+from timings import timed
+from waits import wait_for, clicked, network_idle, any_of, stale, text_changed
+
+# Paths to the search field of every column that patients can be searched by
+search_field_paths = {
+    'Last Name': '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[1]/div/input',
+    'First Name': '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[2]/div/input',
+    'Date of Birth': '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[3]/div/ejs-datepicker/span/input',
+    'Preferred Phone': '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[3]/div[2]/div/ejs-maskedtextbox/span/input',
+    'Address': '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[3]/div[1]/div/input',
+}
+
+patients_tab_path = '/html/body/div[1]/header/div/div[2]/ul/li[1]/a'
+search_results_table_path = '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/ejs-grid/div[3]/div/table'
+results_count_path = '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/ejs-grid/div[5]/div[4]/span[2]'
+documents_table_path = '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/div/pms-patient-files/div/div[2]/div/div[2]/pms-folder-file-list/div/ejs-grid/div[4]/div/table'
+
+
+class BrowserSession(Backend):
+    """
+    A Chrome window logged in to the website
+    """
+
+    def __init__(self, url: str, headless: bool = False, wait_timeout: float = 10, network_idle_timeout: float = 3,
+                 upload_timeout: float = 60):
+        """
+        Open Chrome on the website.
+        :param url: the address of the website
+        :param headless: run Chrome without a window
+        :param wait_timeout: seconds to wait for an element or a search before giving up
+        :param network_idle_timeout: seconds to wait for the website to stop sending requests before carrying on anyway
+        :param upload_timeout: seconds to wait for an uploaded file to show up in the patient's documents
+        """
+        options = webdriver.ChromeOptions()
+        if headless:
+            options.add_argument('--headless=new')
+        self.driver = webdriver.Chrome(options=options)
+        self.wait_timeout = wait_timeout
+        self.network_idle_timeout = network_idle_timeout
+        self.upload_timeout = upload_timeout
+        self.advanced_search_open = False
+        self.open_folder = None  # The form type whose folder of the open patient's documents is showing
+
+        # Open the URL
+        self.driver.get(url)
+
+    def is_logged_in(self) -> bool:
+        """
+        Check that Chrome is still running and the website still shows the patients tab, which it hides once it logs
+        the session out
+        """
+        try:
+            return any(tab.is_displayed() for tab in self.driver.find_elements(By.XPATH, patients_tab_path))
+        except WebDriverException:
+            return False
+
+    def close(self) -> None:
+        self.driver.quit()
+
+    def login(self, username: str, password: str) -> None:
+        """
+        Login with username and password.
+        """
+        username_field = self.fetch_element(
+            '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/div[1]/div/input',
+            EC.element_to_be_clickable)
+        username_field.click()
+        username_field.send_keys(username)
+        password_field = self.fetch_element(
+            '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/div[2]/div/input',
+            EC.element_to_be_clickable)
+        password_field.click()
+        password_field.send_keys(password)
+        login_button = self.fetch_element(
+            '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/button',
+            EC.element_to_be_clickable)
+        login_button.click()
+
+        # The patients tab only shows once the website has logged in
+        try:
+            wait_for(self.driver, EC.visibility_of_element_located((By.XPATH, patients_tab_path)), self.wait_timeout,
+                     'login')
+        except TimeoutException:
+            raise RuntimeError('The website did not log in. Check the username and password') from None
+
+    def ensure_click(self, location: str, locator=By.XPATH) -> WebElement:
+        """
+        Ensures that the element at the given location is clickable and clicks it.
+        Sometimes, the element clicks are intercepted by other elements, so the click is retried with backoff until it
+        goes through or wait_timeout runs out.
+        :param location: describes the path to the element
+        :param locator: the type of locator to use (e.g. By.XPATH, By.ID, By.CSS_SELECTOR)
+        :return: the element that was clicked
+        :raises TimeoutException: if the element could not be clicked in time
+        """
+        return wait_for(self.driver, clicked((locator, location)), self.wait_timeout, 'click')
+
+    def fetch_element(self, location: str, condition=EC.presence_of_element_located,
+                      locator=By.XPATH) -> WebElement or None:
+        """
+        Fetches an element from the page using the given xpath and condition.
+        :param location: describes the path to the element
+        :param condition: the condition that the element must meet
+        :param locator: the type of locator to use (e.g. By.XPATH, By.ID, By.CSS_SELECTOR)
+        :return: The element if it is found, None otherwise
+        """
+        try:
+            return wait_for(self.driver, condition((locator, location)), self.wait_timeout, condition.__name__)
+        except TimeoutException:
+            return None
+
+    def wait_for_network_idle(self) -> None:
+        """
+        Wait until the website has stopped sending requests. Carries on after network_idle_timeout, since some pages
+        keep a request open in the background.
+        """
+        try:
+            wait_for(self.driver, network_idle(), self.network_idle_timeout, 'network idle')
+        except TimeoutException:
+            pass
+
+    def open_search(self) -> None:
+        """
+        Go to the advanced patient search
+        """
+        # Click Patient Tab and give the search page time to load
+        self.open_folder = None
+        self.ensure_click(patients_tab_path)
+        self.wait_for_network_idle()
+
+        # Click Advanced Search Button if we are searching for the first time
+        if not self.advanced_search_open:
+            self.ensure_click(
+                '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-simple-search/form/div[2]/div/div[2]/button[3]')
+            self.advanced_search_open = True
+
+    def reset_search(self) -> None:
+        # Clears the search fields
+        self.ensure_click(
+            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[2]/div/button[2]')
+
+    def search_many(self, criteria: dict) -> pd.DataFrame or None:
+        """
+        Search for patients by filling in several fields of the advanced search before searching.
+        :param criteria: maps each column to search by, one of search_field_paths, to the value to search for
+        :return: the results table as a dataframe, or None if there are no results
+        """
+        # Fetch each field, click on it, and enter the value
+        for field, value in criteria.items():
+            field_element = self.ensure_click(search_field_paths[field])
+            field_element.send_keys(value)
+
+        # Remember the results of the last search, which stay on the page until the new ones replace them
+        old_rows = self.driver.find_elements(By.XPATH, f'{search_results_table_path}/tbody/tr')
+        old_count = [label.text for label in self.driver.find_elements(By.XPATH, results_count_path)]
+        field_element.send_keys(u'\ue007')  # Press enter
+
+        # Wait until the results on the page are the new search's: the rows of the last search are replaced, even when
+        # both found as many patients, or the number of results changes. Without rows to replace, e.g. after a search
+        # that found nobody, wait for the number to change or for the search request to finish
+        conditions = [text_changed((By.XPATH, results_count_path), old_count[0] if old_count else None)]
+        conditions.append(stale(old_rows[0]) if old_rows else network_idle())
+        try:
+            wait_for(self.driver, any_of(*conditions), self.wait_timeout, 'search results')
+        except TimeoutException:
+            return None
+        self.wait_for_network_idle()
+
+        # Check if there are any results
+        results_label = self.fetch_element(results_count_path, EC.presence_of_element_located)
+
+        # Extract the number of results
+        number_of_results = int(results_label.text[1])
+        if number_of_results == 0:
+            return None
+
+        # Convert the results table to a dataframe
+        table = self.fetch_element(search_results_table_path, EC.presence_of_element_located)
+        table_html = table.get_attribute('outerHTML')
+        with timed('read_html'):
+            return pd.read_html(table_html)[0]
+
+    def open_patient(self, row_index: int) -> None:
+        """
+        Click on a patient in the search results
+        :param row_index: the 0-indexed row of the results table
+        """
+        patient = self.fetch_element(f'{search_results_table_path}/tbody/tr[{row_index + 1}]',
+                                     EC.element_to_be_clickable)
+        patient.click()
+        self.open_folder = None
+
+    def open_documents(self, file_type: str) -> None:
+        """
+        Go to the folder of the open patient's documents that the form type is filed in, unless it is already showing
+        """
+        if self.open_folder == file_type:
+            return
+
+        self.wait_for_network_idle()  # Give the alert time to pop up
+        # Check for alert pop-up and close it if it is present
+        try:
+            alert_cancel_btn = self.driver.find_element(By.CSS_SELECTOR,
+                                                        'button[data-test-id="alertHistoryModalCloseButton"]')
+            alert_cancel_btn.click()
+        except:
+            pass
+
+        # Navigate to the documents tab
+        self.ensure_click(
+            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/pms-patient-navigation-bar/ejs-sidebar/div/a[20]/span')
+
+        # Navigate to the correct folder
+        self.ensure_click(f"//li[@title='{document_folders[file_type]}']")
+        self.open_folder = file_type
+
+    @staticmethod
+    def read_table(driver) -> pd.DataFrame or None:
+        """
+        Expected condition that the table of the patient's documents has loaded
+        :param driver: the webdriver
+        :return: the table as a dataframe, or None while it is still showing the folders instead of the files
+        """
+        table = driver.find_element(By.XPATH, documents_table_path)
+        table_html = table.get_attribute('outerHTML')
+        try:
+            with timed('read_html'):
+                table = pd.read_html(table_html)[0]
+            if table[1][0] == 'Documents':
+                return None
+        except (ValueError, KeyError):  # The table is still rendering
+            return None
+        return table
+
+    def get_table(self) -> pd.DataFrame:
+        """
+        Get the table that contains the patient's documents once it has loaded
+        :return: the table as a dataframe
+        :raises TimeoutException: if the table did not load in time
+        """
+        return wait_for(self.driver, self.read_table, self.wait_timeout, 'documents table')
+
+    def list_documents(self) -> list:
+        """
+        Get the names of the files in the open folder of the patient's documents
+        """
+        return self.get_table()[1].tolist()
+
+    def upload(self, form_path: str, filename: str) -> None:
+        """
+        Upload a file into the open folder of the patient's documents and wait until it shows up.
+        :param form_path: the path to the file
+        :param filename: the name the file shows up under
+        :raises TimeoutException: if the file did not show up within upload_timeout
+        """
+        # Click on the upload button
+        self.ensure_click(
+            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/div/pms-patient-files/div/div[2]/div/div[2]/pms-folder-file-list/div/ejs-grid/div[2]/rev-table-action-menu/div/div/div[1]/div/button[1]')
+
+        # Click on the upload file button and input the path to the form
+        file_input = self.fetch_element(
+            "input[type='file']",
+            locator=By.CSS_SELECTOR)
+        file_input.send_keys(form_path)
+
+        # Wait until the file is uploaded into the patient's documents
+        def file_listed(driver) -> bool:
+            table = self.read_table(driver)
+            return table is not None and filename in table[1].tolist()
+
+        wait_for(self.driver, file_listed, self.upload_timeout, 'upload')
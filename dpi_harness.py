@@ -0,0 +1,89 @@
+# Checks how accurate region-only rendering is at different resolutions.
+# The whole page rendered at pdf2image's default dpi and cropped is the baseline, since that is what the script
+# extracted before pages were rendered by region. Each dpi is scored by how many fields match the baseline.
+#
+# Usage: python dpi_harness.py Batch-1.pdf Batch-2.pdf --form-type intake --dpi 100 150 200 --pages 20
+import argparse
+import sys
+import time
+
+import main
+from forms import form_templates
+from ocr import crop_region, extract_text
+from rasterize import count_pages, iter_page_chunks, page_sizes, render_region
+
+
+def extract_fields(template, regions_text: dict) -> list:
+    """
+    Turn the text of a page's regions into the fields the script would extract from them
+    """
+    return list(template.extract(regions_text, main.default_null_date, main.default_null_phone_number))
+
+
+def baseline_fields(path: str, num_pages: int, template) -> list:
+    """
+    Extract the fields of every page by rendering the whole page at the default dpi and cropping it
+    """
+    fields = []
+    for first_index, pages in iter_page_chunks(path, 8, num_pages):
+        for page in pages:
+            fields.append(extract_fields(template, {name: extract_text(crop_region(page, region))
+                                                    for name, region in template.regions.items()}))
+    return fields
+
+
+def region_fields(path: str, num_pages: int, template, dpi: int) -> list:
+    """
+    Extract the fields of every page by rendering only the regions, in grayscale, at the given dpi
+    """
+    sizes = page_sizes(path, num_pages)
+    return [extract_fields(template, {name: extract_text(render_region(path, i, region, dpi, sizes[i]))
+                                      for name, region in template.regions.items()}) for i in range(num_pages)]
+
+
+def run_harness() -> int:
+    parser = argparse.ArgumentParser(description='Compare region-only rendering at several dpis to the full-page render')
+    parser.add_argument('pdfs', nargs='+', help='sample batch pdfs')
+    parser.add_argument('--form-type', choices=list(form_templates), default=main.file_type)
+    parser.add_argument('--dpi', type=int, nargs='+', default=[100, 150, 200, 250, 300])
+    parser.add_argument('--pages', type=int, default=20, help='maximum number of pages to check in each pdf')
+    args = parser.parse_args()
+
+    template = form_templates[args.form_type]
+
+    # Extract the baseline fields once
+    samples = []
+    start = time.perf_counter()
+    for path in args.pdfs:
+        num_pages = min(count_pages(path), args.pages)
+        samples.append((path, num_pages, baseline_fields(path, num_pages, template)))
+    total_pages = sum(num_pages for path, num_pages, fields in samples)
+    baseline_time = (time.perf_counter() - start) / total_pages
+
+    print(f"{total_pages} pages, baseline {baseline_time:.2f}s per page")
+    print(f"{'dpi':>5} {'pages matching':>15} {'fields matching':>16} {'s/page':>7}")
+
+    configured_dpi_matches = True
+    for dpi in sorted(set(args.dpi) | {template.dpi}):
+        pages_matching = fields_matching = fields_total = 0
+        start = time.perf_counter()
+        for path, num_pages, expected in samples:
+            for page_expected, page_found in zip(expected, region_fields(path, num_pages, template, dpi)):
+                matches = sum(a == b for a, b in zip(page_expected, page_found))
+                fields_matching += matches
+                fields_total += len(page_expected)
+                pages_matching += matches == len(page_expected)
+        seconds = (time.perf_counter() - start) / total_pages
+
+        marker = ' <- configured' if dpi == template.dpi else ''
+        print(f"{dpi:>5} {pages_matching:>7}/{total_pages:<7} {fields_matching:>8}/{fields_total:<7} {seconds:>7.2f}"
+              f"{marker}")
+        if dpi == template.dpi and pages_matching != total_pages:
+            configured_dpi_matches = False
+
+    # A non-zero exit means the configured dpi extracts something different from the full-page render
+    return 0 if configured_dpi_matches else 1
+
+
+if __name__ == '__main__':
+    sys.exit(run_harness())
@@ -0,0 +1,154 @@
+# Ledger of the pages whose patient could not be found, kept in SQLite with one row per batch, page, name and date of
+# birth, so recording an error never rereads the history of errors. Errors are recorded the moment they happen, and
+# marked resolved once their page is uploaded, e.g. by retrying it with python main.py --retry-errors.
+# Every new error is also appended to error_{form type}.csv, which can be rewritten from the ledger at any time.
+#
+# Usage: python error_ledger.py --type intake --unresolved
+#        python error_ledger.py --type intake --export error_intake.csv --all
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from csv import reader, writer
+
+from forms import form_templates
+
+error_columns = ['batch', 'page', 'first_name', 'last_name', 'date_of_birth']
+
+
+class ErrorLedger:
+    """
+    The errors of every batch of every form type. Shared by every upload thread.
+    """
+
+    def __init__(self, path: str, csv_path: str or None = 'error_{file_type}.csv'):
+        """
+        :param path: the path to the ledger. It is created if it does not exist
+        :param csv_path: the csv every new error of a form type is appended to, formatted with the form type, or None
+        to only keep errors in the ledger. The rows of a form type's csv are imported while the ledger has none of them
+        """
+        self.csv_path = csv_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS errors '
+                                '(file_type TEXT NOT NULL, batch INTEGER NOT NULL, page INTEGER NOT NULL, '
+                                'first_name TEXT NOT NULL, last_name TEXT NOT NULL, date_of_birth TEXT NOT NULL, '
+                                'batch_path TEXT, recorded REAL NOT NULL, resolved REAL, resolution TEXT, '
+                                'PRIMARY KEY (file_type, batch, page, first_name, last_name, date_of_birth))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS errors_unresolved ON errors (file_type, resolved)')
+        if csv_path is not None:
+            for file_type in form_templates:
+                self.import_csv(file_type, csv_path.format(file_type=file_type))
+
+    def import_csv(self, file_type: str, csv_path: str) -> int:
+        """
+        Add the rows of an error csv written before the ledger existed, unless the ledger already has errors of the
+        form type
+        :return: the number of errors added
+        """
+        if not os.path.exists(csv_path):
+            return 0
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM errors WHERE file_type = ? LIMIT 1', (file_type,)).fetchone():
+                return 0
+            with open(csv_path, newline='') as file:
+                # Skip headers and rows that are not [batch number, page number, first name, last name, date of birth]
+                rows = [row[:5] for row in reader(file) if len(row) >= 5 and row[0].isdigit() and row[1].isdigit()]
+            self.connection.executemany('INSERT OR IGNORE INTO errors (file_type, batch, page, first_name, last_name, '
+                                        'date_of_birth, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [(file_type, int(row[0]), int(row[1]), *row[2:], time.time()) for row in rows])
+        return len(rows)
+
+    def record(self, file_type: str, error_patient: list, batch_path: str = None) -> bool:
+        """
+        Record a page whose patient could not be found. A page recorded before is marked unresolved again
+        :param file_type: 'intake' or 'vf'
+        :param error_patient: [batch number, page number, first name, last name, date of birth]
+        :param batch_path: the path to the batch pdf, so the page can be retried
+        :return: True if the error is new
+        """
+        batch, page, first_name, last_name, date_of_birth = [str(x) for x in error_patient[:5]]
+        key = (file_type, int(batch), int(page), first_name, last_name, date_of_birth)
+        with self.lock:
+            added = self.connection.execute(
+                'INSERT OR IGNORE INTO errors (file_type, batch, page, first_name, last_name, date_of_birth, '
+                'batch_path, recorded) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + (batch_path, time.time())).rowcount == 1
+            if not added:
+                self.connection.execute(
+                    'UPDATE errors SET resolved = NULL, resolution = NULL, batch_path = COALESCE(?, batch_path) '
+                    'WHERE file_type = ? AND batch = ? AND page = ? AND first_name = ? AND last_name = ? '
+                    'AND date_of_birth = ?', (batch_path,) + key)
+            elif self.csv_path is not None:
+                # Keep the csv the user reads up to date, without reading it
+                with open(self.csv_path.format(file_type=file_type), 'a', newline='') as file:
+                    writer(file).writerow([batch, page, first_name, last_name, date_of_birth])
+        return added
+
+    def resolve(self, file_type: str, batch_number: int, page_number: int, resolution: str) -> None:
+        """
+        Mark the errors of a page as resolved, e.g. because it has been uploaded
+        :param page_number: the 1-indexed page of the batch
+        """
+        with self.lock:
+            self.connection.execute('UPDATE errors SET resolved = ?, resolution = ? '
+                                    'WHERE file_type = ? AND batch = ? AND page = ? AND resolved IS NULL',
+                                    (time.time(), resolution, file_type, batch_number, page_number))
+
+    def errors(self, file_type: str, unresolved: bool = True, batch_number: int = None) -> list:
+        """
+        Get the errors of a form type, in batch and page order
+        :param unresolved: only get the errors that have not been resolved
+        :param batch_number: only get the errors of this batch
+        :return: a dict per error with its batch, page, first_name, last_name, date_of_birth, batch_path, recorded,
+        resolved and resolution
+        """
+        query = 'SELECT * FROM errors WHERE file_type = ?'
+        parameters = [file_type]
+        if unresolved:
+            query += ' AND resolved IS NULL'
+        if batch_number is not None:
+            query += ' AND batch = ?'
+            parameters.append(batch_number)
+        with self.lock:
+            cursor = self.connection.execute(query + ' ORDER BY batch, page', parameters)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def export(self, file_type: str, csv_path: str, unresolved: bool = True) -> int:
+        """
+        Write the errors of a form type to a csv laid out like the error csv
+        :return: the number of errors written
+        """
+        errors = self.errors(file_type, unresolved)
+        with open(csv_path, 'w', newline='') as file:
+            writer_object = writer(file)
+            for error in errors:
+                writer_object.writerow([error[column] for column in error_columns])
+        return len(errors)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or export the pages whose patient could not be found')
+    parser.add_argument('--ledger', default='errors.db', help='path to the error ledger')
+    parser.add_argument('--type', choices=list(form_templates), default='intake')
+    parser.add_argument('--unresolved', action='store_true', help='print the errors that have not been resolved')
+    parser.add_argument('--export', metavar='PATH', help='write the errors to a csv laid out like the error csv')
+    parser.add_argument('--all', action='store_true', help='export resolved errors too')
+    args = parser.parse_args()
+
+    ledger = ErrorLedger(args.ledger)
+    if args.unresolved:
+        errors = ledger.errors(args.type)
+        print(f"{len(errors)} unresolved {args.type} errors")
+        for error in errors:
+            recorded = time.strftime('%Y-%m-%d %H:%M', time.localtime(error['recorded']))
+            print(f"Batch {error['batch']:<5} page {error['page']:<5} {error['first_name']} {error['last_name']} "
+                  f"{error['date_of_birth']}  recorded {recorded}")
+    if args.export:
+        print(f"Wrote {ledger.export(args.type, args.export, not args.all)} errors to {args.export}")
+    ledger.close()
@@ -0,0 +1,516 @@
+# Finds the patient of every page on the website and uploads the page into their documents.
+# Pages are handed out to one or more browser sessions through a work queue, each session in its own thread. The pages
+# of each patient are handed out together, so they are all uploaded in one visit to the patient's documents.
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from matching import best_match, search_criteria, score_row, normalize, match_weights, match_threshold, row_patient_id
+from rasterize import extract_page
+from timings import timed
+
+# Columns the patient is searched by, in the order they are tried
+search_order = {
+    'intake': ['Last Name', 'First Name', 'Date of Birth', 'Preferred Phone', 'Address'],
+    'vf': ['Last Name', 'First Name', 'Date of Birth'],
+}
+
+# Column that holds the date each form type's file is named after
+filename_date_columns = {
+    'intake': 'Document Date',
+    'vf': 'Screening Date',
+}
+
+months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+
+
+def find_patient(patient_info: list, table: pd.DataFrame, file_type: str) -> int or None:
+    """
+    Find the patient using the given patient info
+    :param patient_info: all the patient info
+    :param table: the search results table
+    :param file_type: 'intake' or 'vf'
+    :return: the index of the row of the valid patient, None if no valid patient was found
+    """
+    patient_info = [str(x).lower() for x in patient_info]  # convert all patient info to lowercase for easier comparison
+
+    # Go through each patient in table to find valid patient
+    valid_row_index = None
+    for i, patient in table.iterrows():
+        date_of_birth_valid = patient_info[2] in table[3][i].lower()  # shared between intake forms and vf forms
+
+        if file_type == 'intake':
+            full_name_valid = patient_info[0] in table[2][i].lower() and patient_info[1] in table[2][0].lower()
+            sex_valid = patient_info[3] in table[4][i].lower()
+            phone_number_valid = patient_info[4] in str(table[5][i]).lower()
+            address_valid = patient_info[5] in table[6][i].lower()
+            provider_valid = patient_info[6] in table[7][i].lower()
+            if (full_name_valid and date_of_birth_valid) or (
+                    (full_name_valid or date_of_birth_valid) and (sex_valid or provider_valid) and (
+                    phone_number_valid or address_valid)):
+                valid_row_index = i  # if any of the above conditions are true, then the patient is valid
+        elif file_type == 'vf':
+            first_name_valid = patient_info[0] in table[2][i].lower()
+            last_name_valid = patient_info[1] in table[2][i].lower()
+            if (first_name_valid or last_name_valid) and date_of_birth_valid:
+                valid_row_index = i  # if any of the above conditions are true, then the patient is valid
+
+    return valid_row_index
+
+
+def cascade_search(session, patient: pd.Series, file_type: str, seen=None) -> tuple or None:
+    """
+    Search for the patient by each of the search fields in turn, until find_patient accepts a row of the results
+    :param session: the session to search with
+    :param patient: the row of the page in the dataframe
+    :param file_type: 'intake' or 'vf'
+    :param seen: called with every search results table, e.g. to add it to the patient index
+    :return: (search results table, index of the patient's row, None), or None if the patient was not found
+    """
+    patient_data = patient.tolist()
+    for field in search_order[file_type]:
+        # Reset the search to avoid errors
+        session.reset_search()
+
+        # If no results are found using this field, try again with the next one, if any
+        with timed(f'search: {field}'):
+            table = session.search(field, patient[field])
+        if table is None:
+            continue
+        if seen is not None:
+            seen(table)
+        row_index = find_patient(patient_data, table, file_type)
+        if row_index is not None:
+            return table, row_index, None
+    return None
+
+
+def scored_search(session, patient: pd.Series, file_type: str, placeholders: set, seen=None) -> tuple or None:
+    """
+    Search for the patient by the most selective combination of fields first, and score every row of the results.
+    Broader searches are only run when a search finds no row that scores confidently.
+    :param session: the session to search with
+    :param patient: the row of the page in the dataframe
+    :param file_type: 'intake' or 'vf'
+    :param placeholders: the values that mean a column could not be read
+    :param seen: called with every search results table, e.g. to add it to the patient index
+    :return: (search results table, index of the patient's row, its score), or None if the patient was not found
+    """
+    for criteria in search_criteria(patient, file_type, placeholders):
+        session.reset_search()
+        with timed('search: ' + ' + '.join(criteria)):
+            table = session.search_many(criteria)
+        if table is None:
+            continue
+        if seen is not None:
+            seen(table)
+        match = best_match(patient, table, file_type, placeholders)
+        if match is not None:
+            return table, match[0], match[1]
+    return None
+
+
+def document_filename(date: str, file_type: str, null_date: str) -> str:
+    """
+    Name the file a form is uploaded as
+    :param date: the document date (intake) or screening date (vf)
+    :param file_type: 'intake' or 'vf'
+    :param null_date: the date that means the date could not be read
+    :return: e.g. January-2020-intake.pdf
+    """
+    if date == null_date:
+        return f'Unknown-Document-Date-{file_type}.pdf'  # Name the file as an unknown document date if the date is null
+
+    # Get the month and year from the date and include it in the filename
+    try:
+        month = months[int(date.split('/')[0]) - 1]
+    except:
+        month = 'UnknownMonth'
+    year = date.split('/')[2]
+    return f'{month}-{year}-{file_type}.pdf'
+
+
+class PatientLocks:
+    """
+    Hands out one lock per patient, so that two sessions never check and upload into the same patient's documents at
+    the same time. Otherwise both could see that a file is missing and both upload it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, key) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class SessionPool:
+    """
+    Keeps logged-in sessions open between batches, so a long-running service only starts the browser and logs in once
+    for every session it runs at the same time
+    """
+
+    def __init__(self, open_session):
+        """
+        :param open_session: a function that opens a new logged-in session
+        """
+        self.open_session = open_session
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def acquire(self):
+        """
+        Take an idle session that is still logged in, or open a new one if none are. Idle sessions that crashed or were
+        logged out by the website are closed
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session = self._idle.pop()
+            if session.is_logged_in():
+                return session
+            try:
+                session.close()
+            except Exception as e:
+                print(f"Could not close a logged out session: {e!r}")
+        return self.open_session()
+
+    def release(self, session) -> None:
+        """
+        Give back a session for the next batch to use
+        """
+        with self._lock:
+            self._idle.append(session)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
+class DocumentCache:
+    """
+    Remembers the files in each patient's folder, so that checking whether a page was already uploaded does not need
+    a visit to their documents. A listing is read from the website on first use and again once it is older than ttl,
+    and files uploaded in between are added to it locally.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: seconds a listing is trusted for. Files uploaded by someone else show up once it expires
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._listings = {}  # Maps each patient to (the names of the files in their folder, when they were read)
+
+    def get(self, key) -> set or None:
+        """
+        Get the files in the patient's folder, or None if they have to be read from the website
+        """
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None or time.monotonic() - listing[1] > self.ttl:
+                return None
+            return set(listing[0])
+
+    def put(self, key, names: list) -> None:
+        with self._lock:
+            self._listings[key] = (set(names), time.monotonic())
+
+    def add(self, key, name: str) -> None:
+        """
+        Add a file that was uploaded into the patient's folder
+        """
+        with self._lock:
+            if key in self._listings:
+                self._listings[key][0].add(name)
+
+
+class BatchFiler:
+    """
+    Files the pages of one batch through one or more browser sessions
+    """
+
+    def __init__(self, file_type: str, batch_number: int, path_to_batch: str, journal, null_date: str,
+                 null_phone_number: str = None, matcher: str = 'scored', patient_index=None,
+                 documents_ttl: float = 300, error_ledger=None):
+        """
+        :param file_type: 'intake' or 'vf'
+        :param batch_number: the number of the batch
+        :param path_to_batch: the path to the batch pdf the pages are copied out of
+        :param journal: the BatchJournal the progress of every page is recorded in
+        :param null_date: the date that means the date could not be read
+        :param null_phone_number: the phone number that means the phone number could not be read
+        :param matcher: 'scored' searches by several fields at once and scores the results, 'cascade' searches by one
+        field after another
+        :param patient_index: the PatientIndex to look patients up in before searching the website, if any
+        :param documents_ttl: seconds the files in a patient's folder are remembered for
+        :param error_ledger: the ErrorLedger pages whose patient could not be found are recorded in as soon as they
+        happen, if any
+        """
+        self.file_type = file_type
+        self.batch_number = batch_number
+        self.path_to_batch = path_to_batch
+        self.journal = journal
+        self.null_date = null_date
+        self.placeholders = {'***', null_date, null_phone_number} - {None}
+        self.matcher = matcher
+        self.patient_index = patient_index
+        self.patient_locks = PatientLocks()
+        self.documents = DocumentCache(documents_ttl)
+        self.error_ledger = error_ledger
+        self.print_lock = threading.Lock()
+        self.error_patients = {}  # Maps the page index of every patient that could not be found to their error row
+
+    def file_page(self, session, page_index: int, patient: pd.Series) -> list or None:
+        """
+        Search for the patient of a page, and upload the page once they are found.
+        :param session: the session to use
+        :param page_index: the 0-indexed page of the batch
+        :param patient: the row of the page in the dataframe
+        :return: the patient's row of the search results if they were found and the page uploaded, None otherwise
+        """
+        patient_data = patient.tolist()
+        session.open_search()
+
+        # Look the patient up in the index first, and only search the website if they are not in it
+        match = self.find_indexed_patient(session, patient)
+        source = 'index'
+        if match is None:
+            source = 'search'
+            seen = self.patient_index.add_table if self.patient_index is not None else None
+            if self.matcher == 'scored':
+                match = scored_search(session, patient, self.file_type, self.placeholders, seen)
+            else:
+                match = cascade_search(session, patient, self.file_type, seen)
+            if match is not None:
+                session.open_patient(match[1])
+        if match is not None:
+            table, row_index, score = match
+            matched_row = [str(x) for x in table.iloc[row_index].tolist()]
+            self.journal.record(page_index, 'matched', patient=matched_row, score=score, source=source)
+            self.upload_form(session, patient[filename_date_columns[self.file_type]], page_index, matched_row)
+            return matched_row
+
+        # Add the patients location in their batch so that the user can easily locate their file. Also their information
+        error_patient = [str(self.batch_number), str(page_index + 1), patient_data[0], patient_data[1], patient_data[2]]
+        self.error_patients[page_index] = error_patient
+        self.journal.record(page_index, 'not_found', error_patient=error_patient)
+        if self.error_ledger is not None:
+            self.error_ledger.record(self.file_type, error_patient, self.path_to_batch)
+        return None
+
+    def file_page_for_open_patient(self, session, page_index: int, patient: pd.Series, matched_row: list) -> bool:
+        """
+        Upload a page into the documents of the patient that is already open, if the page matches them confidently,
+        so that a patient's pages are filed in one visit without searching for them again.
+        :param session: the session the patient is open in
+        :param page_index: the 0-indexed page of the batch
+        :param patient: the row of the page in the dataframe
+        :param matched_row: the open patient's row of the search results
+        :return: True if the page was uploaded, False if it has to be searched for
+        """
+        score = score_row(patient, pd.Series(matched_row), match_weights[self.file_type], self.placeholders)
+        if score is None or score < match_threshold:
+            return False
+        self.journal.record(page_index, 'matched', patient=matched_row, score=score, source='open patient')
+        self.upload_form(session, patient[filename_date_columns[self.file_type]], page_index, matched_row)
+        return True
+
+    def file_session_page(self, session, page_index: int, patient: pd.Series, matched_row: list or None) -> tuple:
+        """
+        File a page through a session, into the documents of the patient already open in it if the page matches them,
+        or else by finding its patient. Errors are printed and leave the page out of the journal, so that --resume
+        tries it again
+        :param session: the session to file the page with
+        :param page_index: the 0-indexed page of the batch
+        :param patient: the row of the page in the dataframe
+        :param matched_row: the row of the search results of the patient open in the session, or None
+        :return: (True if the page was uploaded, False if the patient was not found, or None if an error stopped it,
+        the row of the patient now open in the session or None)
+        """
+        patient_data = patient.tolist()
+        try:
+            if matched_row is not None and self.file_page_for_open_patient(session, page_index, patient, matched_row):
+                success = True
+            else:
+                matched_row = self.file_page(session, page_index, patient)
+                success = matched_row is not None
+        except Exception as e:
+            success = None
+            matched_row = None
+            with self.print_lock:
+                print(f"Patient {page_index + 1}: error while filing: {e!r}")
+
+        # Display the patient's information and whether the upload was successful
+        with self.print_lock:
+            print("Patient " + str(page_index + 1) + ": " + str(patient_data[0]) + " " + str(
+                patient_data[1]) + " " + str(patient_data[2]))
+            print("Patient Upload Successful: " + str(success) + "\n")
+        return success, matched_row
+
+    def find_indexed_patient(self, session, patient: pd.Series) -> tuple or None:
+        """
+        Find the patient of a page in the patient index and open them
+        :param session: the session to open the patient in
+        :param patient: the row of the page in the dataframe
+        :return: (table of candidates, index of the patient's row, its score), or None if the patient has to be searched
+        for
+        """
+        if self.patient_index is None:
+            return None
+        match = self.patient_index.find(patient, self.file_type, self.placeholders)
+        if match is None:
+            return None
+        table, row_index, score = match
+        patient_id = row_patient_id(table.iloc[row_index].tolist())
+        if patient_id is None:
+            return None
+        try:
+            session.open_patient_by_id(patient_id, table.iloc[row_index].tolist())
+        except LookupError:
+            # The website no longer has the patient under that id
+            self.patient_index.forget(patient_id)
+            return None
+        return match
+
+    def upload_form(self, session, date: str, page_index: int, matched_row: list) -> None:
+        """
+        Upload a page of the batch into the open patient's documents, unless it is already there.
+        :param session: the session the patient is open in
+        :param date: the document date (intake) or screening date (vf) used to name the file
+        :param page_index: the 0-indexed page of the batch to upload
+        :param matched_row: the open patient's row of the search results. Uploads into the documents of the patient
+        with its id are done one at a time
+        """
+        filename = document_filename(date, self.file_type, self.null_date)
+
+        # A patient without an id is locked by their name and date of birth, and their files are not remembered, since
+        # another patient's could be mistaken for them
+        patient_id = row_patient_id(matched_row)
+        lock_key = patient_id if patient_id is not None else (matched_row[2], matched_row[3])
+
+        # Hold the patient's lock from checking their documents until the upload shows up
+        with self.patient_locks(lock_key):
+            # Check if the file has already been uploaded by comparing it to the files in the patient's folder. They
+            # are only read from the website if they are not remembered from an earlier page
+            listing = self.documents.get(patient_id) if patient_id is not None else None
+            if listing is None:
+                session.open_documents(self.file_type)
+                listing = session.list_documents()
+                if patient_id is not None:
+                    self.documents.put(patient_id, listing)
+            already_uploaded = filename in listing
+            if not already_uploaded:
+                session.open_documents(self.file_type)
+                # Copy the page out of the batch pdf into a temporary folder of its own. The file has to keep its name,
+                # and another session may be uploading a file with the same name at the same time
+                form_folder = tempfile.mkdtemp()
+                form_path = os.path.join(form_folder, filename)
+                try:
+                    extract_page(self.path_to_batch, page_index, form_path)
+                    with timed('upload'):
+                        session.upload(form_path, filename)
+                finally:
+                    # Delete the temporary file to avoid cluttering the computer's storage and path errors
+                    shutil.rmtree(form_folder, ignore_errors=True)
+                if patient_id is not None:
+                    self.documents.add(patient_id, filename)
+
+        self.journal.record(page_index, 'uploaded', filename=filename, already_uploaded=already_uploaded)
+        if self.error_ledger is not None:
+            # The page may have been recorded as an error by an earlier run
+            self.error_ledger.resolve(self.file_type, self.batch_number, page_index + 1, 'uploaded')
+
+    def group_pages(self, df: pd.DataFrame, page_indexes: list) -> list:
+        """
+        Group the pages that look like they belong to the same patient, by the last name and date of birth read from
+        them. Pages either could not be read for are left in groups of their own
+        :param df: the dataframe that holds the info for each patient, indexed by page
+        :param page_indexes: the 0-indexed pages to group
+        :return: the groups of page indexes, in the order of their first page
+        """
+        groups = {}
+        for page_index in sorted(page_indexes):
+            groups.setdefault(self.patient_key(page_index, df.loc[page_index]), []).append(page_index)
+        return sorted(groups.values())
+
+    def patient_key(self, page_index: int, patient: pd.Series):
+        """
+        The key that the pages of the same patient share: their normalized last name and date of birth, or the page
+        index for a page either could not be read for
+        """
+        last_name, date_of_birth = str(patient['Last Name']), str(patient['Date of Birth'])
+        if last_name in self.placeholders or date_of_birth in self.placeholders:
+            return page_index
+        return normalize('Last Name', last_name), normalize('Date of Birth', date_of_birth)
+
+    def file_pages(self, df: pd.DataFrame, page_indexes: list, sessions: int, open_session,
+                   release_session=None) -> dict:
+        """
+        File the given pages. The pages of each patient are grouped, so that once a session has found and opened the
+        patient it uploads all of their pages in the same visit. Each session takes the next group from a shared queue
+        until the queue is empty.
+        :param df: the dataframe that holds the info for each patient, indexed by page
+        :param page_indexes: the 0-indexed pages to file
+        :param sessions: the number of sessions to file with at the same time
+        :param open_session: a function that opens a new logged-in session
+        :param release_session: a function that takes back a session once it is done, e.g. to keep it logged in for
+        the next batch. Sessions are closed if it is None
+        :return: maps each page index to True if it was uploaded, False if the patient was not found, or None if an
+        error stopped the page from being filed, including pages no session could log in to file
+        """
+        work = queue.Queue()
+        groups = self.group_pages(df, page_indexes)
+        for group in groups:
+            work.put(group)
+        results = {}
+
+        def worker() -> None:
+            try:
+                session = open_session()
+            except Exception as e:
+                # The other sessions take this session's share of the queue
+                with self.print_lock:
+                    print(f"{threading.current_thread().name}: could not log in: {e!r}")
+                return
+            try:
+                while True:
+                    try:
+                        group = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    matched_row = None  # The patient that is open in the session
+                    for page_index in group:
+                        results[page_index], matched_row = self.file_session_page(session, page_index,
+                                                                                  df.loc[page_index], matched_row)
+            finally:
+                if release_session is None:
+                    session.close()
+                else:
+                    release_session(session)
+
+        threads = [threading.Thread(target=worker, name=f'session-{n + 1}')
+                   for n in range(min(sessions, len(groups)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every session that could log in has emptied the queue, so pages left out were never filed because no session
+        # could log in. Leave them out of the journal so that --resume tries them again
+        unfiled = [page_index for page_index in page_indexes if page_index not in results]
+        if unfiled:
+            print(f"{len(unfiled)} pages were not filed because no session could log in: "
+                  f"{', '.join(str(page_index + 1) for page_index in sorted(unfiled))}")
+            results.update(dict.fromkeys(unfiled))
+        return results
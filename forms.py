@@ -0,0 +1,164 @@
+# The form types the script can read. Each form template declares the regions of the page its information is in, the
+# resolution they are rendered at, and the fields it extracts from their text with precompiled patterns. A new form
+# type is added by registering another FormTemplate.
+import re
+from typing import NamedTuple
+
+
+class PatientRecord(NamedTuple):
+    """
+    The information extracted from one page, in the columns of the dataframe
+    """
+    first_name: str
+    last_name: str
+    date_of_birth: str
+    sex: str
+    preferred_phone: str
+    address: str
+    provider: str
+    document_date: str
+    screening_date: str
+
+
+# The dataframe column of every PatientRecord field, in the same order
+record_columns = ['First Name', 'Last Name', 'Date of Birth', 'Sex', 'Preferred Phone', 'Address', 'Provider',
+                  'Document Date', 'Screening Date']
+column_index = {column: i for i, column in enumerate(record_columns)}
+
+
+class Field:
+    """
+    A value found in the text of one region of the page
+    """
+
+    def __init__(self, columns: tuple, pattern: str, kind: str = 'text', region: str = 'info', normalize=None,
+                 label: str = '', whitelist: str = ''):
+        """
+        :param columns: the columns the value fills. A normalizer that splits the value fills more than one
+        :param pattern: the regex whose first group is the value. The last match on the page is used
+        :param kind: 'date', 'phone' or 'text'. Decides the value when nothing matches
+        :param region: the region of the page the value is in
+        :param normalize: fixes up the matched value. Returns a tuple with a value for each column
+        :param label: the text printed before the value, as the pattern expects it, so adaptive extraction can find the
+        value on the page. Without one, the value is the whole region
+        :param whitelist: the only characters the value can hold, used when adaptive extraction reads the value again
+        """
+        self.columns = columns
+        self.pattern = re.compile(pattern)
+        self.kind = kind
+        self.region = region
+        self.normalize = normalize
+        self.label = label
+        self.whitelist = whitelist
+
+
+def fix_sex(value: str) -> tuple:
+    # Sometimes the l is misread as an i or t
+    return value.replace('i', 'l').replace('t', 'l'),
+
+
+def split_full_name(value: str) -> tuple:
+    # The name is written as 'Last, First'
+    last_name, first_name = value.split(',', 1)
+    return first_name.strip(), last_name.strip()
+
+
+class FormTemplate:
+    """
+    Turns the text of the regions of a page into a PatientRecord
+    """
+
+    def __init__(self, name: str, regions: dict, dpi: int, fields: list):
+        """
+        :param name: the form type, e.g. 'intake'
+        :param regions: maps the name of each region to its (left, top, right, bottom) fractions of the page
+        :param dpi: the resolution the regions are rendered at. Run dpi_harness.py on sample pages before lowering it
+        :param fields: the Fields the form holds. Columns no field fills are left as '***', or the null date
+        """
+        self.name = name
+        self.regions = regions
+        self.dpi = dpi
+        self.fields = fields
+        # Look up where each field's values go once, instead of on every page
+        self.slots = [(field, [column_index[column] for column in field.columns]) for field in fields]
+        # Maps each region to the fields read from it, for adaptive extraction
+        self.region_fields = {name: [field for field in fields if field.region == name] for name in regions}
+
+    def extract(self, regions_text: dict, null_date: str, null_phone_number: str) -> PatientRecord:
+        """
+        Extract the information from the text of a page's regions
+        :param regions_text: maps the name of each region to the text OCR read from it
+        :param null_date: the date used when a date is not found or cannot be right
+        :param null_phone_number: the phone number used when the phone number is not found
+        :return: the record of the page
+        """
+        values = ['***'] * len(record_columns)
+        values[column_index['Document Date']] = values[column_index['Screening Date']] = null_date
+
+        for field, slots in self.slots:
+            matches = field.pattern.findall(regions_text.get(field.region, ''))
+            if matches:
+                value = matches[-1]
+                if field.kind == 'date':
+                    # Visual fields write dates with dashes instead of slashes. Dates that cannot be right are
+                    # replaced for the whole batch at once by validation.validate_records
+                    value = value.replace('-', '/')
+                found = field.normalize(value) if field.normalize else (value,)
+            elif field.kind == 'date':
+                found = (null_date,) * len(slots)
+            elif field.kind == 'phone':
+                found = (null_phone_number,) * len(slots)
+            else:
+                found = ('***',) * len(slots)
+            for slot, value in zip(slots, found):
+                values[slot] = value
+        return PatientRecord._make(values)
+
+
+# The characters dates and phone numbers are written with, which adaptive extraction limits their values to
+date_characters = '0123456789/'
+dash_date_characters = '0123456789-'
+phone_characters = '0123456789()-'  # Spaces split words, so they are never read
+
+# Maps each form type to its template
+form_templates = {}
+
+
+def register(template: FormTemplate) -> FormTemplate:
+    form_templates[template.name] = template
+    return template
+
+
+register(FormTemplate(
+    'intake',
+    regions={
+        'info': (0, 0, 1, 1 / 3),  # The top 33% of the page holds the patient information
+        'document_date': (0, 9 / 10, 1, 1),  # The bottom 10% of the page holds the document date
+    },
+    dpi=200,
+    fields=[
+        Field(('First Name',), r'First:\s([A-Za-z]+)', label='First:'),
+        Field(('Last Name',), r'Last:\s([A-Za-z]+)', label='Last:'),
+        Field(('Date of Birth',), r'DOB:\s(\d{2}/\d{2}/\d{4})', 'date', label='DOB:', whitelist=date_characters),
+        Field(('Sex',), r'Sex:\s([A-Za-z]+)', normalize=fix_sex, label='Sex:'),
+        Field(('Preferred Phone',), r'Preferred:\sCell:\s(\(\d{3}\)\s\d{3}-\d{4})', 'phone', label='Preferred: Cell:',
+              whitelist=phone_characters),
+        Field(('Address',), r'Address:\s(.+?)\n', label='Address:'),
+        Field(('Provider',), r'Provider:\s(.+?)\n', label='Provider:'),
+        Field(('Document Date',), r'(\d{2}/\d{2}/\d{4})', 'date', region='document_date', whitelist=date_characters),
+    ],
+))
+
+register(FormTemplate(
+    'vf',
+    regions={
+        'info': (0, 0, 1, 1 / 7),  # The information is all in the top 1/7 of the page
+    },
+    dpi=200,
+    fields=[
+        Field(('First Name', 'Last Name'), r'NAME:\s+(\w+\s*,\s*\w+)\s+', normalize=split_full_name, label='NAME:'),
+        Field(('Date of Birth',), r'DOB:\s*(\d{2}-\d{2}-\d{4})', 'date', label='DOB:', whitelist=dash_date_characters),
+        Field(('Screening Date',), r'Screening DATE:\s*(\d{2}-\d{2}-\d{4})', 'date', label='Screening DATE:',
+              whitelist=dash_date_characters),
+    ],
+))
@@ -0,0 +1,214 @@
+# Compares the speed of building a batch's dataframe with the form templates in forms.py and validation.py to the
+# function and row by row loop main.py used before them, and checks which fields the two extract differently.
+# The corpus is the OCR text the journal recorded for real batches, or pages of OCR-style text made from the patients
+# in a csv when there is no journal.
+#
+# Usage: python forms_benchmark.py --journal journal --type intake
+#        python forms_benchmark.py --patients data.csv --type vf --pages 5000
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import time
+
+import pandas as pd
+
+from forms import form_templates, record_columns
+from validation import assemble_records
+
+default_null_date = '10/10/1903'
+default_null_phone_number = '(102) 301-2309'
+
+
+def extract_document_date(text: str) -> str:
+    """
+    Extract the document date from the text at the bottom of a page of a pdf
+    """
+    regex = r"(\d{2}/\d{2}/\d{4})"
+    matches = re.findall(regex, text)
+    if matches:
+        return matches[-1]
+    else:
+        return default_null_date
+
+
+def extract_information_from_text(text: str, file_type: str) -> list:
+    """
+    Extract the relevant information from the text of a page, the way main.py did before form templates
+    """
+    # Intake forms and VF forms have different information to extract
+    data_regexes = {}
+    if file_type == 'intake':
+        data_regexes = {
+            'First name': r'First:\s([A-Za-z]+)',
+            'Last name': r'Last:\s([A-Za-z]+)',
+            'DOB': r'DOB:\s(\d{2}/\d{2}/\d{4})',
+            'Sex': r'Sex:\s([A-Za-z]+)',
+            'Preferred Phone': r'Preferred:\sCell:\s(\(\d{3}\)\s\d{3}-\d{4})',
+            'Address': r'Address:\s(.+?)\n',
+            'Provider': r'Provider:\s(.+?)\n',
+        }
+    elif file_type == 'vf':
+        data_regexes = {
+            'Full Name': r"NAME:\s+(\w+\s*,\s*\w+)\s+",
+            'DOB': r"DOB:\s*(\d{2}-\d{2}-\d{4})",
+            'Screening Date': r"Screening DATE:\s*(\d{2}-\d{2}-\d{4})"
+        }
+
+    info = []
+
+    for key, regex in data_regexes.items():
+        matches = re.findall(regex, text)
+        if matches:
+            if key == 'Sex':
+                info.append(
+                    str(matches[-1]).replace('i', 'l').replace('t', 'l'))  # Sometimes the l is misread as an i or t
+            elif key == 'DOB' or key == 'Screening Date':
+                year = str(matches[-1])[-4:]
+                if int(year) < 1900:
+                    info.append(default_null_date)
+                else:
+                    info.append(str(matches[-1]).replace('-',
+                                                         '/'))  # The date is formatted with dashes instead of slashes in the visual fields
+            else:
+                info.append(str(matches[-1]))
+        else:
+            if key == 'DOB' or key == 'Screening Date':
+                info.append(default_null_date)  # Set the date to default null date if it is not found
+            elif key == 'Preferred Phone':
+                info.append(
+                    default_null_phone_number)  # Set the phone number to default null phone number if it is not found
+            else:
+                info.append('***')  # Set the other fields to *** if they are not found
+
+    if file_type == 'intake':
+        # Set Document Date to default null date if it is the same as the DOB
+        if info[-1] == info[1]:
+            info[-1] = default_null_date
+    elif file_type == 'vf':
+        if info[0] != '***':
+            # Split the name into first and last name
+            first_name = info[0].split(',')[1].strip()
+            last_name = info[0].split(',')[0].strip()
+            info[0] = first_name
+            info.insert(1, last_name)
+        else:
+            info.insert(1, '***')
+
+    return info
+
+
+def legacy_record(regions_text: dict, file_type: str) -> list:
+    """
+    Extract the row of a page the way main.py did before form templates
+    """
+    data = extract_information_from_text(regions_text['info'], file_type)
+    if file_type == 'intake':
+        # Initialize the screening date and document date to the default null date
+        data.append(default_null_date)
+        data.append(default_null_date)
+    elif file_type == 'vf':
+        # Set all the intake form variables to ***
+        for j in range(3, 8):
+            data.insert(j, '***')
+    # Set the document dates to the dates extracted from the bottom of the pages
+    data[7] = extract_document_date(regions_text['document_date']) if file_type == 'intake' else default_null_date
+    return data
+
+
+def journal_corpus(path: str, file_type: str) -> list:
+    """
+    The OCR text of every page of the form type the journal recorded
+    :param path: the journal folder, or the journal of one batch
+    """
+    paths = sorted(glob.glob(os.path.join(path, f'{file_type}-*.jsonl'))) if os.path.isdir(path) else [path]
+    corpus = []
+    for journal_path in paths:
+        with open(journal_path) as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry.get('event') == 'ocr' and entry.get('file_type') == file_type:
+                    corpus.append(entry['regions'])
+    return corpus
+
+
+def synthetic_corpus(patients_csv: str, file_type: str, count: int, rng: random.Random) -> list:
+    """
+    Make pages of text laid out the way tesseract reads each form type, with some lines missing or misread
+    """
+    patients = pd.read_csv(patients_csv, dtype=str, keep_default_na=False)
+    corpus = []
+    for _ in range(count):
+        p = patients.iloc[rng.randrange(len(patients))]
+        if file_type == 'intake':
+            lines = [f"First: {p['First Name']} Last: {p['Last Name']} DOB: {p['Date of Birth']}",
+                     f"Sex: {p['Sex'].replace('l', rng.choice('lit'))}",
+                     f"Preferred: Cell: {p['Preferred Phone']}",
+                     f"Address: {p['Address']}",
+                     f"Provider: {p['Provider']}"]
+            regions = {'document_date': f"Signed {p['Document Date']}\n"}
+        else:
+            dob = p['Date of Birth'].replace('/', '-')
+            lines = [f"NAME: {p['Last Name']}, {p['First Name']} DOB: {dob}",
+                     f"Screening DATE: {dob[:6]}20{rng.randrange(10, 25)}"]
+            regions = {}
+        # Tesseract drops or garbles a line now and then
+        lines = [line for line in lines if rng.random() > 0.05]
+        regions['info'] = 'Patient Information\n' + '\n'.join(lines) + '\n'
+        corpus.append(regions)
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the form templates against the old extraction function')
+    parser.add_argument('--type', choices=list(form_templates), default='intake')
+    parser.add_argument('--journal', help='journal folder whose recorded OCR text is the corpus')
+    parser.add_argument('--patients', default='data.csv', help='csv of patients to make a corpus from without a journal')
+    parser.add_argument('--pages', type=int, default=5000, help='number of pages to make without a journal')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times to time each extractor')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.journal:
+        corpus = journal_corpus(args.journal, args.type)
+    else:
+        corpus = synthetic_corpus(args.patients, args.type, args.pages, random.Random(args.seed))
+    template = form_templates[args.type]
+
+    def legacy_batch() -> list:
+        # main.py added the rows to the dataframe one at a time
+        df = pd.DataFrame(columns=record_columns)
+        for i, regions in enumerate(corpus):
+            df.loc[i] = legacy_record(regions, args.type)
+        return df.values.tolist()
+
+    def template_batch() -> list:
+        records = [template.extract(regions, default_null_date, default_null_phone_number) for regions in corpus]
+        return assemble_records(records, default_null_date, default_null_phone_number)[0].values.tolist()
+
+    def time_batch(extract) -> tuple:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            rows = extract()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        return rows, best
+
+    legacy_rows, legacy_seconds = time_batch(legacy_batch)
+    template_rows, template_seconds = time_batch(template_batch)
+
+    print(f"{len(corpus)} {args.type} pages")
+    print(f"{'extractor':<10}{'us/page':>10}")
+    print(f"{'legacy':<10}{legacy_seconds / len(corpus) * 1e6:>10.1f}")
+    print(f"{'template':<10}{template_seconds / len(corpus) * 1e6:>10.1f}")
+
+    # Fields the two extract differently. The old function compared the provider to the last name where it meant to
+    # compare the document date to the date of birth, and did not check that dates are real dates or phone numbers
+    # have 10 digits, so those columns can differ
+    print(f"\n{'column':<16}{'different':>10}")
+    for i, column in enumerate(record_columns):
+        different = sum(a[i] != b[i] for a, b in zip(legacy_rows, template_rows))
+        print(f"{column:<16}{different:>10}")
@@ -0,0 +1,126 @@
+# Append-only journal of what happened to every page of a batch, so that a crashed run can pick up where it stopped.
+# Every batch has its own file in the journal folder, so opening a batch's journal only reads that batch's lines.
+import json
+import os
+import threading
+import time
+
+# Events that mean a page needs no more work
+completed_events = ('uploaded', 'not_found', 'skipped')
+
+# One lock per journal file, so that the upload sessions of a batch recording from different threads at the same time
+# never interleave their lines
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def batch_journal_path(folder: str, file_type: str, batch_number: int) -> str:
+    """
+    The path to the journal of one batch, e.g. journal/intake-12.jsonl
+    """
+    return os.path.join(folder, f'{file_type}-{batch_number}.jsonl')
+
+
+def split_shared_journal(path: str, folder: str) -> int:
+    """
+    Move the lines of a journal shared by every batch, as it was kept before each batch had its own file, into the
+    batch files. The shared journal is renamed to path + '.split' so it is only read once
+    :return: the number of batches split out
+    """
+    batches = {}
+    with open(path) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # The last line is cut short if the script crashed while writing it
+            batches.setdefault((entry['file_type'], entry['batch']), []).append(line)
+    os.makedirs(folder, exist_ok=True)
+    for (file_type, batch_number), lines in batches.items():
+        with open(batch_journal_path(folder, file_type, batch_number), 'a') as file:
+            file.writelines(lines)
+    os.replace(path, path + '.split')
+    return len(batches)
+
+
+class BatchJournal:
+    """
+    Records the progress of one batch as JSON lines appended to the batch's file in the journal folder. Each line is
+    keyed by form type, batch number and page index and holds one event:
+        ocr: the text of the page's regions
+        matched: the row of the search results the patient was matched to
+        uploaded: the file the page was saved as, and whether it was already in the patient's documents
+        not_found: the row written to the error csv because the patient could not be found
+        skipped: why the page was not read, because it was blank or a duplicate of another page
+    Lines are only ever appended, so a crash can at worst lose the line being written.
+    """
+
+    def __init__(self, folder: str, file_type: str, batch_number: int):
+        """
+        :param folder: the journal folder. It and the batch's file are created if they do not exist. A journal shared by
+        every batch at folder + '.jsonl' is split into the folder first
+        :param file_type: 'intake' or 'vf'
+        :param batch_number: the number of the batch
+        """
+        self.folder = folder
+        self.path = batch_journal_path(folder, file_type, batch_number)
+        self.file_type = file_type
+        self.batch_number = batch_number
+        self.pages = {}  # Maps a page index to the latest fields recorded for each of its events
+        with _file_locks_lock:
+            shared_path = folder.rstrip('/\\') + '.jsonl'
+            if os.path.exists(shared_path):
+                print(f"Split the journal of {split_shared_journal(shared_path, folder)} batches out of {shared_path}")
+            os.makedirs(folder, exist_ok=True)
+            # Upload sessions record from their own threads
+            self.lock = _file_locks.setdefault(os.path.abspath(self.path), threading.Lock())
+
+        # Replay the journal to rebuild the state of this batch's pages
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # The last line is cut short if the script crashed while writing it
+                    if entry['file_type'] == file_type and entry['batch'] == batch_number:
+                        self.pages.setdefault(entry['page'], {})[entry['event']] = entry
+
+    def record(self, page_index: int, event: str, **fields) -> None:
+        """
+        Append an event for a page and flush it to disk straight away.
+        :param page_index: the 0-indexed page of the batch
+        :param event: 'ocr', 'matched', 'uploaded', 'not_found' or 'skipped'
+        :param fields: the information to record with the event. Must be serializable to JSON
+        """
+        entry = {'time': time.time(), 'file_type': self.file_type, 'batch': self.batch_number, 'page': page_index,
+                 'event': event, **fields}
+        with self.lock:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.pages.setdefault(page_index, {})[event] = entry
+
+    def get(self, page_index: int, event: str) -> dict or None:
+        """
+        Get the latest entry recorded for a page's event, or None if it was never recorded
+        """
+        return self.pages.get(page_index, {}).get(event)
+
+    def status(self, page_index: int) -> str or None:
+        """
+        Get the latest of the page's 'uploaded', 'not_found' and 'skipped' events, or None if the page was never
+        completed
+        """
+        entries = [self.get(page_index, event) for event in completed_events]
+        entries = [entry for entry in entries if entry is not None]
+        if not entries:
+            return None
+        return max(entries, key=lambda entry: entry['time'])['event']
+
+    def is_completed(self, page_index: int) -> bool:
+        """
+        Check if the page was uploaded, its patient was recorded as not found, or it was skipped
+        """
+        return self.status(page_index) is not None
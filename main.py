@@ -1,17 +1,22 @@
 # Import the necessary modules
+import argparse
 import pandas as pd
-import pytesseract
-import re
-import time
 import os
-from csv import writer, reader
-import tempfile
-from pdf2image import convert_from_path
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.remote.webelement import WebElement
+import threading
+from ocr import create_ocr_pool, ocr_pages, ocr_page_regions
+from ocr_cache import OCRCache
+from forms import form_templates
+from validation import assemble_records
+from journal import BatchJournal
+from rasterize import count_pages, iter_page_chunks, page_sizes
+from timings import timed, take_samples, print_timing_report, write_timing_log
+from browser import BrowserSession
+from api_session import ApiSession, session_cookie
+from filing import BatchFiler
+from error_ledger import ErrorLedger
+from patient_index import PatientIndex
+from pipeline import run_batch
+from prefilter import PageFilter, PageHashes
 
 # Define variables
 file_type = 'intake'  # 'intake' or 'vf'
@@ -19,493 +24,375 @@ batch_number = 1
 path_to_batch = r"C:\Users\shtey\Downloads\Batch-{bn}.pdf".format(bn=batch_number)
 default_null_date = '10/10/1903'
 default_null_phone_number = '(102) 301-2309'
+url = "https://revolutionehr.com/static/#/"
+username = 'INSERT USERNAME HERE'
+password = 'INSERT PASSWORD HERE'
+upload_workers = 1  # Number of browser sessions that upload at the same time. More than 1 runs them headless
+ocr_workers = os.cpu_count()  # Number of processes used for OCR. 1 runs OCR one page at a time in this process
+render_mode = 'regions'  # 'regions' renders only the regions of the form's template in forms.py, in grayscale. 'pages' renders whole pages and crops them
+render_chunk_size = 16  # Number of pages rendered into memory at once in 'pages' mode. Keeps memory flat no matter the batch size
+ocr_cache_path = 'ocr_cache.db'  # Text already extracted from a region is read from here instead of running tesseract again
+ocr_cache_max_bytes = 100 * 1024 * 1024  # Least recently used regions are evicted once the cache grows past this
+journal_path = 'journal'  # Folder with a file per batch that records the OCR results, matched patient and upload status of every page
+error_ledger_path = 'errors.db'  # Records the pages whose patient could not be found, and appends them to error_{type}.csv
+timings_path = 'timings.jsonl'  # The p50, p95 and max latency of every stage of each batch are appended here
+wait_timeout = 10  # Seconds to wait for an element or a search before giving up
+network_idle_timeout = 3  # Seconds to wait for the website to stop sending requests before carrying on anyway
+upload_timeout = 60  # Seconds to wait for an uploaded file to show up in the patient's documents
+patient_matcher = 'scored'  # 'scored' searches by several fields at once and scores the results. 'cascade' searches one field at a time
+patient_index_path = 'patients.db'  # Patients seen in search results are kept here and looked up before searching the website
+documents_cache_ttl = 300  # Seconds the files in a patient's folder are remembered for instead of being read again
+upload_backend = 'selenium'  # 'selenium' drives the website through Chrome. 'http' is experimental, see api_session.py
+run_mode = 'pipeline'  # 'pipeline' uploads the first pages while the rest are read. 'phases' reads every page before logging in
+prefilter_pages = True  # Skip blank pages and pages scanned twice before they are read, see prefilter.py
+page_hashes_path = 'page_hashes.db'  # The hashes of the pages of earlier batches, to recognize pages scanned again
+adaptive_extraction = True  # Read again, on their own, the fields that are missing or were read with low confidence, see adaptive_ocr.py
 
 # Define pandas options
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
-# Get the pages of the pdf
-pages = convert_from_path(path_to_batch)
-num_pages = len(pages)
-print(f"Number of pages in the batch: {num_pages}")
-
-# Define empty lists to hold the information
-pages_text = [None for i in range(num_pages)]
-document_dates = [default_null_date for i in range(num_pages)]
 
-
-def extract_text(page) -> str:
+def open_session(site_url: str, headless: bool) -> BrowserSession:
     """
-    Extract the text from a page of a pdf
+    Open Chrome and log in to the website
+    :param site_url: the address of the website
+    :param headless: run Chrome without a window
+    :return: the logged-in session
     """
-    return pytesseract.image_to_string(page, lang='eng', config='--psm 6')
+    session = BrowserSession(site_url, headless=headless, wait_timeout=wait_timeout,
+                             network_idle_timeout=network_idle_timeout, upload_timeout=upload_timeout)
+    session.login(username, password)
+    return session
 
 
-def extract_document_date(page) -> str:
+class ApiLogin:
     """
-    Extract the document date from the bottom of a page of a pdf
+    Opens ApiSessions that share one browser login. Chrome is only opened for the first session, and closed again once
+    its cookies have been copied. It is opened again to log in again once the api stops accepting the cookies.
     """
-    text = extract_text(page)
-    regex = r"(\d{2}/\d{2}/\d{4})"
-    matches = re.findall(regex, text)
-    if matches:
-        return matches[-1]
-    else:
-        return default_null_date
 
-
-def extract_information_from_text(text: str) -> list:
+    def __init__(self, site_url: str):
+        self.site_url = site_url
+        self.lock = threading.Lock()
+        self.cookies = None
+        self.user_agent = None
+
+    def __call__(self) -> ApiSession:
+        with self.lock:
+            if self.cookies is not None:
+                session = ApiSession(self.site_url, self.cookies, self.user_agent)
+                if session.is_logged_in():
+                    return session
+                session.close()
+                print("The api no longer accepts the login, logging in again")
+                self.cookies = None
+            if self.cookies is None:
+                # open_session waits until the website shows it is logged in, so the session cookie has been set
+                browser_session = open_session(self.site_url, headless=True)
+                try:
+                    cookies = browser_session.driver.get_cookies()
+                    self.user_agent = browser_session.driver.execute_script('return navigator.userAgent')
+                finally:
+                    browser_session.close()
+                if not any(cookie['name'] == session_cookie for cookie in cookies):
+                    raise RuntimeError(f"Logging in did not set the '{session_cookie}' cookie the api needs. Check "
+                                       f"session_cookie in api_session.py")
+                self.cookies = cookies
+        return ApiSession(self.site_url, self.cookies, self.user_agent)
+
+
+def read_batch(batch_path: str, form_type: str, journal: BatchJournal, resume: bool = False, ocr_pool=None,
+               use_cache: bool = True, page_filter: PageFilter = None) -> pd.DataFrame:
     """
-    Extract the relevant information from the text of a page
+    Read the information of every page of a batch
+    :param batch_path: the path to the batch pdf
+    :param form_type: 'intake' or 'vf'
+    :param journal: the journal of the batch. The text of every page is recorded in it
+    :param resume: reuse the text the journal has if every page was read before
+    :param ocr_pool: the pool of OCR processes to use. If None, one is started for this batch and shut down after
+    :param use_cache: read the text of regions that were read before from the OCR cache
+    :param page_filter: the PageFilter that skips blank and duplicate pages before they are read, or None to read every
+    page
+    :return: the dataframe that holds the info for each patient, indexed by page. Skipped pages are left out
     """
-    # Intake forms and VF forms have different information to extract
-    data_regexes = {}
-    if file_type == 'intake':
-        data_regexes = {
-            'First name': r'First:\s([A-Za-z]+)',
-            'Last name': r'Last:\s([A-Za-z]+)',
-            'DOB': r'DOB:\s(\d{2}/\d{2}/\d{4})',
-            'Sex': r'Sex:\s([A-Za-z]+)',
-            'Preferred Phone': r'Preferred:\sCell:\s(\(\d{3}\)\s\d{3}-\d{4})',
-            'Address': r'Address:\s(.+?)\n',
-            'Provider': r'Provider:\s(.+?)\n',
-        }
-    elif file_type == 'vf':
-        data_regexes = {
-            'Full Name': r"NAME:\s+(\w+\s*,\s*\w+)\s+",
-            'DOB': r"DOB:\s*(\d{2}-\d{2}-\d{4})",
-            'Screening Date': r"Screening DATE:\s*(\d{2}-\d{2}-\d{4})"
-        }
-
-    info = []
-
-    for key, regex in data_regexes.items():
-        matches = re.findall(regex, text)
-        if matches:
-            if key == 'Sex':
-                info.append(
-                    str(matches[-1]).replace('i', 'l').replace('t', 'l'))  # Sometimes the l is misread as an i or t
-            elif key == 'DOB' or key == 'Screening Date':
-                year = str(matches[-1])[-4:]
-                if int(year) < 1900:
-                    info.append(default_null_date)
-                else:
-                    info.append(str(matches[-1]).replace('-',
-                                                         '/'))  # The date is formatted with dashes instead of slashes in the visual fields
-            else:
-                info.append(str(matches[-1]))
-        else:
-            if key == 'DOB' or key == 'Screening Date':
-                info.append(default_null_date)  # Set the date to default null date if it is not found
-            elif key == 'Preferred Phone':
-                info.append(
-                    default_null_phone_number)  # Set the phone number to default null phone number if it is not found
+    # Count the pages of the pdf without rendering it
+    num_pages = count_pages(batch_path)
+    print(f"Number of pages in the batch: {num_pages}")
+
+    # Extract the text from the regions of every page. The OCR is spread across a pool of processes
+    template = form_templates[form_type]
+    pages_regions = {}
+    skipped = {i for i in range(num_pages) if journal.status(i) == 'skipped'}
+    if resume and all(i in skipped or journal.get(i, 'ocr') is not None for i in range(num_pages)):
+        # Every page was read or skipped before the last run stopped
+        pages_regions = {i: journal.get(i, 'ocr')['regions'] for i in range(num_pages) if i not in skipped}
+    else:
+        own_pool = ocr_pool is None
+        if own_pool:
+            ocr_pool = create_ocr_pool(ocr_workers, ocr_cache_path if use_cache else None, ocr_cache_max_bytes)
+        try:
+            # Skip the blank pages, and find the ones that look like duplicates, before reading any page
+            sizes = page_sizes(batch_path, num_pages)
+            page_indexes = list(range(num_pages))
+            if page_filter is not None:
+                page_indexes = page_filter.filter_pages(batch_path, sizes, page_indexes, ocr_pool)
+
+            fields = template.region_fields if adaptive_extraction else None
+            if render_mode == 'regions':
+                # Only the regions are rasterized, and each worker renders the regions it reads
+                pages_regions = dict(zip(page_indexes, ocr_page_regions(batch_path, sizes, template.regions,
+                                                                        template.dpi, ocr_pool, page_indexes, fields)))
             else:
-                info.append('***')  # Set the other fields to *** if they are not found
-
-    if file_type == 'intake':
-        # Set Document Date to default null date if it is the same as the DOB
-        if info[-1] == info[1]:
-            info[-1] = default_null_date
-    elif file_type == 'vf':
-        if info[0] != '***':
-            # Split the name into first and last name
-            first_name = info[0].split(',')[1].strip()
-            last_name = info[0].split(',')[0].strip()
-            info[0] = first_name
-            info.insert(1, last_name)
+                # Render a chunk of pages at a time and drop the images once they are read
+                kept = set(page_indexes)
+                for first_index, pages in iter_page_chunks(batch_path, render_chunk_size, num_pages,
+                                                           dpi=template.dpi):
+                    chunk_indexes = [first_index + i for i in range(len(pages)) if first_index + i in kept]
+                    pages_regions.update(zip(chunk_indexes, ocr_pages([pages[i - first_index] for i in chunk_indexes],
+                                                                      template.regions, ocr_pool, fields)))
+                    del pages
+        finally:
+            if own_pool and ocr_pool is not None:
+                ocr_pool.shutdown()
+
+        # Record the text of every page so a resumed run does not have to read the batch again
+        for i, regions in pages_regions.items():
+            if journal.get(i, 'ocr') is None or journal.get(i, 'ocr')['regions'] != regions:
+                journal.record(i, 'ocr', regions=regions)
+
+        # Skip the pages that looked like duplicates only if their text is the same as the page they look like
+        if page_filter is not None:
+            for i in sorted(page_filter.suspects):
+                if page_filter.confirm(i, pages_regions[i]):
+                    del pages_regions[i]
+            page_filter.report(f'skipped_{form_type}.csv')
+
+    # Extract the information for each patient from the text of their page, and put it in a dataframe. The values that
+    # cannot be right are replaced for the whole batch at once
+    page_indexes = sorted(pages_regions)
+    records = []
+    for i in page_indexes:
+        with timed('extract'):
+            records.append(template.extract(pages_regions[i], default_null_date, default_null_phone_number))
+    df, fixes = assemble_records(records, default_null_date, default_null_phone_number)
+    df.index = page_indexes
+    if any(fixes.values()):
+        print("Replaced values that cannot be right: " + ", ".join(
+            f"{column} {count}" for column, count in fixes.items() if count))
+    return df
+
+
+def pending_batch_pages(journal: BatchJournal, page_indexes, resume: bool) -> tuple:
+    """
+    Find the pages of a batch that are left to file
+    :param journal: the journal of the batch
+    :param page_indexes: the 0-indexed pages of the batch that were not skipped
+    :param resume: skip the pages the journal has as completed
+    :return: the set of pages left to file, and the error rows of the skipped pages whose patient was not found
+    """
+    # Create a list to store patient's that could not be found/uploaded
+    error_patients = []
+
+    # Pages the journal has as completed are skipped when resuming. Patients it has as not found go back into the
+    # error list, since the last run may have stopped before writing them to the error csv
+    pending_pages = set()
+    for index in page_indexes:
+        if resume and journal.is_completed(index):
+            if journal.status(index) == 'not_found':
+                error_patients.append(journal.get(index, 'not_found')['error_patient'])
         else:
-            info.insert(1, '***')
-
-    return info
-
-
-if file_type == 'intake':
-    pages_bottom = [None for i in range(len(pages))]  # The bottom of the page holds the document date
-    pages_cropped = [None for i in range(len(pages))]  # The top of the page holds the patient information
-
-    for i in range(num_pages):
-        h = pages[i].height
-        w = pages[i].width
-        # Crop function works as follows: crop((left, top, right, bottom))
-        pages_bottom[i] = pages[i].crop((0, h - (h / 10), w, h))  # Bottom 10% of the page
-        pages_cropped[i] = pages[i].crop((0, 0, w, h / 3))  # Top 33% of the page
-
-    pages_text = [extract_text(page) for page in pages_cropped]  # Extract the text from the top of the page
-    document_dates = [extract_document_date(page) for page in
-                      pages_bottom]  # Extract the document date from the bottom of the page
-
-elif file_type == 'vf':
-    pages_cropped = [None for i in range(len(pages))]  # The information is all in the top 1/7 of the page
-    for i in range(num_pages):
-        h = pages[i].height
-        w = pages[i].width
-        pages_cropped[i] = pages[i].crop((0, 0, w, h / 7))
-
-    pages_text = [extract_text(page) for page in pages_cropped]
-
-# Create a dataframe that will hold the info for each patient
-df = pd.DataFrame(
-    columns=['First Name', 'Last Name', 'Date of Birth', 'Sex', 'Preferred Phone', 'Address', 'Provider',
-             'Document Date', 'Screening Date'])
-
-for i in range(num_pages):
-    # Extract the information from the text of the page
-    data = extract_information_from_text(pages_text[i])
-    if file_type == 'intake':
-        # Initialize the screening date and document date to the default null date
-        data.append(default_null_date)
-        data.append(default_null_date)
-    elif file_type == 'vf':
-        # Set all the intake form variables to ***
-        for j in range(3, 8):
-            data.insert(j, '***')
-    # Add the formatted data list to the dataframe
-    df.loc[i] = data
-
-# Set the document dates to the dates extracted from the bottom of the pages
-df['Document Date'] = document_dates
-
-# Save the dataframe to a csv file for debugging purposes
-df.to_csv('data.csv', index=False)
-
-# Set pd options
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_rows', None)
+            pending_pages.add(index)
+    if resume:
+        print(f"Resuming: {len(page_indexes) - len(pending_pages)} pages already completed")
+    return pending_pages, error_patients
 
-# Using Selenium to Automate the Process of Inputting the Data into the Database
-# Open Chrome Browser
-driver = webdriver.Chrome()
 
-# Open the URL
-url = "https://revolutionehr.com/static/#/"
-driver.get(url)
-
-# Define wait condition
-wait = WebDriverWait(driver, 10)
-
-
-def ensure_click(location: str) -> WebElement:
+def file_batch(df: pd.DataFrame, batch_path: str, form_type: str, batch_number: int, journal: BatchJournal,
+               resume: bool, sessions: int, open_session, release_session=None, matcher: str = patient_matcher,
+               patient_index: PatientIndex = None, error_ledger: ErrorLedger = None) -> dict:
     """
-    Ensures that the element at the given location is clickable and clicks it.
-    Sometimes, the element clicks are intercepted by other elements, so this function keeps trying until the element is clickable.
-    :param location:
-    :return:
+    Search for the patient of every page of a batch that is left to file and upload it. The patients that could not
+    be found are recorded in the error ledger
+    :param df: the dataframe that holds the info for each patient, indexed by page
+    :param batch_path: the path to the batch pdf
+    :param form_type: 'intake' or 'vf'
+    :param batch_number: the number of the batch
+    :param journal: the journal of the batch
+    :param resume: skip the pages the journal has as completed
+    :param sessions: the number of sessions to file with at the same time
+    :param open_session: a function that opens a new logged-in session
+    :param release_session: a function that takes back a session once it is done, instead of closing it
+    :param matcher: 'scored' or 'cascade'
+    :param patient_index: the PatientIndex to look patients up in first, if any
+    :param error_ledger: the ErrorLedger to record the patients that could not be found in, if any
+    :return: maps each page that was left to file to True if it was uploaded, False if the patient was not found, or
+    None if it could not be filed
     """
-    while True:  # Keep trying until the element is clickable
-        try:
-            field = fetch_element(location, EC.element_to_be_clickable)
-            field.click()
-            break
-        except:
-            continue  # Try again
+    pending_pages, error_patients = pending_batch_pages(journal, df.index, resume)
 
-    return field
+    # The patients a resumed run had as not found may have been journaled before they were recorded in the ledger
+    if error_ledger is not None:
+        for error_patient in error_patients:
+            error_ledger.record(form_type, error_patient, batch_path)
 
+    # Only opens the browser if there is something left to upload. Patients that cannot be found are recorded as the
+    # filer goes
+    filer = BatchFiler(form_type, batch_number, batch_path, journal, default_null_date, default_null_phone_number,
+                       matcher, patient_index, documents_cache_ttl, error_ledger)
+    if not pending_pages:
+        return {}
+    results = filer.file_pages(df, pending_pages, sessions, open_session, release_session)
+    return {page_index: results.get(page_index) for page_index in pending_pages}
 
-def fetch_element(location: str, condition=EC.presence_of_element_located, locator=By.XPATH) -> WebElement or None:
-    """
-    Fetches an element from the page using the given xpath and condition.
-    :param location: describes the path to the element
-    :param condition: the condition that the element must meet
-    :param locator: the type of locator to use (e.g. By.XPATH, By.ID, By.CSS_SELECTOR)
-    :return: The element if it is found, None otherwise
-    """
-    try:
-        return wait.until(condition((locator, location)))
-    except Exception as e:
-        max_retries = 3
-        retries = 0
-        while retries < max_retries:
-            try:
-                return wait.until(condition((locator, location)))
-            except Exception as e:
-                retries += 1
-                time.sleep(1)
-        return None
 
-# Login with username and password.
-username = 'INSERT USERNAME HERE'
-password = 'INSERT PASSWORD HERE'
-username_field = fetch_element(
-    '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/div[1]/div/input',
-    EC.element_to_be_clickable)
-username_field.click()
-username_field.send_keys(username)
-password_field = fetch_element(
-    '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/div[2]/div/input',
-    EC.element_to_be_clickable)
-password_field.click()
-password_field.send_keys(password)
-login_button = fetch_element(
-    '/html/body/div[2]/div/div/div[1]/div/rev-login-page/div/div[2]/div/rev-login-form/div[2]/div/form/button',
-    EC.element_to_be_clickable)
-login_button.click()
-
-
-def search_patient(field_path: str, field_value: str, patient_number: int) -> bool:
-    """
-    Search for a patient using the given fields and values.
-    :param field_path: the path to the field
-    :param field_value: the field's name
-    :param patient_number: the patient number
-    :return: True if the search was successful, False otherwise
+def retry_errors(error_ledger: ErrorLedger, form_type: str, sessions: int, open_session, matcher: str = patient_matcher,
+                 patient_index: PatientIndex = None, batch_number: int = None) -> None:
     """
-    # Fetch the field, click on it, and enter the value
-    field = ensure_click(field_path)
-    field.send_keys(df[field_value][patient_number])
-    field.send_keys(u'\ue007')  # Press enter
-
-    # Check if the search is finished
-    try:  # Sometimes stale element reference exception is thrown
-        search_finished_indicator = fetch_element(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/h4',
-            EC.presence_of_element_located)
-        while 'Search Results' not in search_finished_indicator.text:
-            search_finished_indicator = fetch_element(
-                '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/h4',
-                EC.presence_of_element_located)
-    except:
-        return False
-
-    # Check if there are any results
-    results_label = fetch_element(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/ejs-grid/div[5]/div[4]/span[2]',
-        EC.presence_of_element_located)
-
-    # Extract the number of results. If there are no results, then try again with the next search method, if any.
-    number_of_results = int(results_label.text[1])
-
-    local_success = number_of_results > 0
-
-    if local_success:
-        local_success = find_patient(patient_data, number_of_results)
-
-        if local_success:
-            if file_type == 'intake':
-                upload_form(patient_data[7])
-            elif file_type == 'vf':
-                upload_form(patient_data[8])
-
-    return local_success
-
-
-def find_patient(patient_info: list, n: int) -> bool:
+    Search again for the patients of only the pages the error ledger has as unresolved, and upload the pages whose
+    patient is found now. Pages are read from the journal, and only read from their batch if it has no text for them
+    :param error_ledger: the ErrorLedger the pages are taken from and resolved in
+    :param form_type: 'intake' or 'vf'
+    :param sessions: the number of sessions to file with at the same time
+    :param open_session: a function that opens a new logged-in session
+    :param matcher: 'scored' or 'cascade'
+    :param patient_index: the PatientIndex to look patients up in first, if any
+    :param batch_number: only retry the pages of this batch
     """
-    Find the patient using the given patient info
-    :param patient_info: all the patient info
-    :param n: number of results
-    :return: True if patient found, False otherwise
-    """
-    # Convert the results table to a dataframe
-    table = fetch_element(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/ejs-grid/div[3]/div/table',
-        EC.presence_of_element_located)
-    table_html = table.get_attribute('outerHTML')
-    table = pd.read_html(table_html)[0]
-
-    # Go through each patient in table to find valid patient
-    valid_row_index = None
-    for i, patient in table.iterrows():
-        patient_info = [str(x).lower() for x in
-                        patient_info]  # convert all patient info to lowercase for easier comparison
-
-        date_of_birth_valid = patient_info[2] in table[3][i].lower()  # shared between intake forms and vf forms
-
-        if file_type == 'intake':
-            full_name_valid = patient_info[0] in table[2][i].lower() and patient_info[1] in table[2][0].lower()
-            sex_valid = patient_info[3] in table[4][i].lower()
-            phone_number_valid = patient_info[4] in str(table[5][i]).lower()
-            address_valid = patient_info[5] in table[6][i].lower()
-            provider_valid = patient_info[6] in table[7][i].lower()
-            if (full_name_valid and date_of_birth_valid) or (
-                    (full_name_valid or date_of_birth_valid) and (sex_valid or provider_valid) and (
-                    phone_number_valid or address_valid)):
-                valid_row_index = i  # if any of the above conditions are true, then the patient is valid
-        elif file_type == 'vf':
-            first_name_valid = patient_info[0] in table[2][i].lower()
-            last_name_valid = patient_info[1] in table[2][i].lower()
-            if (first_name_valid or last_name_valid) and date_of_birth_valid:
-                valid_row_index = i  # if any of the above conditions are true, then the patient is valid
-
-    # If a valid patient was found, click on the patient
-    if valid_row_index is not None:
-        # Click on the patient
-        patient = fetch_element(
-            f'/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[2]/div/ejs-grid/div[3]/div/table/tbody/tr[{valid_row_index + 1}]',
-            EC.element_to_be_clickable)
-        patient.click()
-        return True
-    else:  # No valid patient was found
-        return False
-
-
-def reset_search() -> None:
-    # Clears the search fields
-    ensure_click(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[2]/div/button[2]')
-
-
-def get_table() -> pd.DataFrame:
+    template = form_templates[form_type]
+    batches = {}
+    for error in error_ledger.errors(form_type, batch_number=batch_number):
+        batch = batches.setdefault(error['batch'], {'path': error['batch_path'], 'pages': set()})
+        batch['path'] = batch['path'] or error['batch_path']
+        batch['pages'].add(error['page'] - 1)
+    if not batches:
+        print(f"No unresolved {form_type} errors to retry")
+
+    for number, batch in sorted(batches.items()):
+        pages = sorted(batch['pages'])
+        journal = BatchJournal(journal_path, form_type, number)
+        unread = [i for i in pages if journal.get(i, 'ocr') is None]
+        if unread:
+            if not batch['path'] or not os.path.exists(batch['path']):
+                print(f"Batch {number}: the batch pdf {batch['path']} is gone, so pages "
+                      f"{', '.join(str(i + 1) for i in unread)} cannot be read again")
+                pages = [i for i in pages if i not in unread]
+            else:
+                sizes = page_sizes(batch['path'])
+                fields = template.region_fields if adaptive_extraction else None
+                for i, regions in zip(unread, ocr_page_regions(batch['path'], sizes, template.regions, template.dpi,
+                                                               page_indexes=unread, fields=fields)):
+                    journal.record(i, 'ocr', regions=regions)
+        if not pages:
+            continue
+
+        records = [template.extract(journal.get(i, 'ocr')['regions'], default_null_date, default_null_phone_number)
+                   for i in pages]
+        df, fixes = assemble_records(records, default_null_date, default_null_phone_number)
+        df.index = pages
+        filer = BatchFiler(form_type, number, batch['path'], journal, default_null_date, default_null_phone_number,
+                           matcher, patient_index, documents_cache_ttl, error_ledger)
+        results = filer.file_pages(df, pages, sessions, open_session)
+        print(f"Batch {number}: {sum(bool(success) for success in results.values())} of {len(pages)} pages filed on "
+              f"retry")
+
+
+def session_opener(backend: str, site_url: str, sessions: int):
     """
-    Get the table from the given table path
-    :return: the table as a dataframe
+    Make the function that opens a logged-in session for the backend
+    :param backend: 'selenium' or 'http'
+    :param site_url: the address of the website
+    :param sessions: the number of sessions that will run at the same time. Browsers run headless when it is more than 1
     """
-    table = fetch_element(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/div/pms-patient-files/div/div[2]/div/div[2]/pms-folder-file-list/div/ejs-grid/div[4]/div/table',
-        EC.presence_of_element_located)
-    table_html = table.get_attribute('outerHTML')
-    table = pd.read_html(table_html)[0]
-    while table[1][0] == 'Documents':
-        table = fetch_element(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/div/pms-patient-files/div/div[2]/div/div[2]/pms-folder-file-list/div/ejs-grid/div[4]/div/table',
-            EC.presence_of_element_located)
-        table_html = table.get_attribute('outerHTML')
-        table = pd.read_html(table_html)[0]
-    return table
-
-
-def upload_form(date: str) -> None:
-    time.sleep(.5)  # Give the alert time to pop up
-    # Check for alert pop-up and close it if it is present
-    try:
-        alert_cancel_btn = driver.find_element(By.CSS_SELECTOR,
-                                               'button[data-test-id="alertHistoryModalCloseButton"]')
-        alert_cancel_btn.click()
-    except:
-        pass
-
-    # Navigate to the documents tab
-    ensure_click(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/pms-patient-navigation-bar/ejs-sidebar/div/a[20]/span')
-
-    # Navigate to the correct folder
-    if file_type == 'intake':
-        ensure_click("//li[@title='IntakeForms']")
-    elif file_type == 'vf':
-        ensure_click("//li[@title='Visual Fields']")
-
-    # Get the table that contains the patient's documents
-    table = get_table()
-
-    if date == default_null_date:
-        filename = f'Unknown-Document-Date-{file_type}.pdf'  # Name the file as an unknown document date if the date is null
+    if backend == 'http':
+        return ApiLogin(site_url)
+    return lambda: open_session(site_url, sessions > 1)
+
+
+if __name__ == '__main__':
+    # Read the command line options
+    parser = argparse.ArgumentParser(description="File a batch of scanned forms into the patients' documents")
+    parser.add_argument('--no-cache', action='store_true', help='run tesseract on every region without using the OCR cache')
+    parser.add_argument('--clear-cache', action='store_true', help='empty the OCR cache before reading the batch')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the pages the journal already has as uploaded or not found, and reuse its OCR results')
+    parser.add_argument('--workers', type=int, default=upload_workers,
+                        help='number of headless browser sessions that upload at the same time')
+    parser.add_argument('--url', default=url, help='address of the website, e.g. the mock_site.py server for testing')
+    parser.add_argument('--matcher', choices=['scored', 'cascade'], default=patient_matcher,
+                        help='score the results of combined searches, or search by one field after another')
+    parser.add_argument('--parquet', metavar='PATH', help='also write the extracted information to a parquet file '
+                                                          '(needs pyarrow or fastparquet)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='always search the website instead of looking patients up in the local patient index first')
+    parser.add_argument('--roster', help="csv of patients exported from the website to add to the patient index, with "
+                                         "a 'Patient ID' column and the columns of data.csv")
+    parser.add_argument('--backend', choices=['selenium', 'http'], default=upload_backend,
+                        help='drive the website through Chrome, or (experimental) log in once and call the api '
+                             'api_session.py assumes, which has not been checked against the real website')
+    parser.add_argument('--phases', action='store_true', default=run_mode == 'phases',
+                        help='read every page of the batch before logging in and uploading, instead of overlapping them')
+    parser.add_argument('--no-prefilter', action='store_true', default=not prefilter_pages,
+                        help='read every page, including blank pages and pages that were scanned twice')
+    parser.add_argument('--no-adaptive', action='store_true', default=not adaptive_extraction,
+                        help='read every region once, without reading missing or low-confidence fields again')
+    parser.add_argument('--retry-errors', action='store_true',
+                        help='instead of filing the batch, search again for the patients of the pages in the error '
+                             'ledger that are still unresolved, and upload the ones that are found')
+    args = parser.parse_args()
+
+    adaptive_extraction = not args.no_adaptive
+    if args.clear_cache:
+        cache = OCRCache(ocr_cache_path, ocr_cache_max_bytes)
+        cache.clear()
+        cache.close()
+
+    # Open the journal of this batch
+    journal = BatchJournal(journal_path, file_type, batch_number)
+    patient_index = None if args.no_index else PatientIndex(patient_index_path)
+    if patient_index is not None and args.roster:
+        print(f"Added {patient_index.add_roster(args.roster)} patients from the roster to the patient index")
+    open_batch_session = session_opener(args.backend, args.url, args.workers)
+    error_ledger = ErrorLedger(error_ledger_path)
+    page_hashes = None if args.no_prefilter else PageHashes(page_hashes_path)
+    page_filter = None if args.no_prefilter else PageFilter(journal, page_hashes)
+
+    if args.retry_errors:
+        retry_errors(error_ledger, file_type, args.workers, open_batch_session, args.matcher, patient_index)
+        df = None
+    elif args.phases:
+        # Read the batch, then search for the patient of every page and upload it
+        df = read_batch(path_to_batch, file_type, journal, args.resume, use_cache=not args.no_cache,
+                        page_filter=page_filter)
+        file_batch(df, path_to_batch, file_type, batch_number, journal, args.resume, args.workers, open_batch_session,
+                   matcher=args.matcher, patient_index=patient_index, error_ledger=error_ledger)
     else:
-        # Get the month and year from the date and include it in the filename
-        months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
-                  'November', 'December']
-        try:
-            month = months[int(date.split('/')[0]) - 1]
-        except:
-            month = 'UnknownMonth'
-        year = date.split('/')[2]
-        filename = f'{month}-{year}-{file_type}.pdf'
-
-    # Check if the file has already been uploaded by comparing it to the files in the table
-    files = table[1].tolist()
-    if filename not in files:
-        # Create a temporary path for the form and save it there
-        form_path = os.path.join(tempfile.gettempdir(), filename)
-        pages[i].save(form_path)
-
-        # Click on the upload button
-        ensure_click(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-patient/div[2]/div/div/pms-patient-files/div/div[2]/div/div[2]/pms-folder-file-list/div/ejs-grid/div[2]/rev-table-action-menu/div/div/div[1]/div/button[1]')
-
-        # Click on the upload file button and input the path to the form
-        file_input = fetch_element(
-            "input[type='file']",
-            locator=By.CSS_SELECTOR)
-        file_input.send_keys(form_path)
-
-        # Wait until the file is uploaded into the patient's documents
-        while True:
-            table = get_table()
-            files = table[1].tolist()
-            if filename in files:
-                break
-
-        os.remove(form_path)  # Delete the temporary file to avoid cluttering the computer's storage and path errors
-
-
-# Create a list to store patient's that could not be found/uploaded
-error_patients = []
-
-# For each patient in the dataframe
-for index, row in df.iterrows():
-    time.sleep(.5)  # Give the search page time to load
-    # Retrieve the patient's data from the dataframe
-    patient_data = df.iloc[index].tolist()
-
-    # Click Patient Tab
-    ensure_click('/html/body/div[1]/header/div/div[2]/ul/li[1]/a')
-
-    # Click Advanced Search Button if we are searching for the first time
-    if index == 0:
-        ensure_click(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-simple-search/form/div[2]/div/div[2]/button[3]')
-
-    # Reset the search to avoid errors
-    reset_search()
-
-    # Search for the patient using last name
-    success = search_patient(
-        '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[1]/div/input',
-        'Last Name', int(index))
-
-    if not success:  # If no results are found using last name search
-        reset_search()
-        # Search for the patient using first name
-        success = search_patient(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[2]/div/input',
-            'First Name', int(index))
-
-    if not success:  # If no results are found using first name search
-        reset_search()
-        # Search for the patient using date of birth
-        success = search_patient(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[2]/div[3]/div/ejs-datepicker/span/input',
-            'Date of Birth', int(index))
-
-    if not success and file_type == 'intake':  # If no results are found using date of birth search and we are working with an intake form
-        reset_search()
-
-        # Search for the patient using phone number
-        success = search_patient(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[3]/div[2]/div/ejs-maskedtextbox/span/input',
-            'Preferred Phone', int(index))
-
-    if not success and file_type == 'intake':  # If no results are found using phone number search
-        reset_search()
-
-        # Final attempt: Search for the patient using address
-        success = search_patient(
-            '/html/body/div[2]/div/div/pms-root/pms-patients/div/div/div/div/pms-search-patients/div[1]/pms-patients-advanced-search/form/div[1]/div[3]/div[1]/div/input',
-            'Address', int(index))
-
-    if not success:
-        # Add the patients location in their batch so that the user can easily locate their file. Also their information
-        error_patients.append([str(batch_number), str(index + 1), patient_data[0], patient_data[1], patient_data[2]])
-
-    # Display the patient's information and whether the upload was successful
-    print("Patient " + str(index + 1) + ": " + str(patient_data[0]) + " " + str(patient_data[1]) + " " + str(patient_data[2]))
-    print("Patient Upload Successful: " + str(success) + "\n")
-
-# Get the corresponding csv path
-csv_path = f'error_{file_type}.csv'
-
-# Make a list of the patients that have already been uploaded as errors
-with open(csv_path) as file:
-    existing_patients = []
-    reader_object = reader(file)
-    for row in reader_object:
-        existing_patients.append(row)
-
-# Add the error patients into a dataframe containing the patients that could not be found/uploaded
-with open(csv_path, 'a') as error_df:
-    writer_object = writer(error_df)
-    for error_patient in error_patients:
-        if error_patient not in existing_patients:
-            writer_object.writerow(error_patient)
-    error_df.close()
-
+        # Read, extract and file the pages at the same time. Only the pages left to file go through the pipeline
+        num_pages = count_pages(path_to_batch)
+        print(f"Number of pages in the batch: {num_pages}")
+        pending_pages, error_patients = pending_batch_pages(journal, range(num_pages), args.resume)
+        df = run_batch(path_to_batch, file_type, batch_number, journal, pending_pages, error_patients, args.workers,
+                       open_batch_session, default_null_date, default_null_phone_number, ocr_workers,
+                       None if args.no_cache else ocr_cache_path, ocr_cache_max_bytes, page_filter, adaptive_extraction,
+                       matcher=args.matcher, patient_index=patient_index, documents_ttl=documents_cache_ttl,
+                       error_ledger=error_ledger)
+
+    # Save the dataframe to a csv file for debugging purposes, and to parquet for other tools if asked to
+    if df is not None:
+        df.to_csv('data.csv', index=False)
+        if args.parquet:
+            try:
+                df.to_parquet(args.parquet, index=False)
+            except ImportError as e:
+                print(f"Could not write {args.parquet}: {e}")
+
+    if patient_index is not None:
+        patient_index.close()
+    if page_hashes is not None:
+        page_hashes.close()
+    error_ledger.close()
+
+    # Display where the batch's time went, and keep it to compare with other runs
+    batch_samples = take_samples()
+    print_timing_report(batch_samples)
+    write_timing_log(timings_path, batch_samples, file_type, batch_number)
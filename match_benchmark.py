@@ -0,0 +1,172 @@
+# Compares the scored combined search, with and without the patient index, to the search cascade offline, without a
+# browser or the website.
+# Pages are made by copying patients out of a roster and misreading their fields the way OCR does, so the patient each
+# page belongs to is known. Searches are answered from the same roster, the way mock_site.py answers them. A patient
+# found in the index is opened the way each backend opens them: the browser searches for them by last name and date of
+# birth, and the http backend opens them by id without searching, so the searches the index saves are counted for both.
+#
+# Usage: python match_benchmark.py --roster data.csv --pages 500 --noise 0.3
+import argparse
+import random
+import time
+
+import pandas as pd
+
+from api_session import results_table, api_search_fields
+from backend import Backend
+from filing import cascade_search, scored_search
+from mock_site import MockSite
+from patient_index import PatientIndex
+
+null_date = '10/10/1903'
+null_phone_number = '(102) 301-2309'
+
+# Characters tesseract commonly reads as other characters
+ocr_confusions = {
+    'l': 'i', 'i': 'l', 't': 'l', 'o': '0', 'O': '0', '0': 'O', 'e': 'c', 'c': 'e', 'n': 'm', 'm': 'n', 'S': '5',
+    '5': 'S', '1': 'l', '8': '3', '3': '8', '6': '5', 'a': 'o',
+}
+
+# Columns that OCR reads, and the value a column gets when it could not be read at all
+page_columns = {
+    'First Name': '***',
+    'Last Name': '***',
+    'Date of Birth': null_date,
+    'Sex': '***',
+    'Preferred Phone': null_phone_number,
+    'Address': '***',
+    'Provider': '***',
+}
+
+
+class RosterBackend(Backend):
+    """
+    Answers searches from a roster of patients and counts them
+    """
+
+    def __init__(self, site: MockSite, open_by_id: bool = False):
+        """
+        :param open_by_id: open patients found in the index by their id, like the http backend, instead of searching
+        for them like the browser
+        """
+        self.site = site
+        self.open_by_id = open_by_id
+        self.searches = 0
+
+    def search_many(self, criteria: dict) -> pd.DataFrame or None:
+        self.searches += 1
+        return results_table(self.site.search_many([(api_search_fields[field], value)
+                                                    for field, value in criteria.items()]))
+
+    def open_patient(self, row_index: int) -> None:
+        pass
+
+    def open_patient_by_id(self, patient_id, row: list) -> None:
+        if not self.open_by_id:
+            super().open_patient_by_id(patient_id, row)
+
+
+def misread(value: str, rng: random.Random) -> str:
+    """
+    Misread one character of a value, or drop it
+    """
+    positions = [i for i, c in enumerate(value) if c in ocr_confusions or c.isalnum()]
+    if not positions:
+        return value
+    i = rng.choice(positions)
+    if value[i] in ocr_confusions and rng.random() < 0.8:
+        return value[:i] + ocr_confusions[value[i]] + value[i + 1:]
+    return value[:i] + value[i + 1:]
+
+
+def make_pages(roster: pd.DataFrame, file_type: str, count: int, noise: float, unreadable: float,
+               rng: random.Random) -> list:
+    """
+    Make pages out of random patients of the roster
+    :param roster: the patients, with the columns of data.csv
+    :param file_type: 'intake' or 'vf'. vf pages only have a name and date of birth
+    :param count: the number of pages
+    :param noise: the chance that OCR misreads a character of each column
+    :param unreadable: the chance that OCR could not read a column at all
+    :param rng: the random number generator
+    :return: a list of (roster index of the patient, the page's row)
+    """
+    pages = []
+    for _ in range(count):
+        index = rng.randrange(len(roster))
+        page = {}
+        for column, placeholder in page_columns.items():
+            value = str(roster.iloc[index][column])
+            if file_type == 'vf' and column not in ('First Name', 'Last Name', 'Date of Birth'):
+                value = placeholder
+            elif rng.random() < unreadable:
+                value = placeholder
+            elif rng.random() < noise:
+                value = misread(value, rng)
+            page[column] = value
+        page['Document Date'] = null_date
+        page['Screening Date'] = null_date
+        pages.append((index, pd.Series(page)))
+    return pages
+
+
+def run_matcher(name: str, pages: list, site: MockSite, file_type: str) -> dict:
+    """
+    Find the patient of every page with one matcher
+    :param name: 'cascade', 'scored', or 'indexed' and 'indexed-id', which look patients up in the index first and
+    open them like the browser and the http backend
+    :return: the number of searches, how many pages matched the right or wrong patient, and the time taken
+    """
+    backend = RosterBackend(site, open_by_id=name == 'indexed-id')
+    placeholders = {'***', null_date, null_phone_number}
+    patient_index = PatientIndex(':memory:')  # Starts empty and fills up with the results of the searches
+    correct = wrong = 0
+    start = time.perf_counter()
+    for index, page in pages:
+        if name.startswith('indexed'):
+            match = patient_index.find(page, file_type, placeholders)
+            if match is not None:
+                table, row_index, score = match
+                backend.open_patient_by_id(table[1][row_index], table.iloc[row_index].tolist())
+            else:
+                match = scored_search(backend, page, file_type, placeholders, patient_index.add_table)
+        elif name == 'scored':
+            match = scored_search(backend, page, file_type, placeholders)
+        else:
+            match = cascade_search(backend, page, file_type)
+        if match is None:
+            continue
+        table, row_index, score = match
+        if str(table[1][row_index]) == str(site.patients[index]['id']):
+            correct += 1
+        else:
+            wrong += 1
+    return {
+        'searches': backend.searches,
+        'correct': correct,
+        'wrong': wrong,
+        'not found': len(pages) - correct - wrong,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the ways of finding patients offline')
+    parser.add_argument('--roster', default='data.csv', help='csv with the columns of data.csv that holds the patients')
+    parser.add_argument('--type', choices=['intake', 'vf'], default='intake')
+    parser.add_argument('--pages', type=int, default=500, help='number of pages to make')
+    parser.add_argument('--noise', type=float, default=0.3, help='chance that OCR misreads a character of a column')
+    parser.add_argument('--unreadable', type=float, default=0.05, help='chance that OCR cannot read a column at all')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    roster = pd.read_csv(args.roster, dtype=str, keep_default_na=False)
+    site = MockSite(args.roster, alert_every=0)
+    pages = make_pages(roster, args.type, args.pages, args.noise, args.unreadable, random.Random(args.seed))
+
+    print(f"{len(pages)} {args.type} pages, {len(roster)} patients in the roster")
+    print(f"{'matcher':<12}{'searches':>10}{'per page':>10}{'correct':>10}{'wrong':>10}{'not found':>11}{'seconds':>10}")
+    for name in ('cascade', 'scored', 'indexed', 'indexed-id'):
+        result = run_matcher(name, pages, site, args.type)
+        print(f"{name:<12}{result['searches']:>10}{result['searches'] / len(pages):>10.2f}{result['correct']:>10}"
+              f"{result['wrong']:>10}{result['not found']:>11}{result['seconds']:>10.2f}")
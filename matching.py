@@ -0,0 +1,160 @@
+# Scores every row of the search results against the information read from a page, so that the patient can be picked
+# out of one combined search instead of searching by one field after another and keeping the last row that passes.
+import re
+from difflib import SequenceMatcher
+
+import pandas as pd
+
+# How much each column counts towards a row's score. Columns the page could not be read for are left out
+match_weights = {
+    'intake': {'Last Name': 3, 'First Name': 2, 'Date of Birth': 4, 'Sex': 0.5, 'Preferred Phone': 2, 'Address': 1.5,
+               'Provider': 0.5},
+    'vf': {'Last Name': 3, 'First Name': 2, 'Date of Birth': 4},
+}
+
+# Columns searched by together, the most selective first. A broader search is only run when the ones before it found
+# no confident match, e.g. because OCR misread the last name
+combined_searches = {
+    'intake': [('Last Name', 'Date of Birth'), ('Date of Birth',), ('Last Name', 'First Name'), ('Preferred Phone',),
+               ('Last Name',)],
+    'vf': [('Last Name', 'Date of Birth'), ('Date of Birth',), ('Last Name', 'First Name'), ('Last Name',)],
+}
+
+match_threshold = 0.8  # The lowest score a row can be accepted with
+match_margin = 0.05  # How far the best row has to score above the next one, so that look-alike patients are not guessed
+# The patient index only holds the patients seen so far, so a look-alike that would lose by match_margin may be missing
+# from it. Its matches are only accepted with a first name this close to the page's, e.g. not John for Jane
+index_first_name_min = 0.85
+
+# Columns of the search results table that hold each column of the page. Names are split out of column 2
+table_columns = {
+    'Date of Birth': 3,
+    'Sex': 4,
+    'Preferred Phone': 5,
+    'Address': 6,
+    'Provider': 7,
+}
+
+digit_columns = ('Date of Birth', 'Preferred Phone')
+
+
+def normalize(column: str, value) -> str:
+    """
+    Reduce a value to what is compared: the digits of dates and phone numbers, and the lowercase letters, digits and
+    single spaces of everything else
+    """
+    value = str(value).lower()
+    if column in digit_columns:
+        return re.sub(r'\D', '', value)
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', value).split())
+
+
+def similarity(column: str, a: str, b: str) -> float:
+    """
+    How alike two normalized values are, from 0 to 1
+    """
+    if not a or not b:
+        return 0.0
+    if column in digit_columns and len(a) == len(b):
+        # A misread digit costs that digit, without the credit SequenceMatcher gives for digits shared elsewhere
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def split_name(full_name) -> tuple:
+    """
+    Split the 'Last, First' name of a search result into its last and first name
+    """
+    last, _, first = str(full_name).partition(',')
+    return last, first
+
+
+def row_patient_id(row) -> str or None:
+    """
+    The patient's id from column 1 of their row of the search results, or None if the row has none. An empty cell of
+    the results grid is read as nan, which would make every patient without an id look like the same patient
+    """
+    patient_id = str(row[1]).strip()
+    return None if patient_id.lower() in ('', 'nan', 'none') else patient_id
+
+
+def score_row(patient: pd.Series, row: pd.Series, weights: dict, placeholders: set) -> float or None:
+    """
+    Score how well a row of the search results matches the patient read from the page
+    :param patient: the row of the page in the dataframe
+    :param row: the row of the search results table
+    :param weights: how much each column counts
+    :param placeholders: the values that mean a column could not be read
+    :return: the weighted similarity from 0 to 1, or None if none of the weighted columns could be read
+    """
+    total = 0.0
+    weight_sum = 0.0
+    for column, weight in weights.items():
+        score = column_score(patient, row, column, placeholders)
+        if score is None:
+            continue
+        total += weight * score
+        weight_sum += weight
+    return total / weight_sum if weight_sum else None
+
+
+def column_score(patient: pd.Series, row: pd.Series, column: str, placeholders: set) -> float or None:
+    """
+    Score how well one column of a row of the search results matches the patient read from the page
+    :return: the similarity from 0 to 1, or None if the column could not be read from the page
+    """
+    value = patient[column]
+    if str(value) in placeholders:
+        return None
+    last, first = split_name(row[2])
+    if column == 'Last Name':
+        found = last
+    elif column == 'First Name':
+        found = first
+    else:
+        found = row[table_columns[column]]
+    a = normalize(column, value)
+    b = normalize(column, found)
+    score = similarity(column, a, b)
+    if column == 'First Name' and ' ' in b:
+        # The website may keep a middle name with the first name
+        score = max(score, similarity(column, a, b.split(' ')[0]))
+    return score
+
+
+def best_match(patient: pd.Series, table: pd.DataFrame, file_type: str, placeholders: set) -> tuple or None:
+    """
+    Find the row of the search results that matches the patient best, if it matches confidently enough
+    :param patient: the row of the page in the dataframe
+    :param table: the search results table
+    :param file_type: 'intake' or 'vf'
+    :param placeholders: the values that mean a column could not be read
+    :return: (index of the row, its score), or None if no row clears match_threshold by match_margin
+    """
+    scores = []
+    for i, row in table.iterrows():
+        score = score_row(patient, row, match_weights[file_type], placeholders)
+        if score is not None:
+            scores.append((score, i))
+    if not scores:
+        return None
+
+    scores.sort(reverse=True)
+    best_score, best_index = scores[0]
+    if best_score < match_threshold:
+        return None
+    if len(scores) > 1 and best_score - scores[1][0] < match_margin:
+        return None
+    return best_index, best_score
+
+
+def search_criteria(patient: pd.Series, file_type: str, placeholders: set) -> list:
+    """
+    The combined searches that can be run for a patient, skipping the ones that need a column that could not be read
+    :return: a list of dicts mapping each column to search by to its value
+    """
+    criteria = []
+    for columns in combined_searches[file_type]:
+        if all(str(patient[column]) not in placeholders for column in columns):
+            criteria.append({column: str(patient[column]) for column in columns})
+    return criteria
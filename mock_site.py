@@ -0,0 +1,392 @@
+# A local mock of the website's login, patient search and documents pages, so that uploading can be tested offline.
+# The pages are laid out so that every xpath in browser.py finds the same element it finds on the real website, and
+# they get their data from the same api paths that api_session.py calls, behind a session cookie set by logging in.
+# Patients come from a csv with the same columns as data.csv, and uploaded files are kept in memory.
+#
+# Usage: python mock_site.py --patients data.csv --port 8000
+#        python main.py --url http://localhost:8000/ --workers 4
+#        python main.py --url http://localhost:8000/ --backend http
+import argparse
+import json
+import re
+import threading
+import time
+from csv import DictReader
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+page = r"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Mock RevolutionEHR</title>
+<style>
+    td, th { border: 1px solid #ccc; padding: 2px 6px; }
+    tbody tr { cursor: pointer; }
+    #alert-modal { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0, 0, 0, .4); }
+</style>
+</head>
+<body>
+<div id="header" hidden><header><div><div>Mock RevolutionEHR</div><div><ul><li><a id="patients-tab" href="#">Patients</a></li></ul></div></div></header></div>
+<div><div><div>
+    <div id="login-view"><div><rev-login-page><div><div></div><div><div><rev-login-form><div></div><div><div>
+        <form onsubmit="return false">
+            <div><div><input id="username" placeholder="Username"></div></div>
+            <div><div><input id="password" type="password" placeholder="Password"></div></div>
+            <button id="login">Log In</button>
+        </form>
+    </div></div></rev-login-form></div></div></div></rev-login-page></div></div>
+    <pms-root id="app" hidden><pms-patients><div><div><div><div>
+        <pms-search-patients id="search-view">
+            <div>
+                <pms-patients-simple-search id="simple-search"><form onsubmit="return false">
+                    <div><input placeholder="Search patients"></div>
+                    <div><div><div></div><div><button>Search</button><button>Recent</button><button id="advanced">Advanced</button></div></div></div>
+                </form></pms-patients-simple-search>
+                <pms-patients-advanced-search id="advanced-search" hidden><form onsubmit="return false">
+                    <div>
+                        <div></div>
+                        <div>
+                            <div><div><input data-field="last" placeholder="Last Name"></div></div>
+                            <div><div><input data-field="first" placeholder="First Name"></div></div>
+                            <div><div><ejs-datepicker><span><input data-field="dob" placeholder="Date of Birth"></span></ejs-datepicker></div></div>
+                        </div>
+                        <div>
+                            <div><div><input data-field="address" placeholder="Address"></div></div>
+                            <div><div><ejs-maskedtextbox><span><input data-field="phone" placeholder="Phone"></span></ejs-maskedtextbox></div></div>
+                        </div>
+                    </div>
+                    <div><div><button>Search</button><button id="reset">Clear</button></div></div>
+                </form></pms-patients-advanced-search>
+            </div>
+            <div><div>
+                <h4 id="results-heading">Patients</h4>
+                <ejs-grid>
+                    <div></div>
+                    <div></div>
+                    <div><div><table id="results"><tbody></tbody></table></div></div>
+                    <div></div>
+                    <div><div></div><div></div><div></div><div><span>Showing </span><span id="results-count">(0 items)</span></div></div>
+                </ejs-grid>
+            </div></div>
+        </pms-search-patients>
+        <pms-patient id="patient-view" hidden>
+            <div><h3 id="patient-name"></h3></div>
+            <div><div>
+                <pms-patient-navigation-bar><ejs-sidebar><div id="navigation"></div></ejs-sidebar></pms-patient-navigation-bar>
+                <div><pms-patient-files id="patient-files" hidden><div>
+                    <div></div>
+                    <div><div>
+                        <div><ul><li title="IntakeForms">IntakeForms</li><li title="Visual Fields">Visual Fields</li></ul></div>
+                        <div><pms-folder-file-list><div><ejs-grid>
+                            <div></div>
+                            <div><rev-table-action-menu><div><div><div><div><button id="upload">Upload</button></div></div></div></div></rev-table-action-menu></div>
+                            <div><div id="upload-dialog" hidden><input type="file" id="file-input"></div></div>
+                            <div><div><table id="documents"><tbody></tbody></table></div></div>
+                        </ejs-grid></div></pms-folder-file-list></div>
+                    </div></div>
+                </div></pms-patient-files></div>
+            </div></div>
+        </pms-patient>
+    </div></div></div></div></pms-patients></pms-root>
+</div></div></div>
+<div id="alert-modal" hidden><div><p>Patient alert</p><button data-test-id="alertHistoryModalCloseButton">Close</button></div></div>
+<script>
+const $ = (id) => document.getElementById(id);
+const html = (text) => String(text).replace(/[&<>"]/g, (c) => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[c]));
+let patient = null;
+let folder = null;
+
+// The documents tab is the 20th link of the navigation bar
+const tabs = ['Summary', 'Demographics', 'Insurance', 'Family', 'Contacts', 'Encounters', 'Appointments', 'Orders',
+              'Prescriptions', 'Allergies', 'Problems', 'Health', 'Vitals', 'Recalls', 'Messages', 'Notes', 'Tasks',
+              'Accounts', 'Invoices', 'Documents'];
+$('navigation').innerHTML = tabs.map((tab) => `<a href="#"><span>${tab}</span></a>`).join('');
+$('navigation').lastChild.onclick = (event) => {
+    event.preventDefault();
+    $('patient-files').hidden = false;
+    renderDocuments([['', 'Documents']]);
+};
+
+// Like the real website, the header with the patients tab only shows once the login has been answered
+$('login').onclick = async () => {
+    const response = await fetch('/api/login', {method: 'POST'});  // Sets the session cookie the api checks
+    if (!response.ok) {
+        return;
+    }
+    $('login-view').hidden = true;
+    $('header').hidden = false;
+    $('app').hidden = false;
+};
+
+$('patients-tab').onclick = (event) => {
+    event.preventDefault();
+    $('search-view').hidden = false;
+    $('patient-view').hidden = true;
+};
+
+$('advanced').onclick = () => {
+    $('simple-search').hidden = true;
+    $('advanced-search').hidden = false;
+};
+
+$('reset').onclick = () => {
+    document.querySelectorAll('#advanced-search input').forEach((input) => input.value = '');
+    $('results-heading').textContent = 'Patients';
+    renderResults([]);
+};
+
+document.querySelectorAll('#advanced-search input').forEach((input) => input.addEventListener('keydown', async (event) => {
+    if (event.key !== 'Enter') {
+        return;
+    }
+    event.preventDefault();
+    $('results-heading').textContent = 'Searching...';
+    // Every filled in field is searched by at once
+    const query = Array.from(document.querySelectorAll('#advanced-search input')).filter((field) => field.value)
+        .map((field) => `field=${field.dataset.field}&value=${encodeURIComponent(field.value)}`).join('&');
+    const response = await fetch(`/api/patients/search?${query}`);
+    renderResults(await response.json());
+    $('results-heading').textContent = 'Search Results';
+}));
+
+function renderResults(rows) {
+    const body = $('results').tBodies[0];
+    body.innerHTML = rows.map((row) => `<tr><td></td><td>${row.id}</td><td>${html(row.last)}, ${html(row.first)}</td>` +
+        `<td>${html(row.dob)}</td><td>${html(row.sex)}</td><td>${html(row.phone)}</td>` +
+        `<td>${html(row.address)}</td><td>${html(row.provider)}</td></tr>`).join('');
+    rows.forEach((row, i) => body.rows[i].onclick = () => openPatient(row));
+    $('results-count').textContent = `(${rows.length} items)`;
+}
+
+function openPatient(row) {
+    patient = row;
+    folder = null;
+    $('patient-name').textContent = `${row.last}, ${row.first}`;
+    $('search-view').hidden = true;
+    $('patient-view').hidden = false;
+    $('patient-files').hidden = true;
+    $('upload-dialog').hidden = true;
+    $('alert-modal').hidden = !row.alert;
+}
+
+document.querySelector('[data-test-id="alertHistoryModalCloseButton"]').onclick = () => $('alert-modal').hidden = true;
+
+document.querySelectorAll('li[title]').forEach((item) => item.onclick = () => {
+    folder = item.title;
+    loadDocuments();
+});
+
+async function loadDocuments() {
+    renderDocuments([['', 'Documents']]);  // The grid shows the folder while its files load
+    const response = await fetch(`/api/patients/${patient.id}/documents?folder=${encodeURIComponent(folder)}`);
+    const files = await response.json();
+    renderDocuments(files.map((file) => ['', file.name, file.uploaded]));
+}
+
+function renderDocuments(rows) {
+    const body = $('documents').tBodies[0];
+    if (rows.length === 0) {
+        body.innerHTML = '<tr><td colspan="3">No records to display</td></tr>';
+        return;
+    }
+    body.innerHTML = rows.map((row) => '<tr>' + row.map((cell) => `<td>${html(cell)}</td>`).join('') + '</tr>').join('');
+}
+
+$('upload').onclick = () => $('upload-dialog').hidden = false;
+
+$('file-input').onchange = async () => {
+    const file = $('file-input').files[0];
+    await fetch(`/api/patients/${patient.id}/documents?folder=${encodeURIComponent(folder)}&name=${encodeURIComponent(file.name)}`,
+                {method: 'POST', body: file});
+    $('file-input').value = '';
+    $('upload-dialog').hidden = true;
+    loadDocuments();
+};
+</script>
+</body>
+</html>
+"""
+
+
+class MockSite:
+    """
+    The patients and their uploaded documents, shared by every browser session
+    """
+
+    def __init__(self, patients_csv: str, latency: float = 0, alert_every: int = 3):
+        """
+        :param patients_csv: a csv with the columns of data.csv that holds the patients
+        :param latency: seconds every request to the api takes, to mimic the real website
+        :param alert_every: every alert_every-th patient shows an alert pop-up when opened. 0 for none
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.documents = {}  # Maps (patient id, folder) to the files uploaded into it
+        self.uploads = 0
+        self.sessions = set()  # The session cookies handed out by logging in
+
+        self.patients = []
+        with open(patients_csv, newline='') as file:
+            for i, row in enumerate(DictReader(file)):
+                self.patients.append({
+                    'id': i + 1,
+                    'first': row['First Name'],
+                    'last': row['Last Name'],
+                    'dob': row['Date of Birth'],
+                    'sex': row['Sex'],
+                    'phone': row['Preferred Phone'],
+                    'address': row['Address'],
+                    'provider': row['Provider'],
+                    'alert': bool(alert_every) and (i + 1) % alert_every == 0,
+                })
+
+    def search(self, field: str, value: str) -> list:
+        """
+        Find the patients whose field matches the value the way the website's advanced search does
+        """
+        value = value.strip().lower()
+        if not value:
+            return []
+        if field in ('first', 'last'):
+            return [p for p in self.patients if p[field].lower().startswith(value)]
+        if field == 'dob':
+            return [p for p in self.patients if p['dob'] == value]
+        if field == 'phone':
+            digits = re.sub(r'\D', '', value)
+            return [p for p in self.patients if re.sub(r'\D', '', p['phone']) == digits]
+        if field == 'address':
+            return [p for p in self.patients if value in p['address'].lower()]
+        return []
+
+    def search_many(self, criteria: list) -> list:
+        """
+        Find the patients that match every (field, value) pair, like an advanced search with several fields filled in
+        """
+        if not criteria:
+            return []
+        ids = None
+        for field, value in criteria:
+            found = {p['id'] for p in self.search(field, value)}
+            ids = found if ids is None else ids & found
+        return [p for p in self.patients if p['id'] in ids]
+
+    def login(self) -> str:
+        """
+        Start a session and return its cookie
+        """
+        with self.lock:
+            token = f'mock-{len(self.sessions) + 1}'
+            self.sessions.add(token)
+        return token
+
+    def list_documents(self, patient_id: int, folder: str) -> list:
+        with self.lock:
+            return list(self.documents.get((patient_id, folder), []))
+
+    def upload(self, patient_id: int, folder: str, name: str, size: int) -> None:
+        with self.lock:
+            self.documents.setdefault((patient_id, folder), []).append(
+                {'name': name, 'size': size, 'uploaded': time.strftime('%m/%d/%Y')})
+            self.uploads += 1
+
+
+def make_handler(site: MockSite):
+    """
+    Make the request handler class that serves the mock site
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass  # Keep the console quiet
+
+        def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data, status: int = 200) -> None:
+            self.send_body(json.dumps(data).encode(), 'application/json', status)
+
+        def logged_in(self) -> bool:
+            """
+            Check that the request carries the cookie of a session, like the real api does
+            """
+            cookies = dict(part.strip().split('=', 1) for part in self.headers.get('Cookie', '').split(';') if '=' in part)
+            return cookies.get('session') in site.sessions
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path in ('/', '/static/'):
+                self.send_body(page.encode(), 'text/html; charset=utf-8')
+                return
+
+            time.sleep(site.latency)
+            if not self.logged_in():
+                self.send_json({'error': 'not logged in'}, 401)
+                return
+            if url.path == '/api/patients/search':
+                params = parse_qs(url.query)
+                self.send_json(site.search_many(list(zip(params.get('field', []), params.get('value', [])))))
+                return
+            match = re.fullmatch(r'/api/patients/(\d+)/documents', url.path)
+            if match:
+                self.send_json(site.list_documents(int(match.group(1)), query.get('folder', '')))
+                return
+            self.send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            time.sleep(site.latency)
+            if url.path == '/api/login':
+                self.send_response(200)
+                self.send_header('Set-Cookie', f'session={site.login()}; Path=/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if not self.logged_in():
+                self.send_json({'error': 'not logged in'}, 401)
+                return
+            match = re.fullmatch(r'/api/patients/(\d+)/documents', url.path)
+            if match:
+                site.upload(int(match.group(1)), query.get('folder', ''), query.get('name', ''), len(body))
+                self.send_json({'ok': True})
+                return
+            self.send_json({'error': 'not found'}, 404)
+
+    return Handler
+
+
+def serve(site: MockSite, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start serving the mock site in a background thread.
+    :param site: the patients and documents to serve
+    :param port: the port to listen on. 0 picks a free one
+    :return: the server. Its address is http://localhost:{server.server_port}/
+    """
+    server = ThreadingHTTPServer(('localhost', port), make_handler(site))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local mock of the website for testing offline')
+    parser.add_argument('--patients', default='data.csv', help='csv with the columns of data.csv that holds the patients')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds every request to the api takes')
+    parser.add_argument('--alert-every', type=int, default=3,
+                        help='every n-th patient shows an alert pop-up when opened. 0 for none')
+    args = parser.parse_args()
+
+    server = serve(MockSite(args.patients, args.latency, args.alert_every), args.port)
+    print(f"Serving the mock site at http://localhost:{server.server_port}/")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,164 @@
+# OCR helpers that send cropped page regions to a pool of worker processes
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pytesseract
+
+from adaptive_ocr import read_adaptively, settings_key
+from ocr_cache import OCRCache
+from rasterize import render_region
+from timings import timed, run_timed, collect
+
+# Define tesseract settings shared by every worker
+tesseract_lang = 'eng'
+tesseract_config = '--psm 6'
+tesseract_threads = 1  # Threads each tesseract process may use. One per worker keeps the pool from oversubscribing the CPU
+
+_cache = None  # The OCR cache this process reads and writes, or None to always run tesseract
+
+
+def extract_text(page) -> str:
+    """
+    Extract the text from a page of a pdf
+    """
+    with timed('ocr'):
+        return pytesseract.image_to_string(page, lang=tesseract_lang, config=tesseract_config)
+
+
+def crop_region(page, region: tuple):
+    """
+    Crop a region out of a page.
+    :param page: the PIL image of the page
+    :param region: (left, top, right, bottom) as fractions of the page's width and height
+    :return: the cropped image
+    """
+    w, h = page.width, page.height
+    left, top, right, bottom = region
+    # Crop function works as follows: crop((left, top, right, bottom))
+    return page.crop((w * left, h * top, w * right, h * bottom))
+
+
+def extract_region_text(image, region: tuple, fields: list = None) -> str:
+    """
+    Extract the text from a region of a page, reading it from the OCR cache if the region has been seen before.
+    :param image: the PIL image of the region
+    :param region: the (left, top, right, bottom) crop spec the image was cut with
+    :param fields: the forms.Field objects read from the region, to read again the ones that are missing or were read
+    with low confidence, see adaptive_ocr.py. None reads the region once
+    :return: the text of the region
+    """
+    def read(region_image) -> str:
+        if fields is None:
+            return extract_text(region_image)
+        return read_adaptively(region_image, fields, tesseract_lang, tesseract_config)
+
+    if _cache is None:
+        return read(image)
+
+    # Adaptive text holds the fields that were read again, so it is cached apart from the plain text, and apart from
+    # text read again with other settings
+    config = tesseract_config if fields is None else f'{tesseract_config}|adaptive|{settings_key(fields)}'
+    key = OCRCache.make_key(image, region, tesseract_lang, config)
+    text = _cache.get(key)
+    if text is None:  # Only run tesseract on regions that are not in the cache
+        text = read(image)
+        _cache.put(key, text)
+    return text
+
+
+def _init_worker(threads: int, cache_path: str or None, cache_max_bytes: int) -> None:
+    """
+    Runs once in every worker process. Tesseract uses OpenMP internally, so without a limit each worker would
+    start one thread per core and the pool would oversubscribe the CPU.
+    :param threads: the number of threads each tesseract process may use
+    :param cache_path: the path to the OCR cache, or None to not use it
+    :param cache_max_bytes: the size the OCR cache may grow to
+    """
+    global _cache
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)
+    _cache = OCRCache(cache_path, cache_max_bytes) if cache_path else None
+
+
+def create_ocr_pool(workers: int = None, cache_path: str = None, cache_max_bytes: int = 100 * 1024 * 1024,
+                    in_process: bool = True) -> ProcessPoolExecutor or None:
+    """
+    Create the process pool used for OCR.
+    :param workers: the number of worker processes. Defaults to the number of cores. 1 or less runs OCR in this process
+    :param cache_path: the path to the OCR cache, or None to always run tesseract
+    :param cache_max_bytes: the size the OCR cache may grow to before the least recently used entries are evicted
+    :param in_process: allow running OCR in this process for 1 worker. If False, 1 worker is a pool of one process
+    :return: the pool, or None if OCR should run in this process
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(workers, 1)
+    if workers == 1 and in_process:
+        _init_worker(tesseract_threads, cache_path, cache_max_bytes)
+        return None
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(tesseract_threads, cache_path, cache_max_bytes))
+
+
+def ocr_pages(pages: list, regions: dict, pool: ProcessPoolExecutor = None, fields: dict = None) -> list:
+    """
+    OCR the given regions of every page.
+    :param pages: the PIL images of the pages
+    :param regions: maps a region name to its (left, top, right, bottom) crop spec
+    :param pool: the pool created by create_ocr_pool, or None to OCR in this process
+    :param fields: maps a region name to the fields read from it, to read them adaptively, or None
+    :return: one dict per page, in page order, that maps each region name to its text
+    """
+    # Only the cropped regions are sent to the workers, which keeps the pickling cost down
+    names = list(regions)
+    crops = [crop_region(page, regions[name]) for page in pages for name in names]
+    crop_specs = [regions[name] for page in pages for name in names]
+    crop_fields = [None if fields is None else fields[name] for page in pages for name in names]
+
+    if pool is None:
+        texts = [extract_region_text(*crop) for crop in zip(crops, crop_specs, crop_fields)]
+    else:
+        # map returns the results in the order the crops were submitted, so the pages stay in order. The timings the
+        # workers record come back with the text
+        texts = [collect(result) for result in pool.map(run_timed, repeat(extract_region_text), crops, crop_specs,
+                                                        crop_fields)]
+
+    return [dict(zip(names, texts[i:i + len(names)])) for i in range(0, len(texts), len(names))]
+
+
+def render_and_extract(task: tuple) -> str:
+    """
+    Render one region of a page and extract its text. Runs in the worker, so only the task is pickled, never an image.
+    :param task: (path, page_index, region, dpi, page_size), see render_region, and optionally the fields read from the
+    region, to read them adaptively
+    """
+    path, page_index, region, dpi, page_size = task[:5]
+    fields = task[5] if len(task) > 5 else None
+    return extract_region_text(render_region(path, page_index, region, dpi, page_size), region, fields)
+
+
+def ocr_page_regions(path: str, sizes: list, regions: dict, dpi: int, pool: ProcessPoolExecutor = None,
+                     page_indexes: list = None, fields: dict = None) -> list:
+    """
+    Render only the given regions of the pages of a pdf, in grayscale, and OCR them.
+    :param path: the path to the pdf
+    :param sizes: the size of every page in points, from page_sizes
+    :param regions: maps a region name to its (left, top, right, bottom) crop spec
+    :param dpi: the resolution the regions are rendered at
+    :param pool: the pool created by create_ocr_pool, or None to OCR in this process
+    :param page_indexes: the 0-indexed pages to read. Defaults to every page
+    :param fields: maps a region name to the fields read from it, to read them adaptively, or None
+    :return: one dict per page, in page order, that maps each region name to its text
+    """
+    if page_indexes is None:
+        page_indexes = range(len(sizes))
+    names = list(regions)
+    tasks = [(path, i, regions[name], dpi, sizes[i], None if fields is None else fields[name])
+             for i in page_indexes for name in names]
+
+    if pool is None:
+        texts = [render_and_extract(task) for task in tasks]
+    else:
+        texts = [collect(result) for result in pool.map(run_timed, repeat(render_and_extract), tasks)]
+
+    return [dict(zip(names, texts[i:i + len(names)])) for i in range(0, len(texts), len(names))]
@@ -0,0 +1,106 @@
+# On-disk cache of OCR results so that re-runs and overlapping batches skip tesseract for regions already read
+import hashlib
+import sqlite3
+import time
+
+
+class OCRCache:
+    """
+    Maps a key built from the image bytes, the tesseract settings and the crop spec to the text tesseract extracted.
+    Stored in SQLite so that every OCR worker process can share it. Once the stored text grows past max_bytes, the
+    least recently used entries are evicted. The total size is kept in a one-row table, updated in the same transaction
+    as the entries, so checking it never sums the whole cache.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        """
+        :param path: the path to the cache file. It is created if it does not exist
+        :param max_bytes: the size the cached keys and text may grow to before entries are evicted
+        """
+        self.max_bytes = max_bytes
+        # Autocommit, and wait for other workers instead of failing when they are writing at the same time
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ocr_cache '
+                                '(key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, '
+                                'last_used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ocr_cache_stats '
+                                '(id INTEGER PRIMARY KEY, total INTEGER NOT NULL)')
+        # Caches made before the total was kept are summed once
+        self.connection.execute('INSERT OR IGNORE INTO ocr_cache_stats (id, total) '
+                                'SELECT 0, COALESCE(SUM(size), 0) FROM ocr_cache')
+
+    @staticmethod
+    def make_key(image, region: tuple, lang: str, config: str) -> str:
+        """
+        Build the key of a region's image.
+        :param image: the PIL image that would be sent to tesseract
+        :param region: the (left, top, right, bottom) crop spec the image was cut with
+        :param lang: the tesseract language
+        :param config: the tesseract config (e.g. --psm 6)
+        :return: a hex digest that changes if the pixels, the crop or the tesseract settings change
+        """
+        digest = hashlib.sha256()
+        digest.update(f'{image.mode}|{image.size}|{region}|{lang}|{config}|'.encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str or None:
+        """
+        Get the cached text for the key, or None if it has not been seen
+        """
+        row = self.connection.execute('SELECT text FROM ocr_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE ocr_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, text: str) -> None:
+        """
+        Cache the text for the key, then evict the least recently used entries if the cache is too big
+        """
+        size = len(key) + len(text.encode())
+        # Take the write lock first, so no other worker changes the total between reading and writing it
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute('SELECT size FROM ocr_cache WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO ocr_cache (key, text, size, last_used) VALUES (?, ?, ?, ?)',
+                                    (key, text, size, time.time()))
+            self.connection.execute('UPDATE ocr_cache_stats SET total = total + ? WHERE id = 0',
+                                    (size - (row[0] if row else 0),))
+            self.evict()
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used entries until the cache fits in max_bytes. Runs inside put's transaction
+        """
+        total = self.connection.execute('SELECT total FROM ocr_cache_stats WHERE id = 0').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Walk the entries from least to most recently used and delete them until enough space is freed
+        freed = 0
+        stale_keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM ocr_cache ORDER BY last_used'):
+            if total - freed <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            freed += size
+        self.connection.executemany('DELETE FROM ocr_cache WHERE key = ?', stale_keys)
+        self.connection.execute('UPDATE ocr_cache_stats SET total = total - ? WHERE id = 0', (freed,))
+
+    def clear(self) -> None:
+        """
+        Delete every entry in the cache
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('DELETE FROM ocr_cache')
+        self.connection.execute('UPDATE ocr_cache_stats SET total = 0 WHERE id = 0')
+        self.connection.execute('COMMIT')
+
+    def close(self) -> None:
+        self.connection.close()
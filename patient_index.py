@@ -0,0 +1,190 @@
+# Local index of the patients seen in search results, so that most pages can be matched without searching the website.
+# The patient population rarely changes, so every search result table is added to the index as it is seen, and a
+# roster exported from the website can be loaded into it up front.
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from matching import best_match, column_score, index_first_name_min, row_patient_id, split_name
+
+# Column of an exported roster that holds the patient's id on the website. The other columns are those of data.csv
+roster_id_column = 'Patient ID'
+
+soundex_codes = {c: str(code) for code, letters in enumerate(
+    ['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for c in letters}
+
+
+def soundex(name: str) -> str:
+    """
+    The soundex code of a name, so names that sound alike, or that OCR misread a vowel of, share a code
+    """
+    letters = re.sub(r'[^a-z]', '', name.lower())
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = soundex_codes[letters[0]]
+    for c in letters[1:]:
+        digit = soundex_codes[c]
+        if digit != '0' and digit != previous:
+            code += digit
+        if c not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+
+def name_key(name: str) -> str:
+    return re.sub(r'[^a-z]', '', str(name).lower())
+
+
+def digits_key(value: str) -> str:
+    return re.sub(r'\D', '', str(value))
+
+
+def trigrams(name: str) -> set:
+    """
+    The three-letter pieces of a name, padded so that its first and last letters count too
+    """
+    padded = f'  {name_key(name)} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PatientIndex:
+    """
+    Stores every patient row seen in the search results, keyed by normalized last name, date of birth and phone number,
+    with a soundex code and trigrams of the last name for names that OCR misread. Shared by every upload thread.
+    """
+
+    def __init__(self, path: str, max_candidates: int = 50):
+        """
+        :param path: the path to the index file. It is created if it does not exist
+        :param max_candidates: the most rows a lookup scores
+        """
+        self.max_candidates = max_candidates
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS patients '
+                                '(id TEXT PRIMARY KEY, row TEXT NOT NULL, last_name TEXT NOT NULL, '
+                                'soundex TEXT NOT NULL, dob TEXT NOT NULL, phone TEXT NOT NULL, seen REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS trigrams '
+                                '(trigram TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (trigram, id)) WITHOUT ROWID')
+        for column in ('last_name', 'soundex', 'dob', 'phone'):
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS patients_{column} ON patients ({column})')
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+
+    def add_rows(self, rows: list) -> None:
+        """
+        Add or refresh patients. Rows without an id are left out, since they could not be told apart
+        :param rows: rows laid out like the search results table, with the patient's id in column 1
+        """
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for row in rows:
+                    row = [str(x) for x in row]
+                    patient_id = row_patient_id(row)
+                    if patient_id is None:
+                        continue
+                    last, first = split_name(row[2])
+                    self.connection.execute('INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            (patient_id, json.dumps(row), name_key(last), soundex(last),
+                                             digits_key(row[3]), digits_key(row[5]), time.time()))
+                    self.connection.execute('DELETE FROM trigrams WHERE id = ?', (patient_id,))
+                    self.connection.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                                                [(gram, patient_id) for gram in trigrams(last)])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def add_table(self, table: pd.DataFrame) -> None:
+        """
+        Add the patients of a search results table
+        """
+        self.add_rows(table.values.tolist())
+
+    def add_roster(self, csv_path: str) -> int:
+        """
+        Add the patients of a roster exported from the website
+        :param csv_path: a csv with a roster_id_column and the columns of data.csv
+        :return: the number of patients added
+        """
+        roster = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+        self.add_rows([['', p[roster_id_column], f"{p['Last Name']}, {p['First Name']}", p['Date of Birth'], p['Sex'],
+                        p['Preferred Phone'], p['Address'], p['Provider']] for _, p in roster.iterrows()])
+        return len(roster)
+
+    def forget(self, patient_id) -> None:
+        """
+        Remove a patient, e.g. because the website no longer has them
+        """
+        with self.lock:
+            self.connection.execute('DELETE FROM patients WHERE id = ?', (str(patient_id),))
+            self.connection.execute('DELETE FROM trigrams WHERE id = ?', (str(patient_id),))
+
+    def candidates(self, patient: pd.Series, placeholders: set) -> pd.DataFrame or None:
+        """
+        Look up the patients that share a key with the page: the same last name, date of birth or phone number, a last
+        name that sounds the same, or the last names that share the most trigrams with it
+        :param patient: the row of the page in the dataframe
+        :param placeholders: the values that mean a column could not be read
+        :return: the patients laid out like the search results table, or None if there are none
+        """
+        keys = []
+        last = str(patient['Last Name'])
+        if last not in placeholders and name_key(last):
+            keys += [('last_name', name_key(last)), ('soundex', soundex(last))]
+        for column, key in (('Date of Birth', 'dob'), ('Preferred Phone', 'phone')):
+            if column in patient and str(patient[column]) not in placeholders and digits_key(patient[column]):
+                keys.append((key, digits_key(patient[column])))
+
+        with self.lock:
+            ids = set()
+            for column, value in keys:
+                ids.update(row[0] for row in self.connection.execute(
+                    f'SELECT id FROM patients WHERE {column} = ? LIMIT ?', (value, self.max_candidates)))
+            if last not in placeholders and name_key(last):
+                grams = sorted(trigrams(last))
+                # Last names sharing at least half of the page's trigrams, the most shared first
+                ids.update(row[0] for row in self.connection.execute(
+                    f'SELECT id FROM trigrams WHERE trigram IN ({", ".join("?" * len(grams))}) GROUP BY id '
+                    f'HAVING COUNT(*) * 2 >= ? ORDER BY COUNT(*) DESC LIMIT ?',
+                    grams + [len(grams), self.max_candidates]))
+            rows = [json.loads(row[0]) for row in self.connection.execute(
+                f'SELECT row FROM patients WHERE id IN ({", ".join("?" * len(ids))})', sorted(ids))] if ids else []
+
+        if not rows:
+            return None
+        return pd.DataFrame(rows)
+
+    def find(self, patient: pd.Series, file_type: str, placeholders: set) -> tuple or None:
+        """
+        Find the patient of a page in the index
+        :param patient: the row of the page in the dataframe
+        :param file_type: 'intake' or 'vf'
+        :param placeholders: the values that mean a column could not be read
+        :return: (table of candidates, index of the patient's row, its score), or None if no candidate matches
+        confidently, or the page's first name does not confirm the match, so the website has to be searched
+        """
+        table = self.candidates(patient, placeholders)
+        if table is None:
+            return None
+        match = best_match(patient, table, file_type, placeholders)
+        if match is None:
+            return None
+        # A sibling or twin with the same last name and date of birth scores high enough on its own, and may not be in
+        # the index to lose to the right patient by match_margin
+        first_name = column_score(patient, table.iloc[match[0]], 'First Name', placeholders)
+        if first_name is None or first_name < index_first_name_min:
+            return None
+        return table, match[0], match[1]
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,359 @@
+# Files a batch as a pipeline of stages that run at the same time, instead of reading every page before logging in and
+# uploading. Pages flow from OCR to extraction to filing through bounded queues, so the browser starts uploading the
+# first pages while the rest are still being read, and the batch takes about as long as its slowest stage.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from filing import BatchFiler
+from forms import form_templates, record_columns
+from ocr import create_ocr_pool, render_and_extract
+from prefilter import page_fingerprint
+from rasterize import page_sizes
+from timings import timed, run_timed, collect
+from validation import assemble_records
+
+stop = None  # Put on a queue to tell the stage reading it that no more pages are coming
+
+
+class PatientRouter:
+    """
+    Hands the extracted pages to the sessions, in page order, except that a page of a patient a session has open, or is
+    finding, is held back for that session. So all of a patient's pages are filed in the same visit, even when they are
+    not next to each other in the batch. At most size pages wait at once.
+    """
+
+    def __init__(self, size: int, sessions: int):
+        """
+        :param size: the most pages that wait at once
+        :param sessions: the number of sessions that take pages
+        """
+        self.size = size
+        self.sessions = sessions  # The sessions that have not stopped
+        self.pending = []  # (patient key, page index, patient) of the pages waiting to be filed, in page order
+        self.owners = {}  # Maps the key of the patient each session has open to the session's number
+        self.closed = False
+        self.changed = asyncio.Condition()
+
+    async def put(self, key, page_index: int, patient: pd.Series) -> None:
+        """
+        Add a page, waiting while size pages are already waiting. Once every session has stopped, the page is dropped
+        and left unfiled
+        :param key: the key the pages of the page's patient share, from BatchFiler.patient_key
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: len(self.pending) < self.size or not self.sessions)
+            if self.sessions:
+                self.pending.append((key, page_index, patient))
+                self.changed.notify_all()
+
+    async def close(self) -> None:
+        """
+        Tell the sessions no more pages are coming
+        """
+        async with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def next_for(self, number: int) -> tuple or None:
+        """
+        The first page of the patient the session has open, or else the first page of a patient no session has open
+        """
+        for item in self.pending:
+            if self.owners.get(item[0]) == number:
+                return item
+        for item in self.pending:
+            if item[0] not in self.owners:
+                return item
+        return None
+
+    async def take(self, number: int) -> tuple or None:
+        """
+        Take the next page for a session to file, and mark its patient as open in the session
+        :param number: the session's number
+        :return: (page index, patient), or None once there are no more pages for the session. The pages held back for
+        other sessions are left to them
+        """
+        async with self.changed:
+            while True:
+                item = self.next_for(number)
+                if item is not None:
+                    break
+                if self.closed and all(key in self.owners for key, _, _ in self.pending):
+                    self.release(number)
+                    return None
+                await self.changed.wait()
+            self.pending.remove(item)
+            # The session leaves the patient it had open for this page's patient
+            self.owners = {key: owner for key, owner in self.owners.items() if owner != number}
+            self.owners[item[0]] = number
+            self.changed.notify_all()
+            return item[1], item[2]
+
+    def release(self, number: int) -> None:
+        """
+        Let the other sessions take the pages held back for a session. Call with changed held
+        """
+        self.owners = {key: owner for key, owner in self.owners.items() if owner != number}
+        self.changed.notify_all()
+
+    async def stop(self, number: int) -> None:
+        """
+        Tell the router a session takes no more pages, e.g. because it could not log in. Its pages go to the other
+        sessions, and once none is left the waiting pages are dropped
+        """
+        async with self.changed:
+            self.sessions -= 1
+            if not self.sessions:
+                self.pending = []
+            self.release(number)
+
+
+class BatchPipeline:
+    """
+    Reads and files one batch with three stages, connected by queues of at most queue_size pages:
+        OCR: renders and reads the regions of each page in a pool of processes, several pages at a time
+        extract: turns the text of each page into the patient's information
+        file: finds each page's patient and uploads the page, in every session at once. The pages of a patient that is
+            open in a session are held back for it by a PatientRouter
+    The sessions are opened and logged in while the first pages are being read.
+    """
+
+    def __init__(self, batch_path: str, form_type: str, batch_number: int, journal, null_date: str,
+                 null_phone_number: str, queue_size: int = 8, page_filter=None, adaptive: bool = False,
+                 **filer_options):
+        """
+        :param batch_path: the path to the batch pdf
+        :param form_type: 'intake' or 'vf'
+        :param batch_number: the number of the batch
+        :param journal: the BatchJournal of the batch
+        :param null_date: the date that means a date could not be read
+        :param null_phone_number: the phone number that means the phone number could not be read
+        :param queue_size: the most pages waiting between two stages
+        :param page_filter: the PageFilter that skips blank and duplicate pages before they are read, or None to read
+        every page
+        :param adaptive: read again the fields that are missing or were read with low confidence, see adaptive_ocr.py
+        :param filer_options: passed on to BatchFiler, e.g. matcher and patient_index
+        """
+        self.batch_path = batch_path
+        self.template = form_templates[form_type]
+        self.journal = journal
+        self.null_date = null_date
+        self.null_phone_number = null_phone_number
+        self.queue_size = queue_size
+        self.page_filter = page_filter
+        self.fields = self.template.region_fields if adaptive else {name: None for name in self.template.regions}
+        self.filer = BatchFiler(form_type, batch_number, batch_path, journal, null_date, null_phone_number,
+                                **filer_options)
+        self.records = {}  # Maps every page index to its PatientRecord
+        self.fixes = {}  # The number of values validation replaced in each column
+        self.results = {}
+        self.start = None
+        self.first_upload = None
+
+    async def ocr_stage(self, ocr_pool, page_indexes: list, extract_queue: asyncio.Queue) -> None:
+        """
+        Read the regions of the pages, as many at once as fit in the queue. Pages the journal has the text of are
+        not read again. The other pages are checked by the page filter first, in page order, and only the ones it
+        keeps are read. The ones that look like a duplicate are only skipped once their text is the same as the page
+        they look like
+        """
+        loop = asyncio.get_running_loop()
+        sizes = await loop.run_in_executor(None, page_sizes, self.batch_path, max(page_indexes) + 1)
+        in_flight = asyncio.Semaphore(self.queue_size)
+        # Set once the page's text is in the journal, so the pages that look like it can be compared with it
+        read = {page_index: asyncio.Event() for page_index in page_indexes}
+
+        async def read_page(page_index: int) -> None:
+            async with in_flight:
+                try:
+                    entry = self.journal.get(page_index, 'ocr')
+                    if entry is not None:
+                        regions = entry['regions']
+                    else:
+                        names = list(self.template.regions)
+                        results = await asyncio.gather(*[loop.run_in_executor(
+                            ocr_pool, run_timed, render_and_extract,
+                            (self.batch_path, page_index, self.template.regions[name], self.template.dpi,
+                             sizes[page_index], self.fields[name])) for name in names])
+                        regions = dict(zip(names, [collect(result) for result in results]))
+                        self.journal.record(page_index, 'ocr', regions=regions)
+                finally:
+                    read[page_index].set()
+                if self.page_filter is not None and page_index in self.page_filter.suspects:
+                    # The page it looks like comes earlier, so it was handed to the pool first
+                    batch_number, original_index = self.page_filter.suspects[page_index][:2]
+                    if batch_number == self.journal.batch_number and original_index in read:
+                        await read[original_index].wait()
+                    if self.page_filter.confirm(page_index, regions):
+                        return
+                # Waits while the extract stage is behind
+                await extract_queue.put((page_index, regions))
+
+        # The checks are cheap, so they are all handed to the pool before the pages they keep are read
+        checks = {}
+        if self.page_filter is not None:
+            checks = {page_index: loop.run_in_executor(
+                ocr_pool, run_timed, page_fingerprint,
+                self.page_filter.task(self.batch_path, page_index, sizes[page_index]))
+                for page_index in page_indexes if self.journal.get(page_index, 'ocr') is None}
+        reads = []
+        for page_index in page_indexes:
+            if page_index in checks and self.page_filter.check(page_index, collect(await checks[page_index])):
+                continue
+            reads.append(asyncio.ensure_future(read_page(page_index)))
+        await asyncio.gather(*reads)
+        await extract_queue.put(stop)
+
+    async def extract_stage(self, extract_queue: asyncio.Queue, router: PatientRouter) -> None:
+        """
+        Turn the text of each page into the patient's information, validate it, and hand it to the sessions. The pages
+        that are waiting in the queue are validated together, a column at a time, as read_batch validates a whole batch
+        """
+        done = False
+        while not done:
+            items = [await extract_queue.get()]
+            while not extract_queue.empty():
+                items.append(extract_queue.get_nowait())
+            if items[-1] is stop:
+                items.pop()
+                done = True
+            if not items:
+                continue
+            records = []
+            for page_index, regions in items:
+                with timed('extract'):
+                    records.append(self.template.extract(regions, self.null_date, self.null_phone_number))
+            df, fixes = assemble_records(records, self.null_date, self.null_phone_number)
+            for column, count in fixes.items():
+                self.fixes[column] = self.fixes.get(column, 0) + count
+            for (page_index, regions), (_, patient) in zip(items, df.iterrows()):
+                self.records[page_index] = tuple(patient)
+                await router.put(self.filer.patient_key(page_index, patient), page_index, patient)
+        await router.close()
+
+    async def file_stage(self, number: int, session_future, router: PatientRouter,
+                         executor: ThreadPoolExecutor) -> None:
+        """
+        Find the patient of each page and upload it through one session. The session's calls block, so they run in
+        a thread. The router holds the other pages of the patient the session has open back for it, and they are
+        uploaded without searching again
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            session = await session_future
+        except Exception as e:
+            # The other sessions take this session's share of the pages
+            print(f"Session {number + 1}: could not log in: {e!r}")
+            await router.stop(number)
+            return
+        matched_row = None  # The patient that is open in the session
+        try:
+            while True:
+                item = await router.take(number)
+                if item is None:
+                    break
+                page_index, patient = item
+                if self.first_upload is None:
+                    self.first_upload = time.perf_counter()
+                self.results[page_index], matched_row = await loop.run_in_executor(
+                    executor, self.filer.file_session_page, session, page_index, patient, matched_row)
+        finally:
+            await router.stop(number)
+            await loop.run_in_executor(executor, session.close)
+
+    async def run(self, page_indexes: list, sessions: int, open_session, ocr_workers: int, cache_path: str or None,
+                  cache_max_bytes: int) -> dict:
+        """
+        File the given pages of the batch
+        :param page_indexes: the 0-indexed pages to file
+        :param sessions: the number of sessions to file with at the same time
+        :param open_session: a function that opens a new logged-in session
+        :param ocr_workers: the number of OCR processes
+        :param cache_path: the path to the OCR cache, or None to always run tesseract
+        :param cache_max_bytes: the size the OCR cache may grow to
+        :return: maps each page index to True if it was uploaded, False if the patient was not found, or None if an
+        error stopped the page from being filed, including pages no session could log in to file
+        """
+        self.start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        page_indexes = sorted(page_indexes)
+        if not page_indexes:
+            return {}
+        sessions = min(sessions, len(page_indexes))
+        extract_queue = asyncio.Queue(self.queue_size)
+        router = PatientRouter(self.queue_size, sessions)
+
+        # OCR never runs in the event loop's process, so that it cannot hold up the other stages
+        ocr_pool = create_ocr_pool(ocr_workers, cache_path, cache_max_bytes, in_process=False)
+        with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix='session') as executor:
+            try:
+                # Start logging in straight away, while the first pages are read
+                session_futures = [loop.run_in_executor(executor, open_session) for _ in range(sessions)]
+                stages = [asyncio.ensure_future(stage) for stage in [
+                    self.ocr_stage(ocr_pool, page_indexes, extract_queue),
+                    self.extract_stage(extract_queue, router),
+                    *[self.file_stage(number, session_future, router, executor)
+                      for number, session_future in enumerate(session_futures)]]]
+                try:
+                    await asyncio.gather(*stages)
+                except BaseException:
+                    # Stop the other stages, so none of them waits forever on a queue the failed stage fed, and
+                    # let the sessions close before the executor shuts down
+                    for stage in stages:
+                        stage.cancel()
+                    await asyncio.gather(*stages, return_exceptions=True)
+                    raise
+            finally:
+                ocr_pool.shutdown()
+
+        # Pages that were read but never filed were left because no session could log in. Leave them out of the
+        # journal so that --resume tries them again
+        unfiled = [page_index for page_index in self.records if page_index not in self.results]
+        if unfiled:
+            print(f"{len(unfiled)} pages were not filed because no session could log in: "
+                  f"{', '.join(str(page_index + 1) for page_index in sorted(unfiled))}")
+            self.results.update(dict.fromkeys(unfiled))
+        if any(self.fixes.values()):
+            print("Replaced values that cannot be right: " + ", ".join(
+                f"{column} {count}" for column, count in self.fixes.items() if count))
+        if self.first_upload is not None:
+            print(f"First page started filing {self.first_upload - self.start:.1f}s after starting, "
+                  f"batch filed in {time.perf_counter() - self.start:.1f}s")
+        return self.results
+
+    def dataframe(self) -> pd.DataFrame:
+        """
+        The information of every page that went through the pipeline, in page order
+        """
+        return pd.DataFrame([self.records[i] for i in sorted(self.records)], index=sorted(self.records),
+                            columns=record_columns)
+
+
+def run_batch(batch_path: str, form_type: str, batch_number: int, journal, pending_pages: set, error_patients: list,
+              sessions: int, open_session, null_date: str, null_phone_number: str, ocr_workers: int,
+              cache_path: str or None, cache_max_bytes: int, page_filter=None, adaptive: bool = False,
+              **filer_options) -> pd.DataFrame:
+    """
+    File the pending pages of a batch through the pipeline, then add the pages the page filter skipped to the skipped
+    csv. The patients that could not be found are recorded in the error ledger, if filer_options has one, as they happen
+    :param error_patients: the error rows of pages that were already completed, which are recorded in the error ledger
+    too in case the run that completed them stopped first
+    :param adaptive: read again the fields that are missing or were read with low confidence, see adaptive_ocr.py
+    :return: the information of every page that went through the pipeline
+    """
+    error_ledger = filer_options.get('error_ledger')
+    if error_ledger is not None:
+        for error_patient in error_patients:
+            error_ledger.record(form_type, error_patient, batch_path)
+
+    pipeline = BatchPipeline(batch_path, form_type, batch_number, journal, null_date, null_phone_number,
+                             page_filter=page_filter, adaptive=adaptive, **filer_options)
+    try:
+        asyncio.run(pipeline.run(pending_pages, sessions, open_session, ocr_workers, cache_path, cache_max_bytes))
+    finally:
+        if page_filter is not None:
+            page_filter.report(f'skipped_{form_type}.csv')
+    return pipeline.dataframe()
@@ -0,0 +1,300 @@
+# Cheap checks on a small render of every page, made before the page is read, so that blank separator sheets, blank
+# back sides and pages scanned twice never go through the search for their patient. Pages with almost no ink are blank,
+# and are not read at all. Pages whose regions look the same as those of a page earlier in the batch, or of a page of an
+# earlier batch, may be duplicates: the small render cannot tell two patients' filled in forms apart for certain, so
+# they are still read, and only skipped if their text is the same as the other page's. Every skipped page is recorded
+# in the journal and written to a csv, so none is lost silently.
+import sqlite3
+import threading
+from csv import writer
+from itertools import repeat
+
+from PIL import Image
+
+from forms import form_templates
+from journal import BatchJournal
+from ocr import crop_region
+from rasterize import render_region
+from timings import run_timed, collect
+
+# Define prefilter settings
+thumbnail_dpi = 40  # The resolution pages are rendered at to be checked
+ink_level = 128  # Pixels darker than this are ink
+blank_max_ink = 0.003  # Pages with less than this fraction of ink are blank. Scanner specks stay well below it
+margin = 0.05  # Fraction of each edge of the page left out of the ink count, where scanners leave shadows
+hash_size = 16  # Each region of the template is hashed into hash_size * hash_size bits
+duplicate_max_distance = 0.03  # Pages whose hashes differ in at most this fraction of bits are the same page
+duplicate_max_ink_change = 0.1  # ...and whose amount of ink differs by at most this fraction
+band_min_bits = 0.125  # Bands with fewer than this fraction of their bits set, or unset, are left out of the index
+
+skipped_csv_lock = threading.Lock()
+
+
+def ink_density(image) -> float:
+    """
+    The fraction of the pixels of a grayscale image, inside the margins, that are ink
+    """
+    inside = crop_region(image, (margin, margin, 1 - margin, 1 - margin))
+    histogram = inside.histogram()
+    return sum(histogram[:ink_level]) / max(1, sum(histogram))
+
+
+def difference_hash(image) -> int:
+    """
+    Hash an image by whether each pixel of a small copy of it is brighter than the pixel to its right. Images that look
+    alike, e.g. the same page scanned twice, have hashes that differ in few bits
+    """
+    small = image.resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def page_fingerprint(task: tuple) -> tuple:
+    """
+    Render a page at a low resolution, and measure its ink and hash its regions. Runs in the OCR workers
+    :param task: (path, page_index, page_size, regions), where regions maps each region's name to its crop spec
+    :return: (fraction of the page that is ink, hash of the page's regions)
+    """
+    path, page_index, page_size, regions = task
+    page = render_region(path, page_index, (0, 0, 1, 1), thumbnail_dpi, page_size)
+    page_hash = 0
+    for name in sorted(regions):
+        page_hash = page_hash << hash_size * hash_size | difference_hash(crop_region(page, regions[name]))
+    return ink_density(page), page_hash
+
+
+def hash_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class PageHashes:
+    """
+    Remembers the hash of every page of every batch that was kept, so a page scanned again into a later batch is
+    recognized. Hashes are split into bands, one more than the number of bits two copies of a page may differ in, so
+    two copies share at least one band and only the pages that share a band have to be compared. Bands with almost
+    every bit the same, like the all-zero bands of blank areas, are shared by nearly every page, so they are left out.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the path to the database. It is created if it does not exist
+        """
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS page_hashes '
+                                '(file_type TEXT NOT NULL, batch INTEGER NOT NULL, page INTEGER NOT NULL, '
+                                'hash TEXT NOT NULL, ink REAL NOT NULL, PRIMARY KEY (file_type, batch, page))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS page_hash_bands '
+                                '(file_type TEXT NOT NULL, band INTEGER NOT NULL, value INTEGER NOT NULL, '
+                                'batch INTEGER NOT NULL, page INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS page_hash_bands_value '
+                                'ON page_hash_bands (file_type, band, value)')
+
+    @staticmethod
+    def bands(page_hash: int, bits: int) -> list:
+        """
+        Split a hash of the given number of bits into its bands, leaving out the ones with too few bits set or unset
+        :return: (band number, value) of every band that is kept
+        """
+        count = int(bits * duplicate_max_distance) + 1
+        width = bits // count
+        least = int(width * band_min_bits)
+        values = [page_hash >> (i * width) & ((1 << width) - 1) for i in range(count)]
+        return [(band, value) for band, value in enumerate(values) if least <= bin(value).count('1') <= width - least]
+
+    def find(self, file_type: str, batch_number: int, page_hash: int, ink: float, bits: int) -> tuple or None:
+        """
+        Find a page of another batch that looks the same
+        :return: (batch number, page index) of the page, or None if there is none
+        """
+        bands = self.bands(page_hash, bits)
+        if not bands:
+            return None
+        # Every page sharing a band is fetched with its hash in one query
+        shares_band = ' OR '.join(['(b.band = ? AND b.value = ?)'] * len(bands))
+        rows = self.connection.execute(
+            'SELECT DISTINCT h.batch, h.page, h.hash, h.ink FROM page_hash_bands b JOIN page_hashes h '
+            'ON h.file_type = b.file_type AND h.batch = b.batch AND h.page = b.page '
+            f'WHERE b.file_type = ? AND b.batch != ? AND ({shares_band}) ORDER BY h.batch, h.page',
+            [file_type, batch_number] + [number for band in bands for number in band]).fetchall()
+        for batch, page, stored_hash, stored_ink in rows:
+            if is_duplicate(page_hash, ink, int(stored_hash, 16), stored_ink, bits):
+                return batch, page
+        return None
+
+    def add(self, file_type: str, batch_number: int, page_index: int, page_hash: int, ink: float, bits: int) -> None:
+        """
+        Remember the hash of a page, replacing what was remembered for it from an earlier run of its batch
+        """
+        self.connection.execute('BEGIN')
+        try:
+            self.connection.execute('DELETE FROM page_hash_bands WHERE file_type = ? AND batch = ? AND page = ?',
+                                    (file_type, batch_number, page_index))
+            self.connection.execute('INSERT OR REPLACE INTO page_hashes (file_type, batch, page, hash, ink) '
+                                    'VALUES (?, ?, ?, ?, ?)',
+                                    (file_type, batch_number, page_index, format(page_hash, 'x'), ink))
+            self.connection.executemany('INSERT INTO page_hash_bands (file_type, band, value, batch, page) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        [(file_type, band, value, batch_number, page_index)
+                                         for band, value in self.bands(page_hash, bits)])
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def is_duplicate(hash_a: int, ink_a: float, hash_b: int, ink_b: float, bits: int) -> bool:
+    """
+    Check if two pages are the same page, by their hashes and how much ink they have
+    """
+    if abs(ink_a - ink_b) > duplicate_max_ink_change * max(ink_a, ink_b):
+        return False
+    return hash_distance(hash_a, hash_b) <= bits * duplicate_max_distance
+
+
+def same_text(regions_a: dict, regions_b: dict) -> bool:
+    """
+    Check if two pages' regions were read as the same text, ignoring how the words are spaced
+    """
+    texts_a = {name: ' '.join(str(text).split()) for name, text in regions_a.items()}
+    texts_b = {name: ' '.join(str(text).split()) for name, text in regions_b.items()}
+    return texts_a == texts_b and any(texts_a.values())
+
+
+class PageFilter:
+    """
+    Decides which pages of one batch are skipped, in page order, so the first copy of a page is the one that is filed.
+    Blank pages are skipped before they are read. Pages that look like a duplicate are read, and only skipped once
+    confirm finds their text is the same as that of the page they look like
+    """
+
+    def __init__(self, journal, page_hashes: PageHashes = None):
+        """
+        :param journal: the BatchJournal of the batch. Skipped pages are recorded in it, and count as completed
+        :param page_hashes: the hashes of the pages of earlier batches, or None to only look for duplicates in the batch
+        """
+        self.journal = journal
+        self.page_hashes = page_hashes
+        self.regions = form_templates[journal.file_type].regions
+        self.bits = hash_size * hash_size * len(self.regions)
+        self.kept = []  # (page index, ink, hash) of the pages of the batch that were not skipped
+        self.skipped = {}  # Maps the index of every skipped page to its row of the skipped csv
+        # Maps the index of every page that looks like a duplicate to (batch number, 0-indexed page of the page it looks
+        # like, ink, hash), until confirm decides whether it is one
+        self.suspects = {}
+
+    def task(self, path: str, page_index: int, page_size: tuple) -> tuple:
+        """
+        The task that page_fingerprint takes for a page
+        """
+        return path, page_index, page_size, self.regions
+
+    def check(self, page_index: int, fingerprint: tuple) -> str or None:
+        """
+        Decide whether to skip a page before it is read. Pages must be checked in page order
+        :param page_index: the 0-indexed page of the batch
+        :param fingerprint: what page_fingerprint returned for the page
+        :return: why the page is skipped, or None if it is to be read. Pages that look like a duplicate are read, and
+        added to suspects for confirm to decide on
+        """
+        ink, page_hash = fingerprint
+        if ink < blank_max_ink:
+            self.skip(page_index, 'blank', None, ink)
+            return 'blank'
+
+        for kept_index, kept_ink, kept_hash in self.kept:
+            if is_duplicate(page_hash, ink, kept_hash, kept_ink, self.bits):
+                self.suspects[page_index] = (self.journal.batch_number, kept_index, ink, page_hash)
+                return None
+        if self.page_hashes is not None:
+            found = self.page_hashes.find(self.journal.file_type, self.journal.batch_number, page_hash, ink, self.bits)
+            if found is not None:
+                self.suspects[page_index] = (found[0], found[1], ink, page_hash)
+                return None
+        self.keep(page_index, ink, page_hash)
+        return None
+
+    def keep(self, page_index: int, ink: float, page_hash: int) -> None:
+        """
+        Remember a page that is filed, so later copies of it are recognized
+        """
+        self.kept.append((page_index, ink, page_hash))
+        if self.page_hashes is not None:
+            self.page_hashes.add(self.journal.file_type, self.journal.batch_number, page_index, page_hash, ink,
+                                 self.bits)
+
+    def skip(self, page_index: int, reason: str, duplicate_of: list or None, ink: float) -> None:
+        self.skipped[page_index] = [str(self.journal.batch_number), str(page_index + 1), reason]
+        self.journal.record(page_index, 'skipped', reason=reason, duplicate_of=duplicate_of, ink=ink)
+
+    def original_regions(self, page_index: int) -> dict or None:
+        """
+        The text of the page a suspected duplicate looks like, from its batch's journal
+        :return: maps each region name to its text, or None if the page was never read
+        """
+        batch_number, original_index = self.suspects[page_index][:2]
+        journal = self.journal
+        if batch_number != journal.batch_number:
+            journal = BatchJournal(journal.folder, journal.file_type, batch_number)
+        entry = journal.get(original_index, 'ocr')
+        return None if entry is None else entry['regions']
+
+    def confirm(self, page_index: int, regions: dict) -> str or None:
+        """
+        Decide whether a page that looked like a duplicate is one, once it has been read. It is only skipped if its text
+        is the same as the page it looks like. Otherwise it is kept like any other page. The page it looks like must
+        have been read first
+        :param page_index: a page in suspects
+        :param regions: the text of the page's regions
+        :return: why the page is skipped, or None if it is to be filed
+        """
+        original = self.original_regions(page_index)
+        batch_number, original_index, ink, page_hash = self.suspects.pop(page_index)
+        if original is None or not same_text(regions, original):
+            self.keep(page_index, ink, page_hash)
+            return None
+        if batch_number == self.journal.batch_number:
+            reason = f'duplicate of page {original_index + 1}'
+        else:
+            reason = f'duplicate of batch {batch_number} page {original_index + 1}'
+        self.skip(page_index, reason, [batch_number, original_index + 1], ink)
+        return reason
+
+    def filter_pages(self, path: str, sizes: list, page_indexes: list, pool=None) -> list:
+        """
+        Check the given pages, rendering them in the OCR pool
+        :param path: the path to the batch pdf
+        :param sizes: the size of every page in points, from page_sizes
+        :param page_indexes: the 0-indexed pages to check
+        :param pool: the pool created by create_ocr_pool, or None to render them in this process
+        :return: the pages that are to be read, in page order. The ones in suspects have to be confirmed once read
+        """
+        tasks = [self.task(path, page_index, sizes[page_index]) for page_index in sorted(page_indexes)]
+        if pool is None:
+            fingerprints = [page_fingerprint(task) for task in tasks]
+        else:
+            fingerprints = [collect(result) for result in pool.map(run_timed, repeat(page_fingerprint), tasks)]
+        return [task[1] for task, fingerprint in zip(tasks, fingerprints) if self.check(task[1], fingerprint) is None]
+
+    def report(self, csv_path: str) -> None:
+        """
+        Print the skipped pages and add them to the csv of skipped pages, as [batch number, page number, reason]
+        """
+        if not self.skipped:
+            return
+        print(f"Skipped {len(self.skipped)} pages: " + ", ".join(
+            f"{index + 1} ({row[2]})" for index, row in sorted(self.skipped.items())))
+        with skipped_csv_lock:
+            with open(csv_path, 'a', newline='') as file:
+                writer_object = writer(file)
+                for index in sorted(self.skipped):
+                    writer_object.writerow(self.skipped[index])
@@ -0,0 +1,99 @@
+# Helpers that render a batch pdf without rasterizing the whole thing into memory at once
+import re
+import subprocess
+from io import BytesIO
+
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from timings import timed
+
+
+def count_pages(path: str) -> int:
+    """
+    Count the pages of a pdf without rendering it
+    """
+    return int(pdfinfo_from_path(path)['Pages'])
+
+
+def iter_page_chunks(path: str, chunk_size: int, num_pages: int = None, **kwargs):
+    """
+    Render the pages of a pdf in chunks so that only chunk_size page images are in memory at a time.
+    :param path: the path to the pdf
+    :param chunk_size: the number of pages rendered at once
+    :param num_pages: the number of pages in the pdf, if it is already known
+    :param kwargs: passed on to convert_from_path (e.g. dpi, grayscale)
+    :return: yields (index of the first page in the chunk, list of page images)
+    """
+    if num_pages is None:
+        num_pages = count_pages(path)
+    for first_page in range(1, num_pages + 1, chunk_size):
+        last_page = min(first_page + chunk_size - 1, num_pages)  # first_page and last_page are 1-indexed and inclusive
+        with timed('render', pages=last_page - first_page + 1):
+            pages = convert_from_path(path, first_page=first_page, last_page=last_page, **kwargs)
+        yield first_page - 1, pages
+
+
+def extract_page(path: str, page_index: int, output_path: str) -> None:
+    """
+    Copy a single page out of a pdf into its own pdf. The page is copied as-is, so it is not rasterized again.
+    Uses pdfseparate, which ships with poppler alongside the pdftoppm that pdf2image needs.
+    :param path: the path to the source pdf
+    :param page_index: the 0-indexed page to copy
+    :param output_path: where to write the single page pdf
+    """
+    page_number = str(page_index + 1)
+    subprocess.run(['pdfseparate', '-f', page_number, '-l', page_number, path, output_path],
+                   check=True, capture_output=True)
+
+
+def page_sizes(path: str, num_pages: int = None) -> list:
+    """
+    Get the size of every page of a pdf as it is rendered, taking the page's rotation into account.
+    :param path: the path to the pdf
+    :param num_pages: the number of pages in the pdf, if it is already known
+    :return: a list of (width, height) in points (1/72 of an inch), in page order
+    """
+    if num_pages is None:
+        num_pages = count_pages(path)
+    output = subprocess.run(['pdfinfo', '-f', '1', '-l', str(num_pages), path],
+                            check=True, capture_output=True, text=True).stdout
+
+    # pdfinfo prints lines like "Page    1 size: 612 x 792 pts (letter)" and "Page    1 rot:  90"
+    sizes = {int(n): (float(w), float(h)) for n, w, h in
+             re.findall(r'Page\s+(\d+)\s+size:\s+([\d.]+)\s+x\s+([\d.]+)', output)}
+    rotations = {int(n): int(r) for n, r in re.findall(r'Page\s+(\d+)\s+rot:\s+(\d+)', output)}
+    for n, rotation in rotations.items():
+        if rotation % 180 == 90:
+            sizes[n] = sizes[n][::-1]  # The page is rendered sideways, so the width and height swap
+    return [sizes[n] for n in range(1, num_pages + 1)]
+
+
+def render_region(path: str, page_index: int, region: tuple, dpi: int, page_size: tuple, grayscale: bool = True):
+    """
+    Render only one region of a page. pdftoppm crops while it renders, so the rest of the page is never rasterized.
+    :param path: the path to the pdf
+    :param page_index: the 0-indexed page to render
+    :param region: (left, top, right, bottom) as fractions of the page's width and height
+    :param dpi: the resolution to render at
+    :param page_size: the (width, height) of the page in points, from page_sizes
+    :param grayscale: render a single gray channel instead of rgb
+    :return: the PIL image of the region
+    """
+    # Convert the fractions of the page into pixels at the requested resolution
+    width = page_size[0] * dpi / 72
+    height = page_size[1] * dpi / 72
+    left, top, right, bottom = region
+    x, y = round(width * left), round(height * top)
+    w, h = round(width * right) - x, round(height * bottom) - y
+
+    page_number = str(page_index + 1)
+    command = ['pdftoppm', '-f', page_number, '-l', page_number, '-r', str(dpi),
+               '-x', str(x), '-y', str(y), '-W', str(w), '-H', str(h), '-singlefile']
+    if grayscale:
+        command.append('-gray')
+    command.append(path)  # No output root is given, so pdftoppm writes the image to stdout
+
+    with timed('render', pages=1):
+        output = subprocess.run(command, check=True, capture_output=True).stdout
+    return Image.open(BytesIO(output))
@@ -0,0 +1,126 @@
+# Times the hot paths of a batch: rendering, OCR, reading fields again, extraction, every wait for the website, every search and parsing its
+# results, and uploads. Every timed call records a sample, and at the end of a batch the p50, p95 and max latency of
+# each stage are printed and appended to a JSON lines file, so runs can be compared with each other.
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Every timed call appends {'stage', 'seconds', ...} here. Waits also record 'retries' and 'timed_out'
+samples = []
+_lock = threading.Lock()
+
+# The stages that read a batch, and the ones that file it, so a batch being read can be told apart from one being filed
+reading_stages = ('render', 'ocr', 'reread', 'extract')
+filing_stages = ('wait', 'search', 'read_html', 'upload')
+
+
+def record(stage: str, seconds: float, **fields) -> None:
+    """
+    Record how long one call of a stage took
+    :param stage: the name of the stage, e.g. 'ocr' or 'search: Last Name + Date of Birth'
+    :param seconds: how long the call took
+    :param fields: anything else worth knowing about the call, e.g. retries=2
+    """
+    with _lock:
+        samples.append({'stage': stage, 'seconds': seconds, **fields})
+
+
+@contextmanager
+def timed(stage: str, **fields):
+    """
+    Time the body of a with statement as one call of a stage. The sample is recorded even if the body raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **fields)
+
+
+def take_samples(stages: tuple = None) -> list:
+    """
+    Remove the samples recorded so far and return them
+    :param stages: only take the samples of these stages, or the stages that start with them. Defaults to every stage
+    """
+    with _lock:
+        if stages is None:
+            taken = samples[:]
+        else:
+            taken = [sample for sample in samples if sample['stage'].startswith(stages)]
+        taken_ids = {id(sample) for sample in taken}
+        samples[:] = [sample for sample in samples if id(sample) not in taken_ids]
+    return taken
+
+
+def run_timed(function, *args):
+    """
+    Call a function in a worker process, and return its result along with the samples it recorded there. Pass what
+    it returns to collect in the main process
+    """
+    result = function(*args)
+    return result, take_samples()
+
+
+def collect(timed_result):
+    """
+    Add the samples a worker process recorded through run_timed to this process's samples
+    :return: the result of the function
+    """
+    result, worker_samples = timed_result
+    with _lock:
+        samples.extend(worker_samples)
+    return result
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    The value q percent of the values are at or below, by the nearest-rank method
+    :param values: the values, sorted
+    """
+    rank = max(0, min(len(values) - 1, int(len(values) * q / 100 + 0.5) - 1))
+    return values[rank]
+
+
+def summarize(batch_samples: list) -> list:
+    """
+    Summarize the samples of each stage
+    :return: one dict per stage, slowest stage in total first, with its count, total, p50, p95 and max seconds, and the
+    number of retries and timeouts of waits
+    """
+    stages = {}
+    for sample in batch_samples:
+        stages.setdefault(sample['stage'], []).append(sample)
+    summaries = []
+    for stage, stage_samples in stages.items():
+        seconds = sorted(sample['seconds'] for sample in stage_samples)
+        summaries.append({'stage': stage, 'count': len(seconds), 'total': sum(seconds),
+                          'p50': percentile(seconds, 50), 'p95': percentile(seconds, 95), 'max': seconds[-1],
+                          'retries': sum(sample.get('retries', 0) for sample in stage_samples),
+                          'timeouts': sum(bool(sample.get('timed_out')) for sample in stage_samples)})
+    return sorted(summaries, key=lambda summary: -summary['total'])
+
+
+def print_timing_report(batch_samples: list) -> None:
+    """
+    Print how many times each stage ran, its total time and its p50, p95 and max latency
+    """
+    print(f"{'stage':<40} {'count':>6} {'total s':>8} {'p50 s':>7} {'p95 s':>7} {'max s':>7} {'retries':>7} "
+          f"{'timeouts':>8}")
+    for summary in summarize(batch_samples):
+        print(f"{summary['stage']:<40} {summary['count']:>6} {summary['total']:>8.2f} {summary['p50']:>7.3f} "
+              f"{summary['p95']:>7.3f} {summary['max']:>7.3f} {summary['retries']:>7} {summary['timeouts']:>8}")
+
+
+def write_timing_log(path: str, batch_samples: list, form_type: str, batch_number: int) -> None:
+    """
+    Append the summary of every stage of a batch to a JSON lines file, one line per stage
+    :param path: the path to the file
+    :param batch_samples: the samples of the batch
+    :param form_type: 'intake' or 'vf'
+    :param batch_number: the number of the batch
+    """
+    finished = time.time()
+    with open(path, 'a') as file:
+        for summary in summarize(batch_samples):
+            file.write(json.dumps({'time': finished, 'form_type': form_type, 'batch': batch_number, **summary}) + '\n')
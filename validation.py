@@ -0,0 +1,71 @@
+# Builds the dataframe of a batch from the records of all its pages at once, and checks and fixes up its columns
+# together instead of one page at a time.
+import datetime
+
+import pandas as pd
+
+from forms import record_columns
+
+date_columns = ['Date of Birth', 'Document Date', 'Screening Date']
+text_columns = ['First Name', 'Last Name', 'Sex', 'Address', 'Provider']
+
+
+def assemble_records(records: list, null_date: str, null_phone_number: str) -> tuple:
+    """
+    Build the dataframe of a batch from its records and validate it
+    :param records: the PatientRecord of every page, in page order
+    :param null_date: the date that means a date could not be read
+    :param null_phone_number: the phone number that means the phone number could not be read
+    :return: the dataframe, and the number of values validation replaced in each column
+    """
+    df = pd.DataFrame.from_records(records, columns=record_columns)
+    fixes = validate_records(df, null_date, null_phone_number)
+    return df, fixes
+
+
+def validate_records(df: pd.DataFrame, null_date: str, null_phone_number: str) -> dict:
+    """
+    Replace the values that cannot be right with the placeholder of their column, in place:
+    dates of birth and screening dates that are not real dates, and dates before 1900 or in the future, phone numbers
+    without exactly 10 digits, empty text, and document dates that are the same as the date of birth
+    :param df: the dataframe of the batch
+    :param null_date: the date that means a date could not be read
+    :param null_phone_number: the phone number that means the phone number could not be read
+    :return: the number of values replaced in each column
+    """
+    fixes = {}
+    today = pd.Timestamp(datetime.date.today())
+
+    # Tesseract sometimes reads the date of birth again at the bottom of the page
+    same_as_dob = (df['Document Date'] == df['Date of Birth']) & (df['Document Date'] != null_date)
+    df.loc[same_as_dob, 'Document Date'] = null_date
+    fixes['Document Date'] = int(same_as_dob.sum())
+
+    for column in date_columns:
+        dates = pd.to_datetime(df[column], format='%m/%d/%Y', errors='coerce')
+        years = pd.to_numeric(df[column].astype(str).str[-4:], errors='coerce')
+        if column == 'Document Date':
+            # The document date only names the file, which copes with a misread month or day, so keep its year
+            invalid = years.isna() | (years < 1900) | (years > today.year)
+        else:
+            invalid = dates.isna() | (dates.dt.year < 1900) | (dates > today)
+        invalid &= df[column] != null_date
+        df.loc[invalid, column] = null_date
+        fixes[column] = fixes.get(column, 0) + int(invalid.sum())
+
+    # Phone numbers are written the way the website shows them, and ones without 10 digits are misreads
+    digits = df['Preferred Phone'].astype(str).str.replace(r'\D', '', regex=True)
+    valid = digits.str.len() == 10
+    formatted = '(' + digits.str[:3] + ') ' + digits.str[3:6] + '-' + digits.str[6:]
+    no_phone = df['Preferred Phone'] == '***'  # Forms without a phone number leave it as ***
+    phones = formatted.where(valid, null_phone_number).where(~no_phone, '***')
+    fixes['Preferred Phone'] = int((phones != df['Preferred Phone']).sum())
+    df['Preferred Phone'] = phones
+
+    for column in text_columns:
+        values = df[column].fillna('').astype(str).str.strip()
+        values = values.where(values != '', '***')
+        fixes[column] = int((values != df[column]).sum())
+        df[column] = values
+
+    return fixes
@@ -0,0 +1,146 @@
+# Event-driven waits for the website. Every wait polls an expected condition with exponential backoff until it is met
+# or a bounded timeout runs out, and records how long it took and how many times it retried so slow pages can be found.
+import time
+
+from selenium.common.exceptions import (ElementClickInterceptedException, ElementNotInteractableException,
+                                        NoSuchElementException, StaleElementReferenceException, TimeoutException)
+
+from timings import record
+
+# Exceptions that mean the page is still changing, so the condition is polled again instead of failing
+ignored_exceptions = (NoSuchElementException, StaleElementReferenceException, ElementClickInterceptedException,
+                      ElementNotInteractableException)
+
+# Define backoff settings
+initial_poll = 0.05  # Seconds before the condition is polled again the first time
+max_poll = 1  # The delay between polls doubles up to this many seconds
+
+
+def wait_for(driver, condition, timeout: float = 10, name: str = None):
+    """
+    Wait until the condition returns something other than None or False, polling it with exponential backoff.
+    :param driver: the webdriver the condition is checked against
+    :param condition: a callable that takes the driver, like the expected_conditions in selenium
+    :param timeout: the number of seconds to wait before giving up
+    :param name: the name the wait is recorded under, as the stage 'wait: name' in timings
+    :return: what the condition returned
+    :raises TimeoutException: if the condition was not met before the timeout
+    """
+    start = time.perf_counter()
+    delay = initial_poll
+    polls = 0
+    while True:
+        polls += 1
+        try:
+            value = condition(driver)
+            if value is not None and value is not False:  # Not just truthy, so conditions can return e.g. a dataframe
+                _record(name or getattr(condition, '__name__', 'wait'), start, polls, False)
+                return value
+        except ignored_exceptions:
+            pass
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= timeout:
+            _record(name or getattr(condition, '__name__', 'wait'), start, polls, True)
+            raise TimeoutException(f"{name or 'Condition'} was not met after {timeout} seconds")
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, max_poll)
+
+
+def _record(name: str, start: float, polls: int, timed_out: bool) -> None:
+    # Every poll after the first is a retry, e.g. a click that was intercepted or an element that was not there yet
+    record(f'wait: {name}', time.perf_counter() - start, retries=polls - 1, timed_out=timed_out)
+
+
+def clicked(locator: tuple):
+    """
+    Expected condition that clicks the element once it is displayed and enabled. Clicks intercepted by another element
+    are retried on the next poll.
+    :param locator: (By, location) of the element
+    :return: the element once it has been clicked
+    """
+    def condition(driver):
+        element = driver.find_element(*locator)
+        if not (element.is_displayed() and element.is_enabled()):
+            return False
+        element.click()
+        return element
+    return condition
+
+
+def stale(element):
+    """
+    Expected condition that an element has been removed from the page, e.g. because the page re-rendered it
+    """
+    def condition(driver):
+        try:
+            element.is_enabled()
+            return False
+        except StaleElementReferenceException:
+            return True
+    return condition
+
+
+def text_changed(locator: tuple, old_text: str):
+    """
+    Expected condition that the text of an element is no longer old_text
+    :return: the new text
+    """
+    def condition(driver):
+        text = driver.find_element(*locator).text
+        return text if text != old_text else False
+    return condition
+
+
+def any_of(*conditions):
+    """
+    Expected condition that at least one of the conditions is met. A condition that raises one of the ignored
+    exceptions counts as not met, so the others are still checked
+    :return: what the first condition that was met returned
+    """
+    def condition(driver):
+        for each in conditions:
+            try:
+                value = each(driver)
+            except ignored_exceptions:
+                continue
+            if value is not None and value is not False:
+                return value
+        return False
+    return condition
+
+
+# Counts the XMLHttpRequests and fetches the page has started but not finished. It is installed into the page the first
+# time network_idle is checked, so requests that were already running at that point are not seen.
+_network_tracker = """
+if (window.__pendingRequests === undefined) {
+    window.__pendingRequests = 0;
+    window.__lastNetworkActivity = Date.now();
+    const done = () => { window.__pendingRequests--; window.__lastNetworkActivity = Date.now(); };
+    const send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        window.__pendingRequests++;
+        window.__lastNetworkActivity = Date.now();
+        this.addEventListener('loadend', done);
+        return send.apply(this, arguments);
+    };
+    const fetch = window.fetch;
+    window.fetch = function () {
+        window.__pendingRequests++;
+        window.__lastNetworkActivity = Date.now();
+        return fetch.apply(this, arguments).finally(done);
+    };
+}
+return [document.readyState, window.__pendingRequests, Date.now() - window.__lastNetworkActivity];
+"""
+
+
+def network_idle(quiet_ms: int = 300):
+    """
+    Expected condition that the page has loaded and no requests have been running for quiet_ms milliseconds
+    """
+    def condition(driver):
+        ready_state, pending, quiet = driver.execute_script(_network_tracker)
+        return ready_state == 'complete' and pending <= 0 and quiet >= quiet_ms
+    return condition
+
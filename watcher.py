@@ -0,0 +1,321 @@
+# Runs as a service that files every batch dropped into a folder, instead of editing main.py and running it per batch.
+# Batches are read in a folder named after their form type, e.g. scans/intake/Batch-12.pdf, or in the folder itself as
+# the --type form type. The next batch is read while the current one is uploading, and the browser sessions stay logged
+# in from one batch to the next. Finished batches are moved into done/, and batches that failed into failed/. Batches
+# with pages that could not be filed, e.g. because no session could log in, are left in the folder and tried again later.
+#
+# Usage: python watcher.py scans --type intake --workers 2
+#        python watcher.py scans --status
+import argparse
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+import main
+from error_ledger import ErrorLedger
+from filing import SessionPool
+from forms import form_templates
+from journal import BatchJournal
+from ocr import create_ocr_pool
+from patient_index import PatientIndex
+from prefilter import PageFilter, PageHashes
+from timings import reading_stages, filing_stages, take_samples, print_timing_report, write_timing_log
+
+batch_file_pattern = re.compile(r'Batch-(\d+)\.pdf', re.IGNORECASE)
+status_file = 'watcher_status.json'  # Written into the watched folder every time a job changes status
+retry_delay = 300  # Seconds before a batch with pages that could not be filed is queued again
+
+
+class Job:
+    """
+    One batch to read and file
+    """
+
+    def __init__(self, path: str, form_type: str, batch_number: int):
+        self.path = path
+        self.form_type = form_type
+        self.batch_number = batch_number
+        self.status = 'queued'  # queued, reading, read, uploading, done or failed
+        self.pages = None
+        self.error = None
+        self.times = {'queued': time.time()}
+        self.df = None
+        self.samples = []  # The timings of reading the batch, reported along with those of filing it
+
+    def describe(self) -> dict:
+        return {'batch': os.path.basename(self.path), 'form_type': self.form_type, 'batch_number': self.batch_number,
+                'status': self.status, 'pages': self.pages, 'error': self.error, 'times': self.times}
+
+
+class BatchWatcher:
+    """
+    Finds new batches in the watched folder and passes them through two stages, each in its own thread: reading, then
+    uploading. Both queues are bounded. When the upload stage falls behind, the reading stage waits for it, and batches
+    are left in the folder until there is room in the queue again.
+    """
+
+    def __init__(self, folder: str, default_type: str, args, max_queued: int = 2, poll_interval: float = 5):
+        """
+        :param folder: the folder batches are dropped into
+        :param default_type: the form type of batches dropped straight into the folder
+        :param args: the command line options
+        :param max_queued: the most batches waiting to be read at once
+        :param poll_interval: seconds between looking for new batches
+        """
+        self.folder = folder
+        self.default_type = default_type
+        self.args = args
+        self.poll_interval = poll_interval
+        self.read_queue = queue.Queue(max_queued)
+        self.upload_queue = queue.Queue(1)  # Only one batch is read ahead of the one uploading
+        self.jobs = []  # Every job since the watcher started, for the status file
+        self.active = set()  # The paths of the batches that are queued, reading or uploading
+        self.sizes = {}  # Maps the path of every new batch to its size and time last changed, to tell it is complete
+        self.retry_at = {}  # Maps the path of every batch left in the folder to be tried again to when it is tried
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def batch_files(self) -> list:
+        """
+        Find the batches in the folder, as (path, form type, batch number)
+        """
+        found = []
+        folders = [(self.folder, self.default_type)] + [(os.path.join(self.folder, form_type), form_type)
+                                                       for form_type in form_templates]
+        for folder, form_type in folders:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                match = batch_file_pattern.fullmatch(entry.name)
+                if match and entry.is_file():
+                    found.append((entry.path, form_type, int(match.group(1))))
+        return sorted(found, key=lambda batch: (batch[2], batch[1]))
+
+    def scan(self) -> None:
+        """
+        Queue the batches that have finished copying into the folder since the last scan
+        """
+        for path, form_type, batch_number in self.batch_files():
+            if path in self.active or time.time() < self.retry_at.get(path, 0):
+                continue
+
+            # A batch is complete once its size and modification time stop changing between scans
+            stat = os.stat(path)
+            if self.sizes.get(path) != (stat.st_size, stat.st_mtime):
+                self.sizes[path] = (stat.st_size, stat.st_mtime)
+                continue
+
+            job = Job(path, form_type, batch_number)
+            try:
+                self.read_queue.put_nowait(job)
+            except queue.Full:
+                return  # Leave the rest for a later scan
+            del self.sizes[path]
+            with self.lock:
+                self.retry_at.pop(path, None)
+                self.active.add(path)
+                self.jobs.append(job)
+            self.report(job)
+
+    def set_status(self, job: Job, status: str, error: str = None) -> None:
+        with self.lock:
+            job.status = status
+            job.error = error
+            job.times[status] = time.time()
+        self.report(job)
+
+    def report(self, job: Job) -> None:
+        """
+        Print the job's new status and write the status of every job to the status file
+        """
+        with self.lock:
+            print(f"[{time.strftime('%H:%M:%S')}] {os.path.basename(job.path)} ({job.form_type}): {job.status}"
+                  + (f" - {job.error}" if job.error else ""))
+            jobs = [each.describe() for each in self.jobs]
+            status = {'updated': time.time(), 'read_queue': self.read_queue.qsize(),
+                      'upload_queue': self.upload_queue.qsize(), 'jobs': jobs}
+            temporary_path = os.path.join(self.folder, status_file + '.tmp')
+            with open(temporary_path, 'w') as file:
+                json.dump(status, file, indent=2)
+            os.replace(temporary_path, os.path.join(self.folder, status_file))
+
+    def finish(self, job: Job, outcome: str, error: str = None) -> None:
+        """
+        Mark a job as done or failed, and move its batch out of the watched folder into done/ or failed/
+        """
+        self.set_status(job, outcome, error)
+        destination = os.path.join(self.folder, outcome)
+        try:
+            os.makedirs(destination, exist_ok=True)
+            shutil.move(job.path, os.path.join(destination, f'{job.form_type}-{os.path.basename(job.path)}'))
+        except OSError as e:
+            print(f"Could not move {job.path} into {destination}: {e!r}")
+        with self.lock:
+            self.active.discard(job.path)
+
+    def retry_later(self, job: Job, error: str) -> None:
+        """
+        Mark a job as failed but leave its batch in the watched folder, so it is queued again after retry_delay. The
+        journal lets the next attempt skip the pages that were filed
+        """
+        self.set_status(job, 'failed', f"{error}, trying again in {retry_delay}s")
+        with self.lock:
+            self.retry_at[job.path] = time.time() + retry_delay
+            self.active.discard(job.path)
+
+    def report_timings(self, job: Job, batch_samples: list) -> None:
+        """
+        Print where the job's time went and add it to the timings log
+        """
+        job.samples = []
+        with self.lock:
+            print(f"Timings of {os.path.basename(job.path)} ({job.form_type}):")
+            print_timing_report(batch_samples)
+        write_timing_log(main.timings_path, batch_samples, job.form_type, job.batch_number)
+
+    def read_stage(self) -> None:
+        """
+        Read each queued batch with a pool of OCR processes that is kept between batches
+        """
+        ocr_pool = create_ocr_pool(main.ocr_workers, None if self.args.no_cache else main.ocr_cache_path,
+                                   main.ocr_cache_max_bytes)
+        page_hashes = None if self.args.no_prefilter else PageHashes(main.page_hashes_path)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    job = self.read_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.set_status(job, 'reading')
+                try:
+                    journal = BatchJournal(main.journal_path, job.form_type, job.batch_number)
+                    page_filter = None if page_hashes is None else PageFilter(journal, page_hashes)
+                    job.df = main.read_batch(job.path, job.form_type, journal, True, ocr_pool,
+                                             page_filter=page_filter)
+                    job.pages = len(job.df)
+                    job.df.to_csv(f'data_{job.form_type}_{job.batch_number}.csv', index=False)
+                except Exception as e:
+                    self.finish(job, 'failed', repr(e))
+                    continue
+                finally:
+                    job.samples = take_samples(reading_stages)
+                self.set_status(job, 'read')
+
+                # Wait while the upload stage is still busy with the batch before
+                while not self.stopping.is_set():
+                    try:
+                        self.upload_queue.put(job, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            if ocr_pool is not None:
+                ocr_pool.shutdown()
+            if page_hashes is not None:
+                page_hashes.close()
+
+    def upload_stage(self) -> None:
+        """
+        File each read batch through sessions that stay logged in between batches
+        """
+        sessions = SessionPool(main.session_opener(self.args.backend, self.args.url, self.args.workers))
+        patient_index = None if self.args.no_index else PatientIndex(main.patient_index_path)
+        error_ledger = ErrorLedger(main.error_ledger_path)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    job = self.upload_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.set_status(job, 'uploading')
+                try:
+                    journal = BatchJournal(main.journal_path, job.form_type, job.batch_number)
+                    results = main.file_batch(job.df, job.path, job.form_type, job.batch_number, journal, True,
+                                              self.args.workers, sessions.acquire, sessions.release,
+                                              self.args.matcher, patient_index, error_ledger)
+                except Exception as e:
+                    self.finish(job, 'failed', repr(e))
+                    continue
+                finally:
+                    job.df = None  # Drop the batch's dataframe once it is filed
+                    self.report_timings(job, job.samples + take_samples(filing_stages))
+                unfiled = sorted(page_index for page_index, success in results.items() if success is None)
+                if unfiled:
+                    self.retry_later(job, f"{len(unfiled)} pages could not be filed: "
+                                          f"{', '.join(str(page_index + 1) for page_index in unfiled)}")
+                else:
+                    self.finish(job, 'done')
+        finally:
+            sessions.close()
+            if patient_index is not None:
+                patient_index.close()
+            error_ledger.close()
+
+    def run(self) -> None:
+        """
+        Watch the folder until interrupted
+        """
+        stages = [threading.Thread(target=self.read_stage, name='read'),
+                  threading.Thread(target=self.upload_stage, name='upload')]
+        for stage in stages:
+            stage.start()
+        print(f"Watching {os.path.abspath(self.folder)} for batches")
+        try:
+            while True:
+                self.scan()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Stopping once the current batches are finished")
+        finally:
+            self.stopping.set()
+            for stage in stages:
+                stage.join()
+
+
+def print_status(folder: str) -> None:
+    """
+    Print the status file a running watcher writes
+    """
+    path = os.path.join(folder, status_file)
+    if not os.path.exists(path):
+        print(f"No watcher has written {path} yet")
+        return
+    with open(path) as file:
+        status = json.load(file)
+    print(f"Updated {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(status['updated']))}, "
+          f"{status['read_queue']} waiting to be read, {status['upload_queue']} waiting to be uploaded")
+    for job in status['jobs']:
+        print(f"{job['batch']:<20}{job['form_type']:<8}{job['status']:<11}{job['pages'] or '':>6}  {job['error'] or ''}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='File every batch dropped into a folder, as a long-running service')
+    parser.add_argument('folder', help='the folder scanned batches are dropped into')
+    parser.add_argument('--type', choices=list(form_templates), default=main.file_type,
+                        help='form type of batches dropped straight into the folder rather than into a form type folder')
+    parser.add_argument('--status', action='store_true', help='print the status of a running watcher and exit')
+    parser.add_argument('--max-queued', type=int, default=2, help='most batches waiting to be read at once')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between looking for new batches')
+    parser.add_argument('--workers', type=int, default=main.upload_workers,
+                        help='number of sessions that upload at the same time')
+    parser.add_argument('--url', default=main.url, help='address of the website')
+    parser.add_argument('--matcher', choices=['scored', 'cascade'], default=main.patient_matcher)
+    parser.add_argument('--backend', choices=['selenium', 'http'], default=main.upload_backend,
+                        help="drive the website through Chrome, or (experimental) call the api api_session.py assumes")
+    parser.add_argument('--no-cache', action='store_true', help='run tesseract on every region without the OCR cache')
+    parser.add_argument('--no-index', action='store_true', help='always search the website for patients')
+    parser.add_argument('--no-prefilter', action='store_true', default=not main.prefilter_pages,
+                        help='read every page, including blank pages and pages that were scanned twice')
+    parser.add_argument('--no-adaptive', action='store_true', default=not main.adaptive_extraction,
+                        help='read every region once, without reading missing or low-confidence fields again')
+    args = parser.parse_args()
+    main.adaptive_extraction = not args.no_adaptive
+
+    if args.status:
+        print_status(args.folder)
+    else:
+        BatchWatcher(args.folder, args.type, args, args.max_queued, args.poll).run()